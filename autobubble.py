@@ -6,19 +6,41 @@
 #     active image:      gimp.image_list()[0]
 #     active layer:      <image>.active_layer()
 #
+# sys.path.append('projects/gimp-autobubble')
 # execfile('projects/gimp-autobubble/autobubble.py')
 #
 # debug cheat
 """
 -- start --
+sys.path.append('projects/gimp-autobubble')
 execfile('projects/gimp-autobubble/autobubble.py')
 image = gimp.image_list()[0]
 """
 
+import os
+import sys
 import math
+import time
 import copy
+import json
+import hashlib
 import itertools
+import collections
+import multiprocessing
 from gimpfu import *
+import gimpplugin
+
+# everything that computes bubble geometry lives in autobubble_geometry.py,
+# which doesn't need gimp. That way worker processes (and benchmarks) can
+# import it. When this file is execfile'd from the console there's no
+# __file__, so the console needs to put the script directory on sys.path
+# itself (see cheat sheet above)
+try:
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+  pass
+
+from autobubble_geometry import *
 
 # I tried looking for proper solution that gets position of a given layer
 # in the layer stack. Google didn't yield anything useful, and text outliner
@@ -55,29 +77,186 @@ def get_layer_stack_position(layer, group):
 
   return 0  # for some reason we didn't find proper position of layer in the stack     
 
-# add a new layer under given layer
-def add_layer_below(image, layer, preserveCmd=False, argumentPass="()=>skip", tag=''):
-  stack_pos = 0
-  
-  if layer.parent:
-    # parent is a group layer (= we're inside a group layer)
-    # this returns a tuple: (parent id, (<child ids>)). We want child ids.
-    sublayers = pdb.gimp_item_get_children(layer.parent)[1]
-    stack_pos = get_layer_stack_position(layer, sublayers)
-  else:
-    # parent is not a group layer (e.g. selected layer is on top level)
-    stack_pos = get_layer_stack_position(layer, image.layers)
-  
+# Per-run index of layer stacks. Asking gimp for children of a group (and then
+# for every child by its id) on every insert makes groups with lots of text
+# layers quadratic, so we ask once per group and keep track of what we insert,
+# remove and merge ourselves. python_autobubble resets it on every run.
+#
+# parent id (None for top level of the image) -> {
+#     'children': [child ids, top to bottom],
+#     'bubbles':  {source tattoo: [[layer, tag], ...]} or None if not built yet
+# }
+__layer_index = {}
+
+def reset_layer_index():
+  __layer_index.clear()
+
+def get_layer_index_entry(image, parent):
+  key = parent.ID if parent else None
+  if key not in __layer_index:
+    if parent:
+      children = pdb.gimp_item_get_children(parent)[1]
+    else:
+      children = pdb.gimp_image_get_layers(image)[1]
+    __layer_index[key] = {'children': list(children), 'bubbles': None}
+  return __layer_index[key]
+
+# ids of children of parent (or top-level layers if parent is None), top to
+# bottom. Don't change the list, use index_* functions for that
+def get_layer_children(image, parent):
+  return get_layer_index_entry(image, parent)['children']
+
+def index_layer_inserted(layer, parent, position):
+  entry = __layer_index.get(parent.ID if parent else None)
+  if entry:
+    entry['children'].insert(position, layer.ID)
+
+def index_layer_removed(layer, parent):
+  entry = __layer_index.get(parent.ID if parent else None)
+  if entry:
+    if layer.ID in entry['children']:
+      entry['children'].remove(layer.ID)
+    entry['bubbles'] = None
+
+# layer and the layer below it became merged
+def index_layer_merged(layer, parent, merged):
+  entry = __layer_index.get(parent.ID if parent else None)
+  if entry and layer.ID in entry['children']:
+    position = entry['children'].index(layer.ID)
+    entry['children'][position:position + 2] = [merged.ID]
+    entry['bubbles'] = None
+
+def remove_layer(image, layer):
+  parent = layer.parent
+  pdb.gimp_image_remove_layer(image, layer)
+  index_layer_removed(layer, parent)
+
+# merges layer into the one below it. Merged layer keeps the name of the top one
+def merge_layer_down(image, layer):
+  name = layer.name
+  parent = layer.parent
+  merged = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
+  merged.name = name
+  index_layer_merged(layer, parent, merged)
+  return merged
+
+# Snapshot of the layer tree. Going through a group means asking gimp for its
+# children, then asking every child if it's visible, what it's called, what
+# parasites it has and so on, and collect_bubble_layers and plan_group
+# both do that on every level. Every one of those questions is a round trip
+# to gimp, so we ask once per layer, when the run starts, and keep answers
+# (with command blocks already parsed) in a tree of LayerNodes.
+#
+# Snapshot is what the tree looked like before we started. Bubble layers we
+# add don't show up in it, layers we remove and merge don't go away. Where a
+# new layer goes is up to the layer index (see above), which does keep up.
+# We never look inside hidden groups, so their nodes don't have children,
+# and we only ask about things we'll need: text-ness, offsets and size of
+# groups and hidden layers are never used, so they're left at False/None.
+class LayerNode(object):
+  # same names as gimp's layer attributes, where there's one
+  __slots__ = ['ID', 'item', 'kind', 'visible', 'text', 'bubble', 'name', 'offsets', 'width', 'height', 'arguments', 'children', 'parent']
+
+  def __init__(self, item, parent = None):
+    self.ID = item.ID
+    self.item = item
+    self.parent = parent
+    self.kind = 'group' if type(item) is gimp.GroupLayer else 'layer'
+    self.visible = item.visible
+    self.name = item.name
+    self.arguments = get_layer_arguments(self.name)
+    self.children = []
+
+    self.text = False
+    self.bubble = self.name.startswith('@autobubble')
+    self.offsets = None
+    self.width = None
+    self.height = None
+
+    # hidden bubble layers still need to go once their source is gone
+    if self.kind == 'layer':
+      parasites = item.parasite_list()
+      self.bubble = self.bubble or bubble_parasite in parasites
+
+    if self.kind == 'layer' and self.visible:
+      self.text = bool(parasites) and parasites[0] == 'gimp-text-layer'
+      self.offsets = item.offsets
+      self.width = item.width
+      self.height = item.height
+
+  def __repr__(self):
+    return '<LayerNode {} #{}>'.format(self.name, self.ID)
+
+# every node of the snapshot, by id. python_autobubble resets it on every run
+__layer_nodes = {}
+
+def reset_layer_nodes():
+  __layer_nodes.clear()
+
+def snapshot_layer_tree(image, layer):
+  node = LayerNode(layer)
+  __layer_nodes[node.ID] = node
+  if node.kind == 'group':
+    snapshot_layer_children(image, node)
+  return node
+
+def snapshot_layer_children(image, node):
+  for childId in get_layer_children(image, node.item):
+    child = LayerNode(gimp.Item.from_id(childId), node)
+    __layer_nodes[child.ID] = child
+    if child.kind == 'group' and child.visible:
+      snapshot_layer_children(image, child)
+    node.children.append(child)
+
+# offsets and [width, height] of a layer. From the snapshot, if it has them
+def get_layer_offsets(layer):
+  node = __layer_nodes.get(layer.ID)
+  if node and node.offsets is not None:
+    return node.offsets
+  return layer.offsets
+
+def get_layer_size(layer):
+  node = __layer_nodes.get(layer.ID)
+  if node and node.width is not None:
+    return [node.width, node.height]
+  return [layer.width, layer.height]
+
+# layers we make only need to cover what we're going to paint into them, so
+# they're sized to the selection instead of the whole image.
+# Returns [x, y, width, height]
+def get_selection_bounds(image):
+  [nonEmpty, x1, y1, x2, y2] = pdb.gimp_selection_bounds(image)
+  if not nonEmpty:
+    return [0, 0, 1, 1]
+  return [x1, y1, x2 - x1, y2 - y1]
+
+# name of a layer we make for the layer called sourceName
+def get_bubble_layer_name(sourceName, preserveCmd=False, argumentPass="()=>skip", tag=''):
   if preserveCmd:
-    new_name = layer.name
+    new_name = sourceName
   else:
-    new_name = layer.name.split('()=>')[0]
+    new_name = sourceName.split('()=>')[0]
 
-  layer_out = gimp.Layer(image, "@autobubble{}::{}{}".format(tag, new_name, argumentPass), image.width, image.height, get_layer_type(image), 100, NORMAL_MODE)
+  return "@autobubble{}::{}{}".format(tag, new_name, argumentPass)
+
+# add a new layer under given layer. New layer covers bounds ([x, y, width,
+# height]) or, if there's no bounds, current selection. In that case select
+# what's going to be painted (outline grown and feathered) first
+def add_layer_below(image, layer, preserveCmd=False, argumentPass="()=>skip", tag='', bounds=None):
+  # parent is either a group layer (= we're inside a group layer) or None (e.g.
+  # selected layer is on top level)
+  siblings = get_layer_children(image, layer.parent)
+  stack_pos = siblings.index(layer.ID) if layer.ID in siblings else 0
+
+  [x, y, width, height] = bounds or get_selection_bounds(image)
+  layer_out = gimp.Layer(image, get_bubble_layer_name(layer.name, preserveCmd, argumentPass, tag), width, height, get_layer_type(image), 100, NORMAL_MODE)
   
   # if img.active_layer.parent doesn't exist, it adds layer to top group. Otherwise 
   # the layer will be added into current layer group
   pdb.gimp_image_insert_layer(image, layer_out, layer.parent, stack_pos + 1)
+  index_layer_inserted(layer_out, layer.parent, stack_pos + 1)
+  layer_out.set_offsets(x, y)
+  track_created_layer(layer_out)
 
   return layer_out
 
@@ -89,16 +268,19 @@ def add_layer_group_bottom(image, layer):
     # we want to give outline to a layer group. We add new layer at 
     # at the bottom of the current group, so moving the group moves
     # both group's original contents as well as the outline
-    stack_pos = len(pdb.gimp_item_get_children(layer)[1]) - 1
+    stack_pos = len(get_layer_children(image, layer)) - 1
 
   else:
     # not a layer group, business as usual:
     return add_layer_below(image, layer)
   
-  layer_out = gimp.Layer(image, "outline::{}".format(layer.name), image.width, image.height, get_layer_type(image), 100, NORMAL_MODE)
+  [x, y, width, height] = get_selection_bounds(image)
+  layer_out = gimp.Layer(image, "outline::{}".format(layer.name), width, height, get_layer_type(image), 100, NORMAL_MODE)
   # if img.active_layer.parent doesn't exist, it adds layer to top group. Otherwise 
   # the layer will be added into current layer group
   pdb.gimp_image_insert_layer(image, layer_out, layer, stack_pos + 1)
+  index_layer_inserted(layer_out, layer, stack_pos + 1)
+  layer_out.set_offsets(x, y)
 
   return layer_out
 
@@ -121,6 +303,88 @@ def add_layer_group_bottom(image, layer):
 
   return bubble_layer
 
+#
+#
+#  I N C R E M E N T A L   R E - B U B B L I N G
+#
+# every bubble (and outline) layer we make gets a parasite that says which
+# layer it was made for and a fingerprint of everything that went into it:
+# contents and positions of source layers plus all arguments that change how
+# the bubble looks. When we run again, bubbles with a matching fingerprint
+# are left alone and stale ones are removed before we make new ones.
+bubble_parasite = 'autobubble-source'
+
+def get_bubble_fingerprint(layers, bubbleArgs):
+  parts = [repr(bubbleArgs)]
+  for layer in layers:
+    parts.append(get_layer_content_key(layer))
+    parts.append(repr(get_layer_offsets(layer)))
+  return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+def tag_bubble_layer(layer, source, role, fingerprint):
+  data = json.dumps({'source': source.tattoo, 'role': role, 'fingerprint': fingerprint})
+  layer.attach_new_parasite(bubble_parasite, PARASITE_PERSISTENT, data)
+
+  entry = __layer_index.get(layer.parent.ID if layer.parent else None)
+  if entry:
+    entry['bubbles'] = None
+
+def get_bubble_tag(layer):
+  parasite = layer.parasite_find(bubble_parasite)
+  if not parasite:
+    return None
+  try:
+    return json.loads(parasite.data)
+  except ValueError:
+    return None
+
+# layers made by this script. Old versions didn't tag their layers, but they
+# did name them '@autobubble...'
+def is_bubble_layer(layer):
+  return layer.name.startswith('@autobubble') or get_bubble_tag(layer) is not None
+
+# bubble layers of a source always sit next to it, in the same parent. Tags of
+# all bubble layers in the parent are read once and kept in the layer index
+def find_bubble_layers(image, source):
+  entry = get_layer_index_entry(image, source.parent)
+
+  if entry['bubbles'] is None:
+    entry['bubbles'] = {}
+    for layerId in entry['children']:
+      layer = gimp.Item.from_id(layerId)
+      tag = get_bubble_tag(layer)
+      if tag:
+        entry['bubbles'].setdefault(tag['source'], []).append([layer, tag])
+
+  return list(entry['bubbles'].get(source.tattoo, []))
+
+# marks bubble layer for removal if the layer it was made for doesn't exist
+# anymore. Returns True if it did that. Layers marked for removal go to
+# 'removed' (id -> layer), they get removed when the plan is applied
+def mark_orphaned_bubble_layer(image, layer, removed):
+  tag = get_bubble_tag(layer)
+  if not tag or pdb.gimp_image_get_layer_by_tattoo(image, tag['source']):
+    return False
+
+  removed[layer.ID] = layer
+  return True
+
+# returns True if source already has bubble layers for every role, all with
+# the given fingerprint. Otherwise marks whatever stale bubble layers it has
+# for removal (see above) and returns False
+def reuse_bubble_layers(image, source, fingerprint, roles, removed):
+  found = find_bubble_layers(image, source)
+
+  if found and sorted(tag['role'] for [layer, tag] in found) == sorted(roles):
+    if all(tag['fingerprint'] == fingerprint for [layer, tag] in found):
+      count_stat('bubbles_reused')
+      return True
+
+  for [layer, tag] in found:
+    removed[layer.ID] = layer
+
+  return False
+
 #
 #
 #  A U T O - A R G U M E N T     P A R S E R
@@ -156,6 +420,164 @@ def parse_args_from_layer_name(name):
 
   return argsOut
 
+# parsed command blocks by layer name. Names don't change what they parse to,
+# so these are kept between runs. Nobody changes parsed arguments, so they
+# can be shared, too
+__layer_arguments = {}
+layer_arguments_cache_size = 10000
+
+# command block of a layer name, or None if there isn't one
+def get_layer_arguments(name):
+  if name not in __layer_arguments:
+    if len(__layer_arguments) >= layer_arguments_cache_size:
+      __layer_arguments.clear()
+    try:
+      __layer_arguments[name] = parse_args_from_layer_name(name)
+    except IndexError:
+      __layer_arguments[name] = None
+  return __layer_arguments[name]
+
+# how far apart text has to be to get split into separate bubbles, if the
+# 'split' command doesn't say
+split_distance = 32
+
+# bubble options that don't have their own function parameter. Command block
+# in the layer name can change these, same as the regular parameters
+def default_options():
+  return {
+    'metrics': False,     # text rows from font metrics: False, True or 'refine'
+    'fit': 'mvee',        # ellipse fitter: 'mvee' or 'bruteforce'
+    'rotated': False,     # allow rotated ellipses (mvee only)
+    'tolerance': 0.001,   # how close to optimal mvee ellipse needs to be
+    'budget': 1000,       # milliseconds ellipse fitting can take per bubble. 0 means no limit
+    'cache': True,        # keep rows and ellipses in geometry cache file
+    'incremental': True,  # keep bubbles whose source didn't change, replace stale ones
+    'workers': 0,         # processes that compute geometry. 0 means one per core
+    'profile': False,     # write timing report: False, True or path to the report
+    'undo': 'group',      # 'group' (one undo step), 'freeze' (no undo) or 'steps'
+    'rounded': 0,         # corner radius of rectangle bubbles
+    'render': 'selection',  # 'selection' (select and fill) or 'raster' (numpy)
+    'split': 0,           # split layers into a bubble per clump of text this far apart. 0 means don't
+  }
+
+# plan_group's parameters (plus things only the command block can set)
+# as a dict, so command blocks can be applied outside of plan_group too
+def get_group_settings(auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options):
+  return {
+    'auto': auto,
+    'isRound': isRound,
+    'minStepSize': minStepSize,
+    'xpad': xpad,
+    'ypad': ypad,
+    'separate_groups': separate_groups,
+    'separate_layers': separate_layers,
+    'merge_source': merge_source,
+    'outline': outline,
+    'outline_thickness': outline_thickness,
+    'outline_feather': outline_feather,
+    'merge_outline': merge_outline,
+    'inherit_auto_config': inherit_auto_config,
+    'use_defaults': use_defaults,
+    # copy, so that changes from our command block don't leak to the parent.
+    # Anything the caller didn't set keeps its default
+    'options': dict(default_options(), **(options or {})),
+    # these don't carry over to children
+    'skip': False,
+    'fgcolor': '',
+    'bgcolor': '',
+    'argPass': '()=>skip',
+    'preserveCmd': False,
+  }
+
+# applies command block (see get_layer_arguments) to settings. Returns False
+# if the group shouldn't be processed at all. Raises if there's no command
+# block (arguments is None)
+def apply_group_arguments(arguments, settings):
+  if arguments is None:
+    raise ValueError('no command block')
+
+  options = settings['options']
+
+  for arg in arguments:
+    if arg[0] == 'end':
+      return False
+    if arg[0] == 'skip':
+      settings['skip'] = True
+    if arg[0] == 'ellipse':
+      settings['isRound'] = True
+    elif arg[0] == 'rectangle':
+      settings['isRound'] = False
+    elif arg[0] == 'min_step':
+      settings['minStepSize'] = int(arg[1])
+    elif arg[0] == 'xpad':
+      settings['xpad'] = int(arg[1])
+    elif arg[0] == 'ypad':
+      settings['ypad'] = int(arg[1])
+    elif arg[0] == 'separate_groups':
+      settings['separate_groups'] = True
+      settings['separate_layers'] = False
+    elif arg[0] == 'separate_layers':
+      settings['separate_groups'] = False
+      settings['separate_layers'] = True
+    elif arg[0] == 'merge_source':
+      settings['merge_source'] = True
+    elif arg[0] == 'no_merge_source':
+      settings['merge_source'] = False
+    elif arg[0] == 'outline':
+      settings['outline'] = True
+      tmpo = arg[1].split(',')
+      settings['outline_thickness'] = tmpo[0]
+      if len(tmpo) > 1:
+        settings['outline_feather'] = tmpo[1]
+    elif arg[0] == 'merge_outline':
+      settings['merge_outline'] = True
+    elif arg[0] == 'no_merge_outline':
+      settings['merge_outline'] = False
+    elif arg[0] == 'no_auto':
+      settings['auto'] = False
+    elif arg[0] == 'color':
+      settings['fgcolor'] = arg[1]
+    elif arg[0] == 'outline_color':
+      settings['bgcolor'] = arg[1]
+    elif arg[0] == 'pass':
+      settings['argPass'] = arg[1]
+    elif arg[0] == 'preserve_cmd':
+      settings['preserveCmd'] = True
+    elif arg[0] == 'metrics':
+      options['metrics'] = arg[1] if len(arg) > 1 else True
+    elif arg[0] == 'no_metrics':
+      options['metrics'] = False
+    elif arg[0] == 'fit':
+      options['fit'] = arg[1]
+    elif arg[0] == 'rotated':
+      options['rotated'] = True
+    elif arg[0] == 'no_rotated':
+      options['rotated'] = False
+    elif arg[0] == 'tolerance':
+      options['tolerance'] = float(arg[1])
+    elif arg[0] == 'budget':
+      options['budget'] = int(arg[1])
+    elif arg[0] == 'no_cache':
+      options['cache'] = False
+    elif arg[0] == 'no_incremental':
+      options['incremental'] = False
+    elif arg[0] == 'workers':
+      options['workers'] = int(arg[1])
+    elif arg[0] == 'rounded':
+      options['rounded'] = int(arg[1])
+    elif arg[0] == 'render':
+      options['render'] = arg[1]
+    elif arg[0] == 'split':
+      options['split'] = int(arg[1]) if len(arg) > 1 else split_distance
+    elif arg[0] == 'no_split':
+      options['split'] = 0
+
+  if arguments and settings['inherit_auto_config']:
+    settings['use_defaults'] = True
+  elif not arguments and not settings['use_defaults']:
+    settings['skip'] = True
+
+  return True
 
 #
 #
@@ -190,6 +612,14 @@ def set_fg_stack(newColor):
 def restore_fg_stack():
   gimp.set_foreground(color_pop_fg())
 
+def get_color_stack_depth():
+  return [len(__saved_colors_bg), len(__saved_colors_fg)]
+
+# drops colors pushed after get_color_stack_depth returned depth
+def truncate_color_stacks(depth):
+  del __saved_colors_bg[depth[0]:]
+  del __saved_colors_fg[depth[1]:]
+
 #
 #
 # misc helper functions:
@@ -210,482 +640,527 @@ def grow_selection(image, thickness):
 def feather_selection(image, feather):
   pdb.gimp_selection_feather(image, feather)
 
-# FUNCTIONS FOR USE IN determineTextRows
-# Detects if row of pixels has any non-transparent items
-def rowHasText(layer, pixel_region, y):
-  for x in xrange(0, layer.width):
-    if pixel_region[x,y][3] != '\x00':
-      return True
-  return False
+# reads alpha channel of the layer (or a part of it) with a single pixel
+# region read. Returns numpy array of shape [height, width]
+def getLayerAlpha(layer, x=0, y=0, width=None, height=None):
+  [layerWidth, layerHeight] = get_layer_size(layer)
+  if width is None:
+    width = layerWidth
+  if height is None:
+    height = layerHeight
 
-def findRowStartEnd(layer, pixelRegion, currentRow):
-  currentRow.append(findRowStart(layer, pixelRegion, currentRow))
-  currentRow.append(findRowEnd(layer,pixelRegion, currentRow))
+  if not layer.has_alpha:
+    # no alpha channel means every pixel is opaque
+    return np.full((height, width), 255, dtype=np.uint8)
 
-  return currentRow
-
-def findRowStart(layer, pixel_region, currentRow):
-  for x in xrange(0, layer.width):
-    for y in xrange(currentRow[0], currentRow[1]):
-      # we know that sooner or later, we need to find appropriate 'x'. If there were no
-      # as every marked row needs to have at least one non-transparent pixel, so this will
-      # always be true sooner or later
-      if pixel_region[x,y][3] != '\x00':
-        return x
-
-def findRowEnd(layer, pixel_region, currentRow):
-  for x in range(layer.width - 1, -1, -1):
-    for y in xrange(currentRow[0], currentRow[1]):
-      if pixel_region[x,y][3] != '\x00':
-        return x + 1
+  pixel_region = layer.get_pixel_rgn(x, y, width, height, False, False)
+  pixels = np.frombuffer(pixel_region[x:x + width, y:y + height], dtype=np.uint8)
+  pixels = pixels.reshape(height, width, pixel_region.bpp)
 
+  # alpha is always the last channel
+  return pixels[:, :, pixel_region.bpp - 1]
 
 # determine boundaries of text rows
 def determineTextRows(layer):
-  # we'll do all work on copy of our layer
-  work_layer = layer.copy()
-  #
-  # get pixel region of the layer
-  pixel_region = work_layer.get_pixel_rgn(0,0,work_layer.width, work_layer.height)
-  #
-  # we presume layer is completely transparent except for letters
-  # that means if a pixel is not transparent, we're dealing with a letter
-  # we mark rows with text one way, rows without the other.
-  #
-  # rows without text have red component of the first pixel set to 0x00
-  # rows with text have red component of the first pixel set to something else
-  for y in xrange(0, layer.height):
-    if rowHasText(layer, pixel_region, y):
-      pixel_region[0,y] = '\x11' + pixel_region[0,y][1:]
-    else:
-      pixel_region[0,y] = '\x00' + pixel_region[0,y][1:]
-  #
   # rows object: [row][top, bottom, left, right]
-  rows = []
-  isMarked = False
-  currentRow = 0
-  #
-  # with text rows marked, we can determine boundaries of each row
-  for y in xrange(0, layer.height):
-    if pixel_region[0,y][0] != '\x00' and not isMarked:
-      isMarked = True
-      rows.append([y])
-      #
-    if pixel_region[0,y][0] == '\x00' and isMarked:
-      isMarked = False
-      rows[currentRow].append(y - 1)
-      rows[currentRow] = findRowStartEnd(layer, pixel_region, rows[currentRow])      
-      currentRow += 1
-  #
-  return rows
+  if np is not None:
+    return findTextRows(getLayerAlpha(layer))
 
-def findJag(edge1, edge2, minStepSize):
-  #  |<edge1
-  #   |<edge2    - returns 1
-  #
-  #   |<edge1
-  #  |<edge2     - returns -1
-  if abs(edge1 - edge2) < minStepSize:
-    if edge1 > edge2:
-      # print("jag = 1")
-      return 1
-    else: 
-      return -1
-  
-  # print("jag is bigger than min step size")
-  return 0
+  # no numpy, so we go through the layer tile by tile and skip the empty ones
+  [width, height] = get_layer_size(layer)
 
-def correctRows(rows, minStepSize):
-  if len(rows) < 2:
-    return rows #there's nothing to do if we only have one row
-  
-  # correct jags in the left edge
-  for i in xrange(0, len(rows) - 1):
-    jag = findJag(rows[i][2], rows[i+1][2], minStepSize)
-    if jag == -1:
-      rows[i+1][2] = rows[i][2]
-    if jag == 1:
-      # in this case, we correct back, naively. We don't check whether re-adjustment
-      # would cause the jag to grow to acceptable size. I don't think the complicated
-      # nature of the work would make that worth it, but I'll accept a PR
-      rows[i][2] = rows[i+1][2]
-      if i > 0:
-        for j in range(i - 1, -1, -1):
-          rows[j][2] = rows[i][2]
-  
-  # now correct the other edge, but mind that meanings of findJag() have flipped
-  for i in xrange(0, len(rows) - 1):
-    # print('..')
-    jag = findJag(rows[i][3], rows[i+1][3], minStepSize)
-    if jag == 1:
-      rows[i+1][3] = rows[i][3]
-    if jag == -1:
-      rows[i][3] = rows[i+1][3]
-      if i > 0:
-        for j in range(i - 1, -1, -1):
-          rows[j][3] = rows[i][3]
-  
-  return rows
-
-def selectRectangle(image, layer, rows, xpad, ypad):
-  # let's get offsets into more human-readable form
-  offset_x = layer.offsets[0]
-  offset_y = layer.offsets[1]
-
-  # let's do some pre-processing
-  connect_rows_treshold = 0
-  for row in rows:
-    connect_rows_treshold += row[1] - row[0]
+  if not layer.has_alpha:
+    # no alpha channel means every pixel is opaque
+    return findTextRowsSparse(lambda x, y, w, h: '\xff' * (w * h), width, height)
 
-  # if the difference between row[n][1] and row[n+1][0] is more than this,
-  # treat the rows as two separate bubbles
+  pixel_region = layer.get_pixel_rgn(0, 0, width, height, False, False)
+  bpp = pixel_region.bpp
 
-  connect_rows_treshold /= (len(rows))  # Treshold is _average_ row height, hence dividing by len(rows)
+  # alpha is always the last channel
+  def readAlpha(x, y, w, h):
+    return pixel_region[x:x + w, y:y + h][bpp - 1::bpp]
 
-  # now we can start drawing rectangles
-  for i in xrange(0, len(rows)):
-    select_x = rows[i][2] - xpad + offset_x
-    select_y = rows[i][0] - ypad + offset_y
-    select_w = rows[i][3] - rows[i][2] + (2*xpad)
-    select_h = rows[i][1] - rows[i][0] + (2*ypad)
-
-    # image, operation (0 - add), x, y, w, h)
-    pdb.gimp_image_select_rectangle(image, CHANNEL_OP_ADD, select_x, select_y, select_w, select_h)
-
-    # ensure current row is connected with row on top (unless the gap between two rows is
-    # bigger than our treshold)
-
-    if i > 0 and (rows[i][0] - rows[i-1][1]) < connect_rows_treshold:
-      select_x =            max(rows[i][2], rows[i-1][2]) 
-      select_y =            rows[i-1][1] 
-      select_w = 2 * xpad + min(rows[i][3], rows[i-1][3]) - select_x
-      select_h = 2 * ypad + rows[i][0] - select_y
-
-      # there's a reason this isn't included above
-      select_x += offset_x - xpad
-      select_y += offset_y - ypad
-
-      # image, operation (0 - add), x, y, w, h)
-      pdb.gimp_image_select_rectangle(image, CHANNEL_OP_ADD, select_x, select_y, select_w, select_h)
-  # end
-
-def sortPointsByComponent(points, component):
-  # this is criminally bad, but we don't care because it's only 4 points
-  # you can karmawhore this on /r/badcode, I don't care
-  sortedPoints = []
-
-  for p in points:
-    if len(sortedPoints) == 0:
-      sortedPoints.append(p)
-      continue
-
-    append = True
-    for i in range(0, len(sortedPoints)):
-      if sortedPoints[i][component] > p[component]:
-        sortedPoints.insert(i, p)
-        append = False
-        break
-
-    if append:
-      sortedPoints.append(p)
-  
-  return sortedPoints
+  return findTextRowsSparse(readAlpha, width, height)
 
-def getEllipseCenterForPoints(points):
-  # find center
-  middle_x = (points[0][0] + points[1][0] + points[2][0] + points[3][0]) / 4
-  middle_y = (points[0][1] + points[1][1] + points[2][1] + points[3][1]) / 4
-  
-  # find opposing vertices
-  leftFirst = sortPointsByComponent(points, 0)
-  #     * one of the first left points must be nw, the other sw
-  #     * note that this only works because leftmost two points
-  #       cant share 'y' coordinate due to how we calculate edge points
-  leftFirst
-  if leftFirst[0][1] > leftFirst[1][1]:
-    nw = leftFirst[0]
-    sw = leftFirst[1]
-  else:
-    nw = leftFirst[1]
-    sw = leftFirst[0]
-  
-  if leftFirst[2][1] > leftFirst[3][1]:
-    ne = leftFirst[2]
-    se = leftFirst[3]
-  else:
-    ne = leftFirst[3]
-    se = leftFirst[2]
-  
-  # don't even get a center if either of the slopes is vertical
-  if nw[0] == se[0] or ne[0] == sw[0]:
-    return [-1, -1]
+#
+#
+#  T E X T   L A Y E R   M E T R I C S
+#
+# text layers know what text they contain and what font it's written in. If
+# we know how big each glyph is, we can tell where text rows are without
+# looking at a single pixel.
+#
+# NOTE: gimp_text_get_extents_fontname measures ink, not advances. Spaces
+#       have no ink at all, and glyphs don't reach all the way to the next
+#       one, so text is always measured a whole line at a time.
+#
+# line pitch is cached per (font, size). Two lines of 'Hg' are exactly one
+# pitch taller than one line of it, whatever ink the glyphs have
+__line_pitches = {}
+
+def get_ink_width(text, font, size):
+  return pdb.gimp_text_get_extents_fontname(text, size, PIXELS, font)[0]
+
+def get_line_pitch(font, size):
+  key = (font, size)
+  if key not in __line_pitches:
+    one = pdb.gimp_text_get_extents_fontname('Hg', size, PIXELS, font)[1]
+    two = pdb.gimp_text_get_extents_fontname('Hg\nHg', size, PIXELS, font)[1]
+    __line_pitches[key] = two - one
+  return __line_pitches[key]
+
+# how far leading whitespace pushes the line to the right. Whitespace has no
+# ink, so we measure it between two glyphs that do
+def get_indent_width(whitespace, font, size):
+  return get_ink_width('H' + whitespace + 'H', font, size) - get_ink_width('HH', font, size)
+
+# returns text rows calculated from font metrics, or None if text layer is
+# something we can't predict (markup, non-pixel units, text wrapped by a fixed
+# box, ...). Rows are [top, bottom, left, right], same as determineTextRows.
+#
+# NOTE: these are logical rows, not ink rows, so they're a bit taller than
+#       what pixel scan would find. Use refine=True to scan pixels inside of
+#       the predicted rows and tighten them.
+def determineTextRowsFromMetrics(layer, refine=False):
+  text = pdb.gimp_text_layer_get_text(layer)
+  if not text:
+    return None   # text with markup doesn't have plain text
+
+  # unit is a GimpUnit, not a size type like the PIXELS we pass to extents
+  [size, unit] = pdb.gimp_text_layer_get_font_size(layer)
+  if unit != UNIT_PIXEL:
+    return None
+
+  font = pdb.gimp_text_layer_get_font(layer)
+  lineSpacing = pdb.gimp_text_layer_get_line_spacing(layer)
+  letterSpacing = pdb.gimp_text_layer_get_letter_spacing(layer)
+  justification = pdb.gimp_text_layer_get_justification(layer)
+  indent = pdb.gimp_text_layer_get_indent(layer)
+
+  if indent != 0 or justification == TEXT_JUSTIFY_FILL:
+    return None
+
+  pitch = get_line_pitch(font, size)
+  lines = text.split('\n')
 
-  # find where they intersect
-  nwse_slope = (se[1] - nw[1]) / (se[0] - nw[0])
-  swne_slope = (ne[1] - sw[1]) / (ne[0] - sw[0])
-  
-  nwse_extra = se[1] - nwse_slope * se[0]
-  swne_extra = ne[1] - swne_slope * ne[0]
-  
-  x = (swne_extra - nwse_extra) / (nwse_slope - swne_slope)
-  y = (nwse_slope * x) + nwse_extra
-  
-  # mirror that over the center point from earlier
-  mx = middle_x + (middle_x - x)
-  my = middle_y + (middle_y - y)
-  
-  # return value
-  return [mx, my]
-
-def bruteforceEllipseBounds(all_points, combination, mx, my):
-  maxx = combination[0][0]; maxy = combination[0][1]; minx = combination[0][0]; miny = combination[0][1]
-
-  iterations = 50
-  stepRelative = 0.75
-  stepRelative_arStage_outer = 0.99
-  stepRelative_arStage_inner = 0.98
-
-  for p in combination:
-    if p[0] > maxx:
-      maxx = p[0]
-    if p[0] < minx:
-      minx = p[0]
-    if p[1] > maxy:
-      maxy = p[1]
-    if p[1] < miny:
-      miny = p[1]
-
-  ew = maxx - minx  # this is our initial radius, twice as long as width/height
-  eh = maxy - miny  # this also radius, but for other axis
-
-  stepx = ew * stepRelative
-  stepy = eh * stepRelative
-
-  # step 1: find ellipse with same aspect ratio as text
-  while iterations > 0:
-    iterations -= 1
-
-    inEllipse = True
-    for point in all_points:
-      res = (((point[0] - mx) ** 2) / (ew ** 2)) + (((point[1] - my) ** 2) / (eh ** 2))
-      if res > 1:
-        inEllipse = False
-        break
-
-
-    if inEllipse:
-      ew -= stepx
-      eh -= stepy
+  rows = []
+  for i in xrange(0, len(lines)):
+    line = lines[i].rstrip()
+    if not line:
+      continue    # empty lines take space, but they don't get a row
+    if '\t' in line:
+      return None   # tab stops are up to pango
+
+    ink = line.lstrip()
+    lead = line[:len(line) - len(ink)]
+    width = get_ink_width(ink, font, size) + letterSpacing * (len(ink) - 1)
+    offset = get_indent_width(lead, font, size) + letterSpacing * len(lead) if lead else 0
+
+    # we can't tell whether the text layer has a fixed box. If text is wider
+    # than the layer, the box wrapped it and our lines aren't real lines
+    if offset + width > layer.width + 2:
+      return None
+
+    if justification == TEXT_JUSTIFY_RIGHT:
+      left = layer.width - width
+    elif justification == TEXT_JUSTIFY_CENTER:
+      left = (layer.width - width - offset) / 2.0 + offset
     else:
-      ew += stepx
-      eh += stepy
-
-    stepx *= stepRelative
-    stepy *= stepRelative
+      left = offset
 
-  # step 2: try to find a better radius by shrinking shorter radius 
-  # and stretching longer radius. The following values are maximum 
-  # possible values - if we find a solution that has greater area than
-  # the best current solution, we return best width and height without
-  # searching further as we aren't going to find a better solution
-  iterations = 40
-  innerSteps = 20
+    # rows are whole lines, from one line's top to the next one's
+    top = i * (pitch + lineSpacing)
+    rows.append([int(round(top)), int(round(top + pitch)) - 1, int(round(left)), int(round(left + width))])
 
-  bestArea = ew * eh
-  bestw = ew
-  besth = eh
+  # same check for height. Fixed box can be taller than text, but never shorter
+  if not rows or rows[-1][1] > layer.height + 2:
+    return None
 
-  # print("----- bruteforce -----")
-  # print("inital area:")
-  # print([bestArea, [mx, my], [bestw, besth]])
+  if refine and np is not None:
+    return refineTextRows(layer, rows)
 
-  # true if ellipse is wider than taller, false otherwise
-  isLandscape = ew >= eh
-
-  stepx = ew * stepRelative_arStage_outer
-  stepy = eh * stepRelative_arStage_outer
-
-  if isLandscape:
-    stepInner = ew * stepRelative_arStage_inner
-  else:
-    stepInner = eh * stepRelative_arStage_inner
-  
-  for i in range(0, iterations):
-    # reduce shorter radius
-    if isLandscape:
-      eh -= stepy
-    else:
-      ew -= stepx
-
-    h = eh
-    w = ew
+  return rows
 
-    hasBeenInEllipse = False
+# scans pixels inside predicted rows only, tightening them to actual ink.
+# Returns None if what we found doesn't agree with the prediction
+def refineTextRows(layer, rows):
+  refined = []
 
-    for j in range(0, innerSteps):
-      # test if all points are in ellipse
-      inEllipse = True
-      for point in all_points:
-        res = (((point[0] - mx) ** 2) / (w ** 2)) + (((point[1] - my) ** 2) / (h ** 2))
-        if res > 1:
-          inEllipse = False
-          break
-      
-      # expand the ellipse in the other dimension from where we narrowed it
-      if isLandscape:
-        w += stepInner
-      else:
-        h += stepInner
-      
-      if inEllipse:
-        hasBeenInEllipse = True
-        nbb = w * h
-        if nbb < bestArea:
-          bestArea = nbb
-          bestw = w
-          besth = h
-          # print("bruteforce: found new solution (area, mx, my, rx, ry")
-          # print([bestArea, [mx, my], [bestw, besth]])
-        else:
-          break   # we won't find a better solution this iteration
-    
-    if not hasBeenInEllipse:
-      break       # if this iteation has never been in an ellipse, subsequent
-                  # iterations won't be either
-  
-  # return best radius:
-  return [bestw, besth]
+  for row in rows:
+    top = max(row[0], 0)
+    bottom = min(row[1] + 1, layer.height)
+    if bottom <= top:
+      return None
+
+    bandRows = findTextRows(getLayerAlpha(layer, 0, top, layer.width, bottom - top))
+    if len(bandRows) == 0:
+      return None
+
+    # glyphs with a gap in the middle (e.g. 'i' or ':') will produce more than
+    # one band, so merge them back
+    refined.append([
+      bandRows[0][0] + top,
+      bandRows[-1][1] + top,
+      min(r[2] for r in bandRows),
+      max(r[3] for r in bandRows)
+    ])
+
+  return refined
+
+# for checking metrics from the console: returns [metricsRow, scannedRow]
+# for every row where the row predicted from font metrics doesn't contain the
+# row found by scanning pixels (give or take slack pixels). Empty list means
+# metrics agree with the pixels. None if metrics can't predict this layer
+def check_metrics_rows(layer, slack = 2):
+  predicted = determineTextRowsFromMetrics(layer)
+  if predicted is None:
+    return None
+
+  scanned = determineTextRows(layer)
+  if len(predicted) != len(scanned):
+    return [[predicted, scanned]]
+
+  return [[p, r] for [p, r] in zip(predicted, scanned)
+    if r[0] < p[0] - slack or r[1] > p[1] + slack or r[2] < p[2] - slack or r[3] > p[3] + slack]
+
+# picks text rows from font metrics when allowed and possible, otherwise
+# falls back to scanning pixels
+def getTextRows(layer, options):
+  if options['metrics'] and pdb.gimp_item_is_text_layer(layer):
+    rows = determineTextRowsFromMetrics(layer, options['metrics'] == 'refine')
+    if rows:
+      return rows
+
+  return determineTextRows(layer)
+
+# selects bubble shapes (see getBubbleShapes). Polygons that don't overlap
+# are selected with a single call, so that a whole group of rectangle bubbles
+# is usually one selection
+def selectShapes(image, shapes):
+  for shape in shapes:
+    if shape[0] == 'ellipse':
+      # image, operation (0 - add), x, y, w, h)
+      pdb.gimp_image_select_ellipse(image, CHANNEL_OP_ADD, shape[1], shape[2], shape[3], shape[4])
+    elif shape[0] == 'rotated':
+      selectRotatedEllipse(image, *shape[1:])
 
+  for loops in getDisjointPolygonLoops(shapes):
+    selectPolygons(image, loops)
 
-def calculateEllipseBounds_bruteforce(points):
-  bestArea = -1
-  bestBounds = [0, 0, 0, 0]
+def selectPolygons(image, loops):
+  if loops:
+    coords = joinPolygons(loops)
+    pdb.gimp_image_select_polygon(image, CHANNEL_OP_ADD, len(coords), coords)
 
-  for combination in itertools.combinations(points, 4):
-    # print("")
-    # print("")
-    # print("<starting new loop>")
+#
+#
+#  G E O M E T R Y   C A C H E
+#
+# rows and ellipses only depend on what's in the layer and on the shape
+# parameters, so we keep them in a file and skip the work when we see the
+# same layer again. Entries are keyed by hash of layer's alpha (or text
+# layer properties) and shape parameters. Least recently used entries get
+# thrown out once there's more than geometry_cache_size of them.
+#
+# Bump geometry_cache_version whenever geometry code changes what it returns.
+geometry_cache_version = 2
+geometry_cache_size = 5000
+geometry_cache_file = 'autobubble-geometry-cache.json'
+
+__geometry_cache = None
+__geometry_cache_dirty = False
+
+def get_geometry_cache_path():
+  return os.path.join(gimp.directory, geometry_cache_file)
+
+# entries of the cache file, oldest first. No file (or a broken one) means
+# no entries
+def read_geometry_cache_file(path):
+  entries = collections.OrderedDict()
+
+  try:
+    with open(path, 'r') as f:
+      data = json.load(f)
+    if data.get('version') == geometry_cache_version:
+      # entries are saved oldest first
+      for [key, value] in data['entries']:
+        entries[key] = value
+  except (IOError, ValueError, KeyError, TypeError):
+    pass
+
+  return entries
+
+def load_geometry_cache():
+  global __geometry_cache
+  __geometry_cache = read_geometry_cache_file(get_geometry_cache_path())
+  return __geometry_cache
+
+# batch mode runs several gimp processes that all save to the same file. So
+# we merge with whatever is on disk by now (our entries count as the most
+# recent ones), write to a temp file of our own and rename it over the cache
+# file, which is atomic everywhere except on windows
+def save_geometry_cache():
+  global __geometry_cache, __geometry_cache_dirty
+  if __geometry_cache is None or not __geometry_cache_dirty:
+    return
+
+  path = get_geometry_cache_path()
+  tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+  cache = read_geometry_cache_file(path)
+  for key, value in __geometry_cache.items():
+    cache.pop(key, None)
+    cache[key] = value
+  while len(cache) > geometry_cache_size:
+    cache.popitem(last=False)
+
+  try:
+    with open(tmp_path, 'w') as f:
+      json.dump({'version': geometry_cache_version, 'entries': list(cache.items())}, f)
+    if os.name == 'nt' and os.path.exists(path):
+      os.remove(path)     # windows won't rename over existing file
+    os.rename(tmp_path, path)
+    __geometry_cache = cache
+    __geometry_cache_dirty = False
+  except (IOError, OSError) as e:
+    print("[autobubble] couldn't save geometry cache: {}".format(e))
+
+def clear_geometry_cache():
+  global __geometry_cache, __geometry_cache_dirty
+  __geometry_cache = collections.OrderedDict()
+  __geometry_cache_dirty = False
+
+  try:
+    os.remove(get_geometry_cache_path())
+  except OSError:
+    pass
+
+def geometry_cache_get(key):
+  cache = __geometry_cache if __geometry_cache is not None else load_geometry_cache()
+  value = cache.pop(key, None)
+  if value is not None:
+    cache[key] = value      # most recently used entries go to the end
+  return value
+
+def geometry_cache_put(key, value):
+  global __geometry_cache_dirty
+  cache = __geometry_cache if __geometry_cache is not None else load_geometry_cache()
+  cache.pop(key, None)
+  cache[key] = value
+  while len(cache) > geometry_cache_size:
+    cache.popitem(last=False)
+  __geometry_cache_dirty = True
+
+# content keys get asked for more than once per run (incremental check, then
+# geometry cache), so we remember them until the run ends. Source layers don't
+# change while we're running.
+__content_keys = {}
+
+def reset_content_keys():
+  __content_keys.clear()
+
+def get_layer_content_key(layer):
+  if layer.ID not in __content_keys:
+    __content_keys[layer.ID] = compute_layer_content_key(layer)
+  return __content_keys[layer.ID]
+
+# text layers are described by their properties, that's cheaper than reading
+# pixels. Anything else gets its pixels hashed.
+def compute_layer_content_key(layer):
+  [width, height] = get_layer_size(layer)
+
+  if pdb.gimp_item_is_text_layer(layer):
+    return repr([
+      'text',
+      pdb.gimp_text_layer_get_text(layer),
+      pdb.gimp_text_layer_get_markup(layer),
+      pdb.gimp_text_layer_get_font(layer),
+      pdb.gimp_text_layer_get_font_size(layer),
+      pdb.gimp_text_layer_get_antialias(layer),
+      pdb.gimp_text_layer_get_hint_style(layer),
+      pdb.gimp_text_layer_get_kerning(layer),
+      pdb.gimp_text_layer_get_language(layer),
+      pdb.gimp_text_layer_get_base_direction(layer),
+      pdb.gimp_text_layer_get_justification(layer),
+      pdb.gimp_text_layer_get_indent(layer),
+      pdb.gimp_text_layer_get_line_spacing(layer),
+      pdb.gimp_text_layer_get_letter_spacing(layer),
+      width,
+      height
+    ])
+
+  pixel_region = layer.get_pixel_rgn(0, 0, width, height, False, False)
+  return repr([
+    'pixels',
+    width,
+    height,
+    pixel_region.bpp,
+    hashlib.sha1(pixel_region[0:width, 0:height]).hexdigest()
+  ])
+
+def get_geometry_cache_key(layer, isRound, minStepSize, xpad, ypad, options):
+  shape = [geometry_cache_version, isRound, minStepSize, xpad, ypad, options['metrics'], options['fit'], options['rotated'], options['tolerance'], options['budget'], options['split']]
+  return hashlib.sha1(get_layer_content_key(layer) + repr(shape)).hexdigest()
+
+# gimp can only select axis-aligned ellipses, so rotated ones are selected
+# as a polygon
+def selectRotatedEllipse(image, cx, cy, ra, rb, angle, segments = 64):
+  cos = math.cos(angle)
+  sin = math.sin(angle)
+
+  coords = []
+  for i in xrange(0, segments):
+    t = 2 * math.pi * i / segments
+    a = ra * math.cos(t)
+    b = rb * math.sin(t)
+    coords.append(cx + a * cos - b * sin)
+    coords.append(cy + a * sin + b * cos)
+
+  pdb.gimp_image_select_polygon(image, CHANNEL_OP_ADD, len(coords), coords)
+
+# computes rows (and ellipse, for round bubbles) of a layer, or gets them
+# from the geometry cache. Returns {'rows': [...], 'ellipse': [...] or None}
+def getBubbleGeometry(layer, isRound, minStepSize, xpad, ypad, options):
+  # key of a layer that isn't text means hashing all of its pixels, so only
+  # when something can be looked up with it
+  key = None
+  if options['cache'] or __prefetched_geometry:
+    key = get_geometry_cache_key(layer, isRound, minStepSize, xpad, ypad, options)
+
+  if options['cache']:
+    geometry = geometry_cache_get(key)
+    if geometry:
+      count_stat('cache_hits')
+      return geometry
+    count_stat('cache_misses')
+
+  # worker processes may have done the work for us already
+  geometry = __prefetched_geometry.get(key) if key else None
+  if geometry is None and np is not None and options['split']:
+    geometry = computeAlphaGeometry(getLayerAlpha(layer), isRound, minStepSize, xpad, ypad, options)
+  elif geometry is None:
+    geometry = computeBubbleGeometry(getTextRows(layer, options), isRound, minStepSize, xpad, ypad, options)
+
+  # fits that ran out of time might do better next time
+  if options['cache'] and not geometry.get('partial'):
+    geometry_cache_put(key, geometry)
+
+  return geometry
 
-    [mx, my] = getEllipseCenterForPoints(combination)
+#
+#
+#  P A R A L L E L   G E O M E T R Y
+#
+# Once pixels are read, geometry is pure number crunching. So before we draw
+# anything, we walk the layer tree the same way plan_group does, read
+# pixels of every layer that's going to get a bubble and hand them to a pool
+# of worker processes. Results are keyed by geometry cache key, so
+# getBubbleGeometry picks them up when plan_group gets to the layer.
+__prefetched_geometry = {}
+
+def get_worker_count(options):
+  if options['workers'] > 0:
+    return options['workers']
+
+  # on windows, workers are new processes that import this file from scratch,
+  # and gimp's python doesn't cope with that too well
+  if os.name == 'nt':
+    return 1
+
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+# walks the layer tree (snapshot, see LayerNode) the same way plan_group
+# does and appends [layer, isRound, minStepSize, xpad, ypad, options] for
+# every layer that would get a bubble to targets
+def collect_bubble_layers(tree, settings, targets):
+  settings = dict(settings)
+  settings.update(options = dict(settings['options']), skip = False, fgcolor = '', bgcolor = '', argPass = '()=>skip', preserveCmd = False)
+
+  if settings['auto']:
+    try:
+      if not apply_group_arguments(tree.arguments, settings):
+        return
+    except:
+      if not settings['use_defaults']:
+        for node in tree.children:
+          if node.visible and node.kind == 'group':
+            collect_bubble_layers(node, settings, targets)
+        return
 
-    # let's see if getEllipseCenterForPoints told us to not bother with
-    # this set of points. We'd just waste time
-    if mx == -1:
+  for node in tree.children:
+    if not node.visible:
       continue
 
-    [rx, ry] = bruteforceEllipseBounds(points, combination, mx, my)
-
-    # did we already find an ellipse? If no, this is the best candidate
-    # so far and we'll mark it down later.
-    # if yes, we check if the new ellipse is smaller than the old one
-    if bestArea > 0:
-      nbb = rx * ry
-      if nbb < bestArea:
-        # print("[[[ N E W   B E S T   S O L U T I O N]]]")
-        # print ("mx, my, rx, ry")
-        # print (bestBounds)
-        bestArea = nbb
-        bestBounds = [mx, my, rx*2, ry*2]
-    else:
-      bestArea = rx * ry
-      bestBounds = [mx, my, rx*2, ry*2]
-      # print("BEST AREA:")
-      # print([bestArea, [mx, my], [rx, ry]])
-      
-    
-  # print ("::")
-  # print ("mx, my, rx, ry")
-  # print (bestBounds)
-
-  return bestBounds
-
-def getEllipseDimensions(rows, xpad, ypad):
-  # uh oh
-  #
-  # returns [x,y,width,height]
-  #
-  # Ideally, we'd draw an ellipse such that all the points would be:
-  #      * inside the ellipse
-  #      * as close as possible to the edge of the ellipse.
-  #
-  # That's a bit hard, though, so we'll have to do with an approximation.
-  # see: https://math.stackexchange.com/a/207837
-  # and even this is cancer so ...
-  #  
-  # Quick reminder. Rows coords are like this: top, bottom, left, right 
-  #
-  # NOTE: gimp-image-select-ellipse takes arguments (x,y,width,height) AS
-  #       A FLOAT, which means we don't have to round stuff.
-  #       source: procedure browser in gimp (see: help menu)
-
-  rowCount = len(rows)
-
-  edgePoints = []
-
-  # determine edge points and offset a tiny bit to ensure a solution exists
-  # when calculating ellipse dimensions
-  for i in xrange(0, -(-rowCount // 2)):
-    # Instead of having one point per corner, we add extra points which take
-    # vertical and horizontal offset into account (a,b instead of x)
-    #       a    
-    #     b x-----
-    #       | text corner
-    #
-
-    edgePoints.append([float(rows[i][2]), float(rows[i][0])])
-    edgePoints.append([float(rows[i][3]), float(rows[i][0])])
-
-  for i in xrange(rowCount // 2, rowCount):
-    # offset x, left then right
-    edgePoints.append([float(rows[i][2]), float(rows[i][1])])
-    edgePoints.append([float(rows[i][3]), float(rows[i][1])])
-
-  return calculateEllipseBounds_bruteforce(edgePoints)
-  
-def selectEllipse(image, layer, rows, xpad, ypad):
-  # making things more readable
-
-  offset_x = layer.offsets[0]
-  offset_y = layer.offsets[1]
-
-  # oh boi. Let's start by putting the function that calculated ellipse dimensions
-  # into its own function in a bid to clean things up a bit
-  #
-  # returns [center_x, center_y, width, height] (note: center points are relative to
-  # the layer)
-  
-  dims = getEllipseDimensions(rows, xpad, ypad)
-  
-  toolOffset_x = dims[2] // 2
-  toolOffset_y = dims[3] // 2
-
-  # correct coordinates and grow the ellipse  
-  select_x = dims[0] - toolOffset_x - xpad + offset_x
-  select_y = dims[1] - toolOffset_y - ypad + offset_y
-
-  select_w = dims[2] + 2 * xpad
-  select_h = dims[3] + 2 * ypad
-
-
-  # image, operation (0 - add), x, y, w, h)
-  pdb.gimp_image_select_ellipse(image, CHANNEL_OP_ADD, select_x, select_y, select_w, select_h)
-
-def mkbubble (image, layer, isRound, minStepSize, xpad, ypad):
-  # NOTE: image parameter is needed by select functions later down the line.
-  # NOTE: this creates selection (and adds it to existing one). It doesn't
-  # actually fill the bubble, so I suppose the name is a bit misleading
-
-  # TODO: check for empty/non-text layers. If layer is devoid of text, do not
-  # select it. 100% transparent layers can hang the program and garbage input
-  # _will_ produce garbage result. Pro tip: non-text input is garbage input.
+    if node.kind == 'group':
+      collect_bubble_layers(node, settings, targets)
+    elif settings['skip'] or node.bubble:
+      continue
+    elif node.text or not settings['separate_groups']:
+      targets.append([node.item, settings['isRound'], settings['minStepSize'], settings['xpad'], settings['ypad'], settings['options']])
+
+# whether worker processes get alpha of the layer or text rows. Splitting
+# needs alpha of the whole layer, and so does anything that isn't worked out
+# from font metrics. Without numpy, layers are never split
+def uses_alpha_geometry(layer, options):
+  if np is None:
+    return False
+  return options['split'] or not (options['metrics'] and pdb.gimp_item_is_text_layer(layer))
+
+# computes geometry of all targets that aren't cached yet with a pool of
+# worker processes. If there's not enough work to go around (or the pool
+# can't be started), this does nothing and getBubbleGeometry computes
+# geometry one layer at a time, same as before
+def prefetch_bubble_geometry(targets):
+  __prefetched_geometry.clear()
+
+  if not targets:
+    return
+
+  workers = min(get_worker_count(options) for [layer, isRound, minStepSize, xpad, ypad, options] in targets)
+  if workers < 2:
+    return
+
+  pending = collections.OrderedDict()
+  for target in targets:
+    [layer, isRound, minStepSize, xpad, ypad, options] = target
+    key = get_geometry_cache_key(layer, isRound, minStepSize, xpad, ypad, options)
+    if key in pending or (options['cache'] and geometry_cache_get(key)):
+      continue
+    pending[key] = target
 
-  textRows = determineTextRows(layer)
+  if len(pending) < 2:
+    return
 
-  if isRound:
-    selectEllipse(image, layer, textRows, xpad, ypad)
-  else:
-    textRows = correctRows(textRows, minStepSize)
-    selectRectangle(image, layer, textRows, xpad, ypad)
+  # reading pixels needs gimp, so that happens here
+  jobs = []
+  for key, [layer, isRound, minStepSize, xpad, ypad, options] in pending.items():
+    job = {'key': key, 'isRound': isRound, 'minStepSize': minStepSize, 'xpad': xpad, 'ypad': ypad, 'options': options}
+    if uses_alpha_geometry(layer, options):
+      job['alpha'] = getLayerAlpha(layer)
+    else:
+      job['rows'] = getTextRows(layer, options)
+    jobs.append(job)
+
+  pool = None
+  try:
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    results = pool.map(computeBubbleGeometryJob, jobs)
+    pool.close()
+  except Exception as e:
+    print("[prefetch_bubble_geometry] worker pool failed, computing geometry one layer at a time. Error: " + repr(e))
+    if pool:
+      pool.terminate()
+    return
+  pool.join()
+
+  for [key, geometry, stats] in results:
+    __prefetched_geometry[key] = geometry
+    for name, value in stats.items():
+      count_stat(name, value)
+  count_stat('prefetched', len(results))
 
 def mkoutline (image, thickness, feather):
   if thickness > 0:
@@ -693,255 +1168,912 @@ def mkoutline (image, thickness, feather):
   if feather > 0:
     feather_selection(image, feather)
 
-def autobubble_group( image, layer_group, auto = True, isRound = True, minStepSize = 25, xpad = 7, ypad = 3, separate_groups = True, separate_layers = False, merge_source = False, outline = False, outline_thickness = 3, outline_feather = 0, merge_outline = False, inherit_auto_config = False, use_defaults = False):
-  print("[autobubble_group] Hello.")
-  # TODO: optionally set parameters from layer full name
+#
+#
+#  D R A W I N G
+#
+# Bubbles are drawn one of two ways (render option):
+#
+#     'selection'  shapes are selected and bucket filled, outlines are grown
+#                  and feathered selections. Every shape is a pdb call, and
+#                  so is every grow, feather and fill
+#     'raster'     shapes are rasterized with numpy (see autobubble_geometry)
+#                  and written into a new layer with a single pixel region
+#                  write, outlines come from a distance field of the bubbles.
+#                  Selection isn't touched. Needs numpy, falls back to
+#                  'selection' without it
+#
+# Either way, the new layer only covers the bubbles.
+
+def get_render_mode(options):
+  if options['render'] == 'raster' and np is not None:
+    return 'raster'
+  return 'selection'
+
+# [r, g, b] in 0-255 from whatever gimp.get_foreground() returned
+def get_color_bytes(color):
+  if hasattr(color, 'r'):
+    return [int(round(c * 255)) for c in [color.r, color.g, color.b]]
+  if isinstance(color, str):
+    # '#rrggbb', same as color= in the command block
+    return [int(color.lstrip('#')[i:i + 2], 16) for i in [0, 2, 4]]
+  return [int(c) for c in color[:3]]
+
+# writes fills ([coverage, color], bottom to top) into a layer that was made
+# to the size of coverage. Coverage is a numpy array, 0 to 1. Fills are
+# composited over each other, same as layers with normal mode would be
+def write_coverage(layer, fills):
+  [height, width] = fills[0][0].shape
+
+  # premultiplied color
+  color = np.zeros((height, width, 3), dtype=np.float64)
+  alpha = np.zeros((height, width), dtype=np.float64)
+  for [coverage, fillColor] in fills:
+    color *= (1 - coverage)[:, :, None]
+    color += coverage[:, :, None] * get_color_bytes(fillColor)
+    alpha *= 1 - coverage
+    alpha += coverage
+  color /= np.maximum(alpha, 1e-9)[:, :, None]
+
+  pixel_region = layer.get_pixel_rgn(0, 0, width, height, True, True)
+  pixels = np.zeros((height, width, pixel_region.bpp), dtype=np.uint8)
+  if pixel_region.bpp == 4:
+    pixels[:, :, 0:3] = np.rint(color)
+  else:
+    pixels[:, :, 0] = np.rint(np.dot(color, [0.2126, 0.7152, 0.0722]))
+  pixels[:, :, pixel_region.bpp - 1] = np.rint(alpha * 255)
+
+  pixel_region[0:width, 0:height] = pixels.tobytes()
+  layer.flush()
+  layer.merge_shadow(True)
+  layer.update(0, 0, width, height)
+
+# draws bubble shapes on a new layer below source, in foreground color. If
+# there's an outline ([thickness, feather]), it's drawn in background color
+# on a new layer below the bubble, or merged into the bubble layer if
+# merge_outline is set. Returns [bubble layer, outline layer or None]. In
+# 'selection' mode, whatever was selected last stays selected
+def draw_bubble(image, source, shapes, options, outline, merge_outline, preserveCmd, argPass):
+  if get_render_mode(options) == 'raster':
+    return draw_bubble_raster(image, source, shapes, outline, merge_outline, preserveCmd, argPass)
+
+  selectShapes(image, shapes)
+  bubble_layer = add_layer_below(image, source, preserveCmd, argPass)
+  paint_selection_fg(bubble_layer)
+
+  if not outline:
+    return [bubble_layer, None]
+
+  mkoutline(image, outline[0], outline[1])
+  outline_layer = add_layer_below(image, bubble_layer, preserveCmd, argPass, '-outline')
+  paint_selection_bg(outline_layer)
+
+  if merge_outline:
+    bubble_layer = merge_layer_down(image, bubble_layer)
+    track_created_layer(bubble_layer)
+    return [bubble_layer, None]
+
+  return [bubble_layer, outline_layer]
+
+# draw_bubble for 'raster' mode. Shapes are rasterized once, outline comes
+# from the distance field of the bubbles (see rasterizeOutline), and every
+# layer gets written once
+def draw_bubble_raster(image, source, shapes, outline, merge_outline, preserveCmd, argPass):
+  # one pixel of margin for antialiasing
+  bounds = getShapesBounds(shapes, 1, image.width, image.height) or [0, 0, 1, 1]
+
+  if not outline:
+    bubble_layer = add_layer_below(image, source, preserveCmd, argPass, bounds = bounds)
+    write_coverage(bubble_layer, [[rasterizeShapes(shapes, bounds), gimp.get_foreground()]])
+    return [bubble_layer, None]
+
+  # outline needs room to grow. Thickness and feather from command blocks
+  # are strings
+  [thickness, feather] = [float(outline[0]), float(outline[1])]
+  outlineBounds = getShapesBounds(shapes, 1 + getOutlineReach(thickness, feather), image.width, image.height) or [0, 0, 1, 1]
+  bounds = getShapesBounds(shapes, 1, image.width, image.height) or outlineBounds[0:2] + [1, 1]
+
+  coverage = rasterizeShapes(shapes, outlineBounds)
+  outlineCoverage = rasterizeOutline(coverage, thickness, feather)
+
+  if merge_outline:
+    # what merging bubble layer into outline layer would give us
+    bubble_layer = add_layer_below(image, source, preserveCmd, argPass, bounds = outlineBounds)
+    write_coverage(bubble_layer, [[outlineCoverage, gimp.get_background()], [coverage, gimp.get_foreground()]])
+    return [bubble_layer, None]
+
+  [x, y] = [bounds[0] - outlineBounds[0], bounds[1] - outlineBounds[1]]
+  bubble_layer = add_layer_below(image, source, preserveCmd, argPass, bounds = bounds)
+  write_coverage(bubble_layer, [[coverage[y:y + bounds[3], x:x + bounds[2]], gimp.get_foreground()]])
+
+  outline_layer = add_layer_below(image, bubble_layer, preserveCmd, argPass, '-outline', outlineBounds)
+  write_coverage(outline_layer, [[outlineCoverage, gimp.get_background()]])
+  return [bubble_layer, outline_layer]
+
+#
+#
+#  P L A N S
+#
+# A run is split in two. Planning walks the layer tree, works out geometry and
+# decides what needs doing, without changing the image. Applying does it.
+# In between, the plan is a plain dict that survives json.dumps, so it can be
+# saved (save_plan), looked at, diffed between runs and applied later:
+#
+#   {
+#     'version': plan_version,
+#     'remove':  [tattoos of stale bubble layers],
+#     'bubbles': [{
+#       'source':      tattoo of the layer (group) the bubble goes below,
+#       'source_name': its name,
+#       'name':        name of the bubble layer, which goes right below source
+#       'layers':      [{'source': tattoo, 'name': name, 'rows': [...],
+#                        'ellipse': [...] or None, 'regions': [...]}, ...]
+#                      for text layers that make up the bubble. Regions are
+#                      there if the layer got split (see computeAlphaGeometry)
+#                      and empty otherwise,
+#       'shapes':      bubble shapes in image coordinates (getBubbleShapes),
+#       'arguments':   everything from the command block (and parameters)
+#                      that decides how the bubble is drawn,
+#       'fingerprint': what the bubble gets tagged with, None for no tag
+#     }, ...]
+#   }
+#
+# Layers are referred to by tattoo, which survives saving and loading xcf.
+# Bubbles whose source layer is gone by the time the plan is applied are
+# skipped. Bump plan_version whenever the format changes.
+plan_version = 2
+
+# layers by tattoo, so applying a plan made in this run doesn't need to ask
+# gimp for layers it already knows. plan_autobubble resets it
+__plan_layers = {}
+
+def reset_plan_layers():
+  __plan_layers.clear()
+
+def get_plan_tattoo(layer):
+  tattoo = layer.tattoo
+  __plan_layers[tattoo] = layer
+  return tattoo
+
+# None if the layer is gone
+def get_plan_layer(image, tattoo):
+  layer = __plan_layers.get(tattoo)
+  if layer is not None and not pdb.gimp_item_is_valid(layer):
+    del __plan_layers[tattoo]
+    layer = None
+  if layer is None:
+    layer = pdb.gimp_image_get_layer_by_tattoo(image, tattoo)
+  return layer
+
+def new_plan():
+  return {'version': plan_version, 'remove': [], 'bubbles': []}
+
+def save_plan(plan, path):
+  with open(path, 'w') as f:
+    json.dump(plan, f, indent=1, sort_keys=True)
+
+def load_plan(path):
+  with open(path) as f:
+    return json.load(f)
+
+# empty bubble that goes below node. colors are [bubble, outline] colors in
+# effect, '' for whatever the current colors are
+def new_plan_bubble(image, node, settings, colors, fingerprint):
+  return {
+    'source': get_plan_tattoo(node.item),
+    'source_name': node.name,
+    'name': get_bubble_layer_name(node.name, settings['preserveCmd'], settings['argPass']),
+    'layers': [],
+    'shapes': [],
+    'arguments': {
+      'isRound': settings['isRound'],
+      'minStepSize': settings['minStepSize'],
+      'xpad': settings['xpad'],
+      'ypad': settings['ypad'],
+      'outline': settings['outline'],
+      'outline_thickness': settings['outline_thickness'],
+      'outline_feather': settings['outline_feather'],
+      'merge_outline': settings['merge_outline'],
+      'merge_source': settings['merge_source'],
+      'preserveCmd': settings['preserveCmd'],
+      'argPass': settings['argPass'],
+      'color': colors[0],
+      'outline_color': colors[1],
+      'options': settings['options'],
+    },
+    'fingerprint': fingerprint,
+  }
+
+# adds bubble of a layer (node) to a planned bubble: its geometry goes into
+# 'layers' and its shapes into 'shapes'. Completely transparent layers don't
+# add any shapes
+def plan_layer_bubble(bubble, node, isRound, minStepSize, xpad, ypad, options):
+  geometry = getBubbleGeometry(node.item, isRound, minStepSize, xpad, ypad, options)
+
+  bubble['layers'].append({'source': get_plan_tattoo(node.item), 'name': node.name, 'rows': geometry['rows'], 'ellipse': geometry['ellipse'], 'regions': geometry.get('regions', [])})
+  bubble['shapes'].extend(getBubbleShapes(geometry, xpad, ypad, options['rounded'], get_layer_offsets(node.item)))
+
+# everything that changes how a bubble looks goes into its fingerprint.
+# Colors are the ones in effect, so that parent group colors count too
+def get_bubble_args(settings, colors):
+  options = settings['options']
+  return [settings['isRound'], settings['minStepSize'], settings['xpad'], settings['ypad'], settings['outline'], settings['outline_thickness'], settings['outline_feather'], settings['merge_outline'], colors[0], colors[1], settings['preserveCmd'], settings['argPass'], options['metrics'], options['fit'], options['rotated'], options['tolerance'], options['budget'], options['rounded'], options['split'], get_render_mode(options)]
+
+# bubble layers a bubble drawn with these settings ends up with
+def get_bubble_roles(settings):
+  return ['bubble', 'outline'] if settings['outline'] and not settings['merge_outline'] else ['bubble']
+
+# plans bubbles for a layer group (or its snapshot, see LayerNode) and
+# everything inside it. colors are the colors in effect, see new_plan_bubble
+def plan_group(plan, image, layer_group, auto = True, isRound = True, minStepSize = 25, xpad = 7, ypad = 3, separate_groups = True, separate_layers = False, merge_source = False, outline = False, outline_thickness = 3, outline_feather = 0, merge_outline = False, inherit_auto_config = False, use_defaults = False, options = None, colors = None):
   # NOTE: parameter from layer full name override function call
-  
-  # get children of currently active layer group
-  # returns [group layer id, [array with sublayer ids]]
-  # if we do dis, we only get array with sublayer ids
-  sublayers = pdb.gimp_item_get_children(layer_group)[1]
-  
-  fgcolor = ''
-  bgcolor = ''
-  texts_processed = 0
 
-  skip = False
-  argPass = '()=>skip'
-  preserveCmd = False
+  tree = layer_group if isinstance(layer_group, LayerNode) else snapshot_layer_tree(image, layer_group)
+  layer_group = tree.item
+  colors = colors or ['', '']
+
+  settings = get_group_settings(auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options)
 
   if auto:
     try:
-      arguments = parse_args_from_layer_name(layer_group.name)
-      for arg in arguments:
-        if arg[0] == 'end':
-          return
-        if arg[0] == 'skip':
-          skip = True
-        if arg[0] == 'ellipse':
-          isRound = True
-        elif arg[0] == 'rectangle':
-          isRound = False
-        elif arg[0] == 'min_step':
-          minStepSize = int(arg[1])
-        elif arg[0] == 'xpad':
-          xpad = int(arg[1])
-        elif arg[0] == 'ypad':
-          ypad = int(arg[1])
-        elif arg[0] == 'separate_groups':
-          separate_groups = True
-          separate_layers = False
-        elif arg[0] == 'separate_layers':
-          separate_groups = False
-          separate_layers = True
-        elif arg[0] == 'merge_source':
-          merge_source = True
-        elif arg[0] == 'no_merge_source':
-          merge_source = False
-        elif arg[0] == 'outline':
-          outline = True,
-          tmpo = arg[1].split(',')
-          outline_thickness = tmpo[0]
-          if len(tmpo) > 1:
-            outline_feather = tmpo[1]
-        elif arg[0] == 'merge_outline':
-          merge_outline = True
-        elif arg[0] == 'no_merge_outline':
-          merge_outline = False
-        elif arg[0] == 'no_auto':
-          auto = False
-        elif arg[0] == 'color':
-          fgcolor = arg[1]
-        elif arg[0] == 'outline_color':
-          bgcolor = arg[1]
-        elif arg[0] == 'pass':
-          argPass = arg[1]
-        elif arg[0] == 'preserve_cmd':
-          preserveCmd = True
-
-      if arguments and inherit_auto_config:
-        use_defaults = True
-      elif not arguments and not use_defaults:
-        skip = True
-      
-      print("[autobubble_group] arguments parsed successfully.")
-    
+      if not apply_group_arguments(tree.arguments, settings):
+        return
+
     except:
       if not use_defaults: # if use_defaults is set, the function will continue with same parameters as its parent
-        print("[autobubble_group] no arguments present on the layer group & use_defaults is not set. autobubble_group() will be run recursively, but nothing will be done on this layer (group).")
-
-        for layerId in sublayers:
-          layer = gimp.Item.from_id(layerId)
-          
+        # no arguments present on the layer group & use_defaults is not set.
+        # Children get processed, but nothing will be done on this group
+        for node in tree.children:
           # we ignore hidden layers
-          if not layer.visible:
+          if not node.visible:
             continue
           
           # autobubble layer groups
-          if type(layer) is gimp.GroupLayer:
-            autobubble_group(image, layer, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults)
+          if node.kind == 'group':
+            plan_group(plan, image, node, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options, colors)
         
         return
 
-
-  if fgcolor:
-    set_fg_stack(fgcolor)
-
-  if bgcolor:
-    set_bg_stack(bgcolor)
+  auto = settings['auto']
+  isRound = settings['isRound']
+  minStepSize = settings['minStepSize']
+  xpad = settings['xpad']
+  ypad = settings['ypad']
+  separate_groups = settings['separate_groups']
+  separate_layers = settings['separate_layers']
+  merge_source = settings['merge_source']
+  outline = settings['outline']
+  outline_thickness = settings['outline_thickness']
+  outline_feather = settings['outline_feather']
+  merge_outline = settings['merge_outline']
+  use_defaults = settings['use_defaults']
+  options = settings['options']
+  skip = settings['skip']
+  fgcolor = settings['fgcolor']
+  bgcolor = settings['bgcolor']
+  argPass = settings['argPass']
+  preserveCmd = settings['preserveCmd']
+
+  # colors carry over to everything inside the group
+  colors = [fgcolor or colors[0], bgcolor or colors[1]]
+
+  bubbleArgs = get_bubble_args(settings, colors)
+  outlineRoles = get_bubble_roles(settings)
+
+  # stale bubble layers that are going to be removed, id -> layer. They're
+  # still in the snapshot
+  removed = collections.OrderedDict()
 
   if separate_groups:
-    print("[autobubble_group] will operate on separate groups. skip?")
-    print(skip)
     group_layers = []
+    text_layers = []
 
-    for layerId in sublayers:
-      layer = gimp.Item.from_id(layerId)
+    for node in tree.children:
+      # bubbles from previous runs go if their layer is gone, hidden or not
+      if node.bubble:
+        mark_orphaned_bubble_layer(image, node.item, removed)
+        continue
 
       # we ignore hidden layers
-      if not layer.visible:
+      if not node.visible:
         continue
       
       # we hide layer gropups and put them on a "handle me later pls" list
-      if type(layer) is gimp.GroupLayer:
-        print("[autobubble_group] trying to operate on a layer group. Deferring for later recursion")
-        group_layers.append(layer)
-      else:
-        print("[autobubble_group] checking layer for text")
-        print(layer)
-        print(layer.parasite_list())
-        pl = layer.parasite_list()
-        if pl and pl[0] == 'gimp-text-layer':
-          print("[autobubble_group] layer has text. Will make bubble.")
-          # process all non-group layers
-          # print("started processing layer " + layer.name)
-          mkbubble(image, layer, isRound, minStepSize, xpad, ypad)
-          print("[autobubble_group] bubble created.")
-          # print(layer.name + " processed")
-          texts_processed += 1
-
-    if texts_processed > 0 and (not skip):
-      # we've created bubbles for all layers (excluding groups). Now fill the bubble
-      group_bubble_layer = add_layer_below(image, layer_group, preserveCmd, argPass)
-      paint_selection_fg(group_bubble_layer)
-
-      # if bubbles have an outline
-      if outline:
-        group_bubble_outline_layer = add_layer_below(image, group_bubble_layer, preserveCmd, argPass, '-outline')
-        mkoutline(image, outline_thickness, outline_feather)
-        paint_selection_bg(group_bubble_outline_layer)
-
-        if merge_outline:
-          name = group_bubble_layer.name
-          mergedLayer = pdb.gimp_image_merge_down(image, group_bubble_layer, EXPAND_AS_NECESSARY)
-          mergedLayer.name = name
-      
-    clear_selection(image)
+      if node.kind == 'group':
+        group_layers.append(node)
+      elif node.text:
+        text_layers.append(node)
+
+    fresh = False
+    fingerprint = None
+    if text_layers and not skip and options['incremental']:
+      fingerprint = get_bubble_fingerprint([node.item for node in text_layers], bubbleArgs + [tree.name])
+      fresh = reuse_bubble_layers(image, layer_group, fingerprint, outlineRoles, removed)
+    elif not text_layers and not skip and options['incremental']:
+      # no text left in the group, so neither should be its bubble
+      reuse_bubble_layers(image, layer_group, None, [], removed)
+
+    if text_layers and not skip and not fresh:
+      # bubbles of the whole group get drawn at once. Groups don't get
+      # merged, merge_source only works with separate_layers
+      bubble = new_plan_bubble(image, tree, settings, colors, fingerprint)
+      bubble['arguments']['merge_source'] = False
+      for node in text_layers:
+        plan_layer_bubble(bubble, node, isRound, minStepSize, xpad, ypad, options)
+      plan['bubbles'].append(bubble)
+
+    plan['remove'].extend(get_plan_tattoo(layer) for layer in removed.values())
 
     # now it's recursion o'clock:
     # (and yes, we do recursion)
-    for layer in group_layers:
-      if layer.visible:
-        # print("started processing group " + layer.name)
-        autobubble_group(image, layer, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults)
-        # print("group" + layer.name + "finished processing")
+    for node in group_layers:
+      plan_group(plan, image, node, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options, colors)
 
   else:
     # making bubbles on one layer group total has lots of things in common
     # with creating bubbles on separate layers for every speech bubble
-    for layerId in sublayers:
-      layer = gimp.Item.from_id(layerId)
-      
+    for node in tree.children:
+      if node.ID in removed:
+        continue
+
+      # bubbles from previous runs aren't text. They go if their layer is
+      # gone, hidden or not
+      if node.bubble:
+        mark_orphaned_bubble_layer(image, node.item, removed)
+        continue
+
       # we ignore hidden layers
-      if not layer.visible:
+      if not node.visible:
         continue
-      
-      # we hide layer gropups and put them on a "handle me later pls" list
-      if type(layer) is gimp.GroupLayer:
-        # group_layers.append(layer)
-        autobubble_group(image, layer, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults)
+
+      if node.kind == 'group':
+        plan_group(plan, image, node, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options, colors)
         continue
       elif not skip: 
-        # process all non-group layers
-        mkbubble(image, layer, isRound, minStepSize, xpad, ypad)
-
-        # if we separate layers, we do that here. Otherwise, we do that after
-        # calling this function.
-        if separate_layers:
-          bubble_layer = add_layer_below(image, layer, preserveCmd, argPass)
-          paint_selection_fg(bubble_layer)
-
-          # if bubbles have an outline
-          if outline:
-            bubble_outline_layer = add_layer_below(image, bubble_layer, preserveCmd, argPass, '-outline')
-            mkoutline(image, outline_thickness, outline_feather)
-            paint_selection_bg(bubble_outline_layer)
-
-            if merge_outline:
-              name = group_bubble_layer.name
-              mergedLayer = pdb.gimp_image_merge_down(image, group_bubble_layer, EXPAND_AS_NECESSARY)
-              mergedLayer.name = name
-          
-          # merge source is a valid strat here
-          if merge_source:
-            name = layer.name         # save name of original layer
-            merged_layer = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
-            merged_layer.name = name  # restore name of original layer
+        # merged source layer is gone after we're done, so there's nothing
+        # to compare against next time
+        incremental = separate_layers and options['incremental'] and not merge_source
+        fingerprint = None
+
+        if incremental:
+          fingerprint = get_bubble_fingerprint([node.item], bubbleArgs + [node.name])
+          if reuse_bubble_layers(image, node.item, fingerprint, outlineRoles, removed):
+            continue
 
-          clear_selection(image)
+        # if we separate layers, every layer gets a bubble of its own.
+        # Otherwise, all of them go into the bubble plan_autobubble draws
+        # below the layer it was ran on (if it wants one, see
+        # plan_loose_bubble)
+        if not separate_layers:
+          if plan.get('loose') is not None:
+            plan['loose_layers'].append([node, isRound, minStepSize, xpad, ypad, options, bubbleArgs + [node.name]])
+        else:
+          bubble = new_plan_bubble(image, node, settings, colors, fingerprint)
+          plan_layer_bubble(bubble, node, isRound, minStepSize, xpad, ypad, options)
+          plan['bubbles'].append(bubble)
 
-  if fgcolor:
-    restore_fg_stack()
+    plan['remove'].extend(get_plan_tattoo(layer) for layer in removed.values())
 
-  if bgcolor:
-    restore_bg_stack()  
+# plans a whole run, see python_autobubble for parameters. Doesn't change the
+# image, so it's safe to call from the console to see what would happen
+def plan_autobubble(image, layer, auto = True, isRound = True, minStepSize = 25, xpad = 7, ypad = 3, separate_groups = True, separate_layers = False, merge_source = False, outline = False, outline_thickness = 3, outline_feather = 0, merge_outline = False, inherit_auto_config = False, use_defaults = False, options = None):
+  reset_content_keys()
+  reset_layer_index()
+  reset_layer_nodes()
+  reset_plan_layers()
 
+  settings = get_group_settings(auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options)
+  plan = new_plan()
+  tree = snapshot_layer_tree(image, layer)
 
-# main function
-def python_autobubble(image, layer, auto = True, isRound = True, minStepSize = 25, xpad = 7, ypad = 3, separate_groups = True, separate_layers = False, merge_source = False, outline = False, outline_thickness = 3, outline_feather = 0, merge_outline = False, inherit_auto_config = False, use_defaults = False):
-  # save background
-  bg_save = gimp.get_background()
-  fg_save = gimp.get_foreground()
+  # remember the 'we do that after calling the function' bit from earlier?
+  # if neither separate_groups or separate_layers is set, everything goes
+  # into one bubble below the layer we were ran on
+  if not (separate_groups or separate_layers):
+    plan['loose'] = new_plan_bubble(image, tree, settings, ['', ''], None)
+    plan['loose_layers'] = []
+
+  try:
+    # treat group layers differently
+    if tree.kind == 'group':
+      targets = []
+      collect_bubble_layers(tree, settings, targets)
+      prefetch_bubble_geometry(targets)
+
+      plan_group(plan, image, tree, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options)
+      if plan.get('loose') is not None:
+        plan_loose_bubble(plan, image, tree, settings)
+    elif plan.get('loose') is not None:
+      plan['loose_layers'].append([tree, isRound, minStepSize, xpad, ypad, settings['options'], get_bubble_args(settings, ['', '']) + [tree.name]])
+      plan_loose_bubble(plan, image, tree, settings)
+  finally:
+    __prefetched_geometry.clear()
+
+  return plan
+
+# plans the bubble that every layer goes into when neither separate_groups
+# nor separate_layers is set. plan_group only collects
+# [node, isRound, minStepSize, xpad, ypad, options, bubbleArgs] of layers
+# that go into it, so that we can tell whether the bubble from last time is
+# still good before we work out any geometry. Same as a group's bubble, its
+# fingerprint covers all layers in it and arguments of each
+def plan_loose_bubble(plan, image, tree, settings):
+  bubble = plan.pop('loose')
+  layers = plan.pop('loose_layers')
+  removed = collections.OrderedDict()
+
+  # merged source is gone after we're done, nothing to compare against
+  if settings['options']['incremental'] and not settings['merge_source']:
+    if not layers:
+      # no text left, so neither should be its bubble
+      reuse_bubble_layers(image, tree.item, None, [], removed)
+    else:
+      bubbleArgs = get_bubble_args(settings, ['', ''])
+      bubble['fingerprint'] = get_bubble_fingerprint([layer[0].item for layer in layers], bubbleArgs + [tree.name] + [layer[6] for layer in layers])
+      if reuse_bubble_layers(image, tree.item, bubble['fingerprint'], get_bubble_roles(settings), removed):
+        layers = []
+
+  plan['remove'].extend(get_plan_tattoo(layer) for layer in removed.values())
+
+  if layers:
+    for [node, isRound, minStepSize, xpad, ypad, options, bubbleArgs] in layers:
+      plan_layer_bubble(bubble, node, isRound, minStepSize, xpad, ypad, options)
+    plan['bubbles'].append(bubble)
+
+# does what the plan says
+# stale layers go last, so that if drawing fails, rollback leaves the page
+# with the bubbles it had before
+def apply_plan(image, plan):
+  if plan.get('version') != plan_version:
+    raise ValueError('plan version {} is not {}, make the plan again'.format(plan.get('version'), plan_version))
+
+  for bubble in plan['bubbles']:
+    apply_bubble(image, bubble)
+
+  for tattoo in plan['remove']:
+    layer = get_plan_layer(image, tattoo)
+    if layer:
+      remove_layer(image, layer)
+      count_stat('bubbles_removed')
+
+def apply_bubble(image, bubble):
+  arguments = bubble['arguments']
+  source = get_plan_layer(image, bubble['source'])
+
+  # plans can be applied long after they were made
+  if source is None:
+    print("[autobubble] layer '{}' is gone, skipping its bubble".format(bubble['source_name']))
+    count_stat('bubbles_missing_source')
+    return
+
+  if arguments['color']:
+    set_fg_stack(arguments['color'])
+  if arguments['outline_color']:
+    set_bg_stack(arguments['outline_color'])
+
+  outline = arguments['outline'] and [arguments['outline_thickness'], arguments['outline_feather']]
+  [bubble_layer, outline_layer] = draw_bubble(image, source, bubble['shapes'], arguments['options'], outline, arguments['merge_outline'], arguments['preserveCmd'], arguments['argPass'])
+
+  if bubble['fingerprint']:
+    if outline_layer:
+      tag_bubble_layer(outline_layer, source, 'outline', bubble['fingerprint'])
+    tag_bubble_layer(bubble_layer, source, 'bubble', bubble['fingerprint'])
+
+  # merge source is a valid strat here
+  if arguments['merge_source']:
+    merge_layer_down(image, source)  # merged layer keeps name of original layer
 
   clear_selection(image)
 
-  isGroupLayer = type(layer) is gimp.GroupLayer
-  # treat group layers differently
-  if isGroupLayer:
-    autobubble_group(image, layer, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults)
+  if arguments['color']:
+    restore_fg_stack()
+  if arguments['outline_color']:
+    restore_bg_stack()
+
+# plans and applies bubbles for a layer group. python_autobubble does the
+# same, plus undo, profiling and geometry cache
+def autobubble_group(image, layer_group, auto = True, isRound = True, minStepSize = 25, xpad = 7, ypad = 3, separate_groups = True, separate_layers = False, merge_source = False, outline = False, outline_thickness = 3, outline_feather = 0, merge_outline = False, inherit_auto_config = False, use_defaults = False, options = None):
+  apply_plan(image, plan_autobubble(image, layer_group, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options))
+
+#
+#
+#  T R A N S A C T I O N S
+#
+# Every layer we add, every fill and every merge is an undo step, and on
+# full-canvas layers undo steps cost a lot of memory. So python_autobubble
+# runs inside a transaction:
+#
+#     'group'   whole run is a single undo step (default)
+#     'freeze'  undo is frozen while we run. Saves the most memory, but the
+#               run can't be undone. Batch mode uses this
+#     'steps'   every change is its own undo step, like it used to be
+#
+# Displays get flushed once, at the end. If something blows up halfway
+# through, the transaction is rolled back: layers we made are removed and
+# selection, colors and color stacks are put back the way they were. Stale
+# bubbles are only removed once every new bubble is drawn, so they're still
+# there. Source layers merged with 'merge_source' can't be brought back, but
+# the next run makes the bubbles again.
+__transaction = None
+
+def begin_transaction(image, options):
+  global __transaction
+
+  mode = (options or {}).get('undo', 'group')
+  if not pdb.gimp_image_undo_is_enabled(image):
+    mode = 'steps'
+
+  transaction = {
+    'image': image,
+    'mode': mode,
+    'background': gimp.get_background(),
+    'foreground': gimp.get_foreground(),
+    'colorDepth': get_color_stack_depth(),
+    'selection': None,
+    'created': [],
+    'parent': __transaction,
+  }
+
+  if mode == 'group':
+    pdb.gimp_image_undo_group_start(image)
+  elif mode == 'freeze':
+    pdb.gimp_image_undo_freeze(image)
+
+  # inside of the undo group, so that saving (and removing) the channel
+  # doesn't make undo steps of its own
+  if not pdb.gimp_selection_is_empty(image):
+    transaction['selection'] = pdb.gimp_selection_save(image)
+
+  __transaction = transaction
+  return transaction
+
+def track_created_layer(layer):
+  if __transaction:
+    __transaction['created'].append(layer)
+
+def rollback_transaction(transaction):
+  image = transaction['image']
+
+  for layer in reversed(transaction['created']):
+    # merged layers are gone already
+    if pdb.gimp_item_is_valid(layer):
+      remove_layer(image, layer)
+
+  if transaction['selection']:
+    pdb.gimp_image_select_item(image, CHANNEL_OP_REPLACE, transaction['selection'])
   else:
-    mkbubble(image, layer, isRound, minStepSize, xpad, ypad)
+    clear_selection(image)
 
-  # remember the 'we do that after calling the function' bit from earlier?
-  # this is where it gets done
-  if not (separate_groups or separate_layers):
-    bubble_layer = add_layer_below(image, layer)
-    paint_selection_fg(bubble_layer)
-
-    # if bubbles have an outline
-    if outline:
-      bubble_outline_layer = add_layer_below(image, layer)
-      mkoutline(image, outline_thickness, outline_feather)
-      paint_selection_bg(bubble_outline_layer)
-
-      if merge_outline:
-        name = bubble_layer.name
-        mergedLayer = pdb.gimp_image_merge_down(image, bubble_layer, EXPAND_AS_NECESSARY)
-        mergedLayer.name = name
-    
-    # merge source is a valid strat here
-    if merge_source:
-      name = layer.name         # save name of original layer
-      merged_layer = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
-      merged_layer.name = name  # restore name of original layer
-
-  # clear selection because we're nice
-  clear_selection(image)
+  truncate_color_stacks(transaction['colorDepth'])
+
+def end_transaction(transaction):
+  global __transaction
+  image = transaction['image']
+
+  if transaction['selection']:
+    pdb.gimp_image_remove_channel(image, transaction['selection'])
+
+  gimp.set_background(transaction['background'])
+  gimp.set_foreground(transaction['foreground'])
+
+  if transaction['mode'] == 'group':
+    pdb.gimp_image_undo_group_end(image)
+  elif transaction['mode'] == 'freeze':
+    pdb.gimp_image_undo_thaw(image)
+
+  # layers made inside a nested transaction belong to the outer one as well
+  __transaction = transaction['parent']
+  if __transaction:
+    __transaction['created'].extend(transaction['created'])
+
+  gimp.displays_flush()
 
-  # at last, restore background
-  gimp.set_background(bg_save)
-  gimp.set_foreground(fg_save)
+#
+#
+#  P R O F I L I N G
+#
+# Off by default. When it's on, python_autobubble swaps functions below (and
+# pdb) for wrappers that time them, runs as usual, and puts the originals back
+# when it's done. Nothing else needs to check whether profiling is on, so it
+# costs nothing when it's off.
+#
+# Turn it on with options={'profile': True} (or path to the report instead of
+# True), or by setting AUTOBUBBLE_PROFILE environment variable to 1 or a path.
+# Report is JSON, autobubble-profile.json in the gimp profile directory unless
+# told otherwise, and a one-line summary gets printed.
+profile_file = 'autobubble-profile.json'
+
+# [function, stage, which argument is the layer the time goes to]. Spans
+# without a layer count towards whichever layer their parent span worked on
+# last. Geometry computed by worker processes shows up as 'geometry pool'
+profiled_functions = [
+  ['snapshot_layer_tree', 'tree walk', 1],
+  ['collect_bubble_layers', 'tree walk', 0],
+  ['plan_group', 'group', 2],
+  ['prefetch_bubble_geometry', 'geometry pool', None],
+  ['plan_layer_bubble', 'bubble', 1],
+  ['apply_bubble', 'draw', None],
+  ['compute_layer_content_key', 'content key', 0],
+  ['getLayerAlpha', 'pixel read', 0],
+  ['getTextRows', 'row detection', 0],
+  ['splitTextRegions', 'split', None],
+  ['correctRows', 'jag correction', None],
+  ['getEllipseDimensions', 'ellipse fit', None],
+  ['selectShapes', 'selection', None],
+  ['rasterizeShapes', 'raster', None],
+  ['write_coverage', 'fill', None],
+  ['add_layer_below', 'new layer', 1],
+  ['paint_selection_fg', 'fill', None],
+  ['paint_selection_bg', 'fill', None],
+  ['mkoutline', 'outline', None],
+  ['rasterizeOutline', 'outline', None],
+]
+
+# pdb procedures that get a span of their own, on top of being counted
+profiled_procedures = {
+  'gimp_image_merge_down': 'merge',
+}
+
+# how many pixels a profiled function read, given its arguments and result
+profiled_pixel_counts = {
+  'getLayerAlpha': lambda args, result: result.size,
+  'compute_layer_content_key': lambda args, result: args[0].width * args[0].height if result.startswith("['pixels'") else 0,
+  'determineTextRows': lambda args, result: args[0].width * args[0].height if np is None else 0,
+}
+
+__profiler = None
+
+def get_profile_path(options):
+  profile = (options or {}).get('profile') or os.environ.get('AUTOBUBBLE_PROFILE')
+  if not profile:
+    return None
+  if profile is True or profile == '1':
+    return os.path.join(gimp.directory, profile_file)
+  return profile
+
+def get_profile_target(layer):
+  return '{} #{}'.format(layer.name, layer.ID)
+
+class Profiler(object):
+  def __init__(self, path):
+    self.path = path
+    self.start = time.time()
+    self.stack = []      # open spans: [stage, target, start, child seconds, last child target]
+    self.spans = []      # [stage, target, start, seconds, self seconds, depth]
+    self.counters = {}
+
+  def begin(self, stage, layer = None):
+    if layer is not None:
+      target = get_profile_target(layer)
+      if self.stack:
+        self.stack[-1][4] = target
+    elif self.stack:
+      target = self.stack[-1][4] or self.stack[-1][1]
+    else:
+      target = None
+
+    span = [stage, target, time.time(), 0.0, None]
+    self.stack.append(span)
+    return span
+
+  def end(self, span):
+    seconds = time.time() - span[2]
+    self.stack.pop()
+    if self.stack:
+      self.stack[-1][3] += seconds
+    self.spans.append([span[0], span[1], span[2] - self.start, seconds, seconds - span[3], len(self.stack)])
+
+  def count(self, name, value = 1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def get_report(self):
+    stages = {}
+    layers = {}
+    for [stage, target, start, seconds, selfSeconds, depth] in self.spans:
+      totals = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0})
+      totals['calls'] += 1
+      totals['self_seconds'] += selfSeconds
+      # recursive spans would count their children twice
+      if depth == 0 or stage != 'group':
+        totals['seconds'] += seconds
+
+      if target is not None:
+        layer = layers.setdefault(target, {})
+        layer[stage] = layer.get(stage, 0.0) + selfSeconds
+
+    return {
+      'seconds': time.time() - self.start,
+      'stages': stages,
+      'layers': layers,
+      'counters': self.counters,
+      'spans': [{'stage': s[0], 'target': s[1], 'start': s[2], 'seconds': s[3], 'self_seconds': s[4], 'depth': s[5]} for s in self.spans],
+    }
+
+  def get_summary(self, report):
+    stages = sorted(report['stages'].items(), key = lambda item: -item[1]['self_seconds'])
+    parts = ['{} {:.2f}s'.format(stage, totals['self_seconds']) for [stage, totals] in stages[:5]]
+    counters = report['counters']
+    return "[autobubble] profile: {:.2f}s total, {} | {} pdb calls, {} pixels scanned, {} combinations evaluated -> {}".format(
+      report['seconds'], ', '.join(parts), counters.get('pdb_calls', 0), counters.get('pixels_scanned', 0), counters.get('combinations_evaluated', 0), self.path
+    )
+
+# wraps a function so that its calls get timed (unless stage is None) and
+# their pixels counted (if there's countPixels). Time spent on bubble layers
+# goes to the layer the bubble is for
+def profile_function(profiler, function, stage, layerArg, countPixels):
+  def profiled(*args, **kwargs):
+    if stage is None:
+      result = function(*args, **kwargs)
+    else:
+      layer = args[layerArg] if layerArg is not None and len(args) > layerArg else None
+      if isinstance(layer, LayerNode):
+        layer = layer.item
+      if layer is not None and is_bubble_layer(layer):
+        layer = None
+      span = profiler.begin(stage, layer)
+      try:
+        result = function(*args, **kwargs)
+      finally:
+        profiler.end(span)
+    if countPixels:
+      profiler.count('pixels_scanned', countPixels(args, result))
+    return result
+  return profiled
+
+# counts every pdb call. Procedures in profiled_procedures also get timed
+class ProfiledPdb(object):
+  def __init__(self, pdb, profiler):
+    self.__pdb = pdb
+    self.__profiler = profiler
+
+  def __getattr__(self, name):
+    procedure = getattr(self.__pdb, name)
+    profiler = self.__profiler
+    stage = profiled_procedures.get(name)
+
+    def call(*args):
+      profiler.count('pdb_calls')
+      profiler.count('pdb_calls:' + name)
+      if not stage:
+        return procedure(*args)
+      span = profiler.begin(stage)
+      try:
+        return procedure(*args)
+      finally:
+        profiler.end(span)
+    return call
+
+# returns the profiler if this call turned profiling on, None if profiling is
+# off or somebody up the stack already turned it on
+def start_profiling(path):
+  global __profiler
+  if not path or __profiler:
+    return None
+
+  profiler = Profiler(path)
+  profiler.originals = []
+
+  # functions live in this file and autobubble_geometry, and some of them in
+  # both (because of 'import *'). Everything that calls them needs to see the
+  # wrapper, so we swap them wherever they are
+  namespaces = [globals(), sys.modules['autobubble_geometry'].__dict__]
+  wrapped = profiled_functions + [[name, None, None] for name in profiled_pixel_counts if name not in [f[0] for f in profiled_functions]]
+
+  for [name, stage, layerArg] in wrapped:
+    for namespace in namespaces:
+      if name in namespace:
+        original = namespace[name]
+        namespace[name] = profile_function(profiler, original, stage, layerArg, profiled_pixel_counts.get(name))
+        profiler.originals.append([namespace, name, original])
+
+  profiler.originals.append([globals(), 'pdb', pdb])
+  globals()['pdb'] = ProfiledPdb(pdb, profiler)
+
+  __profiler = profiler
+  return profiler
+
+# puts original functions back, writes the report and prints the summary
+def stop_profiling(profiler):
+  global __profiler
+  if not profiler:
+    return
+
+  for [namespace, name, original] in reversed(profiler.originals):
+    namespace[name] = original
+  __profiler = None
+
+  report = profiler.get_report()
+  try:
+    with open(profiler.path, 'w') as f:
+      json.dump(report, f, indent=1, sort_keys=True)
+  except (IOError, OSError) as e:
+    print("[autobubble] couldn't save profile: {}".format(e))
+
+  print(profiler.get_summary(report))
+
+# adds geometry stats of a run to the profile, if there is one
+def add_profile_counts(stats):
+  if __profiler:
+    for name, value in stats.items():
+      __profiler.count(name, value)
+
+# main function
+def python_autobubble(image, layer, auto = True, isRound = True, minStepSize = 25, xpad = 7, ypad = 3, separate_groups = True, separate_layers = False, merge_source = False, outline = False, outline_thickness = 3, outline_feather = 0, merge_outline = False, inherit_auto_config = False, use_defaults = False, options = None):
+  profiler = None
+  transaction = None
+  try:
+    # in here, so that profiling wrappers come off even if we can't start
+    profiler = start_profiling(get_profile_path(options))
+    transaction = begin_transaction(image, options)
+
+    clear_selection(image)
+    reset_geometry_stats()
+
+    plan = plan_autobubble(image, layer, auto, isRound, minStepSize, xpad, ypad, separate_groups, separate_layers, merge_source, outline, outline_thickness, outline_feather, merge_outline, inherit_auto_config, use_defaults, options)
+    apply_plan(image, plan)
+
+    # clear selection because we're nice
+    clear_selection(image)
+
+    save_geometry_cache()
+  except:
+    if transaction:
+      rollback_transaction(transaction)
+    raise
+  finally:
+    # at last, restore background (and undo)
+    if transaction:
+      end_transaction(transaction)
+    add_profile_counts(geometry_stats)
+    stop_profiling(profiler)
+
+#
+#
+#  B A T C H   M O D E
+#
+# for running under 'gimp -i' without any user interface. autobubble_batch.py
+# starts gimp processes that call this, see README for details.
+#
+# prints one line per file to stdout, so whoever started us can tell how it went:
+#     autobubble-done<TAB><path><TAB><seconds>
+#     autobubble-error<TAB><path><TAB><seconds><TAB><message>
+#
+# workers is the 'workers' option (see default_options). autobubble_batch.py
+# already runs a gimp process per core, so by default each of them computes
+# geometry by itself instead of starting a pool of its own
+def python_autobubble_batch(paths, output_dir = None, workers = 1):
+  for path in paths:
+    start = time.time()
+    image = None
+
+    try:
+      image = pdb.gimp_xcf_load(0, path, path)
+
+      if output_dir:
+        out_path = os.path.join(output_dir, os.path.basename(path))
+      else:
+        out_path = path
+
+      # with profiling on, every file gets its own report next to it
+      profiler = start_profiling(out_path + '.profile.json' if get_profile_path(None) else None)
+      try:
+        # every top-level group gets the same treatment as if it was selected
+        # in gimp and the script was ran from the console
+        for layer in image.layers:
+          if type(layer) is gimp.GroupLayer:
+            python_autobubble(image, layer, options={'undo': 'freeze', 'workers': workers})
+      finally:
+        stop_profiling(profiler)
+
+      pdb.gimp_xcf_save(0, image, pdb.gimp_image_get_active_drawable(image), out_path, out_path)
+      print("autobubble-done\t{}\t{:.3f}".format(path, time.time() - start))
+
+    except Exception as e:
+      print("autobubble-error\t{}\t{:.3f}\t{}".format(path, time.time() - start, repr(e)))
+
+    finally:
+      if image:
+        pdb.gimp_image_delete(image)
 
 def python_test(image, isRound, minStepSize, xpad, ypad, isOutline):
   python_autobubble(image, image.active_layer, isRound, minStepSize, xpad, ypad, True, False, False, isOutline, 3, 0, True)
@@ -951,21 +2083,91 @@ def python_test_auto():
   python_autobubble(img, img.active_layer, True)
 
 
-# register plugin.
-# register(
-#   "python_fu_autobubble",                                   # name
-#   "Automatically draw speech bubbles around text layers.",  # plugin tl;dr
-#   "Automatically draw speech bubbles around text layers.",  # "help"
-#   "Tamius Han",                                             # Author
-#   "Tamius Han",                                             # Copyright
-#   "2018-2019",                                              # Date
-#   "<Image>/Filters/Render/_Auto-bubble",                    # Menu path
-#   "*",                                                      # Image type
-#   [                                                         # params
-
-#   ],
-#   [],                                                       # results
-#   python_autobubble                                         # script function
-# )
-
-# main()
+#
+#
+#  P L U G - I N
+#
+# When GIMP starts autobubble.py from its plug-ins directory, we register an
+# extension that GIMP starts once and that stays running until GIMP quits.
+# Menu action and batch procedure are temporary procedures of that process,
+# so only the first run pays for python startup and imports. Everything we
+# keep at module level stays warm between runs: geometry cache, line
+# pitches and parsed command blocks.
+
+plugin_extension = 'extension_autobubble'
+plugin_menu_procedure = 'python_fu_autobubble'
+plugin_batch_procedure = 'python_fu_autobubble_batch'
+
+class AutobubblePlugin(gimpplugin.plugin):
+  def query(self):
+    # GIMP starts extensions without any parameters on its own
+    gimp.install_procedure(
+      plugin_extension,
+      "Keeps auto-bubble running between runs.",
+      "Registers auto-bubble menu action and batch procedure and serves them until GIMP quits.",
+      "Tamius Han",
+      "Tamius Han",
+      "2018-2019",
+      None,
+      "",
+      EXTENSION,
+      [],
+      []
+    )
+
+  def extension_autobubble(self):
+    gimp.install_temp_proc(
+      plugin_menu_procedure,
+      "Automatically draw speech bubbles around text layers.",
+      "Automatically draw speech bubbles around text layers.",
+      "Tamius Han",
+      "Tamius Han",
+      "2018-2019",
+      "<Image>/Filters/Render/_Auto-bubble",
+      "*",
+      TEMPORARY,
+      [
+        (PDB_INT32, "run-mode", "Run mode"),
+        (PDB_IMAGE, "image", "Input image"),
+        (PDB_DRAWABLE, "drawable", "Layer or layer group to draw bubbles for"),
+      ],
+      []
+    )
+    gimp.install_temp_proc(
+      plugin_batch_procedure,
+      "Draw speech bubbles in XCF files.",
+      "Same as autobubble_batch.py, for one GIMP process. Paths are separated with the OS path separator (':' or ';').",
+      "Tamius Han",
+      "Tamius Han",
+      "2018-2019",
+      None,
+      "",
+      TEMPORARY,
+      [
+        (PDB_INT32, "run-mode", "Run mode"),
+        (PDB_STRING, "paths", "XCF files"),
+        (PDB_STRING, "output-dir", "Save results here instead of overwriting input files (empty: overwrite)"),
+      ],
+      []
+    )
+
+    gimp.extension_ack()
+    while True:
+      gimp.extension_process(0)
+
+  def python_fu_autobubble(self, run_mode, image, drawable):
+    python_autobubble(image, drawable)
+    gimp.displays_flush()
+
+  def python_fu_autobubble_batch(self, run_mode, paths, output_dir):
+    # only one gimp process here, so geometry gets a worker per core
+    python_autobubble_batch([p for p in paths.split(os.pathsep) if p], output_dir or None, 0)
+
+# GIMP starts plug-ins as '<plug-in> -gimp <pipes> ...'. Python-Fu console is
+# a plug-in as well, so we also check that it's us GIMP started, not the
+# console that execfile'd us
+def started_by_gimp():
+  return '-gimp' in sys.argv and os.path.splitext(os.path.basename(sys.argv[0]))[0] == 'autobubble'
+
+if __name__ == '__main__' and started_by_gimp():
+  AutobubblePlugin().start()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Runs autobubble on a bunch of XCF files without opening GIMP's user interface.
+# Files are split between several 'gimp -i' processes, so every core gets
+# something to do.
+#
+# This script doesn't need gimp itself, so run it with any python:
+#
+#     python autobubble_batch.py chapter-01/ chapter-02/*.xcf -j 8
+#
+# Every top-level layer group in every file gets bubbled, same as if you'd
+# selected it and ran the script. Files are saved in place unless you give
+# --output-dir.
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import time
+import argparse
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# expands directories and globs into a sorted list of xcf files
+def find_files(inputs):
+  files = []
+  for item in inputs:
+    if os.path.isdir(item):
+      files.extend(glob.glob(os.path.join(item, '*.xcf')))
+    elif os.path.isfile(item):
+      files.append(item)
+    else:
+      files.extend(glob.glob(item))
+
+  # same file can come in through more than one input
+  return sorted(set(os.path.abspath(f) for f in files))
+
+def build_command(gimp, files, output_dir, workers):
+  code = "import sys; sys.path.insert(0, {!r}); import autobubble; autobubble.python_autobubble_batch({!r}, {!r}, {!r})".format(script_dir, files, output_dir, workers)
+  # fonts have to load (no '-f'), 'metrics' measures text with them
+  return [gimp, '-i', '-d', '--batch-interpreter', 'python-fu-eval', '-b', code, '-b', 'pdb.gimp_quit(1)']
+
+# runs one gimp process over a list of files. Returns [path, seconds, error]
+# for every file. Files that gimp never got around to are reported as errors
+def run_worker(gimp, files, output_dir, workers):
+  results = {}
+  output = ''
+
+  try:
+    process = subprocess.Popen(build_command(gimp, files, output_dir, workers), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode('utf-8', 'replace')
+  except OSError as e:
+    output = 'could not start {}: {}'.format(gimp, e)
+
+  for line in output.splitlines():
+    parts = line.split('\t')
+    if parts[0] == 'autobubble-done' and len(parts) >= 3:
+      results[parts[1]] = [parts[1], float(parts[2]), None]
+    elif parts[0] == 'autobubble-error' and len(parts) >= 4:
+      results[parts[1]] = [parts[1], float(parts[2]), parts[3]]
+
+  lastLine = output.strip().splitlines()[-1] if output.strip() else 'no output'
+  return [results.get(f, [f, 0.0, 'gimp exited early: ' + lastLine]) for f in files]
+
+def print_summary(results, wall_time):
+  width = max(len(os.path.basename(r[0])) for r in results)
+  failed = 0
+
+  for [path, seconds, error] in results:
+    status = 'ok' if error is None else 'FAILED: ' + error
+    if error is not None:
+      failed += 1
+    print('{}  {:8.2f}s  {}'.format(os.path.basename(path).ljust(width), seconds, status))
+
+  total = sum(r[1] for r in results)
+  print('')
+  print('{} files, {} failed. {:.2f}s of work in {:.2f}s wall time.'.format(len(results), failed, total, wall_time))
+  return failed
+
+def main():
+  parser = argparse.ArgumentParser(description='Run autobubble on XCF files with several headless GIMP processes.')
+  parser.add_argument('inputs', nargs='+', help='xcf files, directories or globs')
+  parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help='number of gimp processes (default: number of cores)')
+  parser.add_argument('--files-per-process', type=int, default=1, help='files each gimp process handles before exiting. Higher values pay gimp startup less often, but balance work worse (default: 1)')
+  parser.add_argument('--gimp', default=os.environ.get('GIMP', 'gimp'), help='gimp executable (default: $GIMP or gimp)')
+  parser.add_argument('--geometry-workers', type=int, default=1, help='processes every gimp process uses to compute bubble geometry. 0 means one per core, which only makes sense with few gimp processes (default: 1)')
+  parser.add_argument('--output-dir', default=None, help='save results here instead of overwriting input files')
+  parser.add_argument('--profile', action='store_true', help='write a timing report for every file, next to the saved file (<name>.xcf.profile.json)')
+  args = parser.parse_args()
+
+  # gimp processes inherit our environment
+  if args.profile:
+    os.environ['AUTOBUBBLE_PROFILE'] = '1'
+
+  files = find_files(args.inputs)
+  if not files:
+    print('no xcf files found')
+    return 1
+
+  if args.output_dir:
+    args.output_dir = os.path.abspath(args.output_dir)
+    if not os.path.isdir(args.output_dir):
+      os.makedirs(args.output_dir)
+
+  chunk = max(args.files_per_process, 1)
+  chunks = [files[i:i + chunk] for i in range(0, len(files), chunk)]
+
+  # threads only wait for gimp processes, so the GIL doesn't get in the way
+  start = time.time()
+  pool = ThreadPool(max(min(args.jobs, len(chunks)), 1))
+  results = pool.map(lambda c: run_worker(args.gimp, c, args.output_dir, args.geometry_workers), chunks)
+  pool.close()
+
+  results = [r for worker in results for r in worker]
+  failed = print_summary(results, time.time() - start)
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
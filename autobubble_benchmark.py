@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+# Benchmarks for the geometry code in autobubble_geometry.py. Doesn't need
+# gimp: inputs are synthetic alpha arrays and text rows, generated here.
+#
+#     python autobubble_benchmark.py                   # run, compare to baseline
+#     python autobubble_benchmark.py --save-baseline   # run, make this the baseline
+#     python autobubble_benchmark.py --quick --stages mvee,bruteforce
+#
+# Every fixture is some number of text rows (1 to 40) in some shape (centered,
+# ragged-left, diamond) on a square layer (200 to 4000 px). For every stage we
+# report the best time out of --repeat runs, peak memory of a separate run
+# (python 3 only, tracemalloc doesn't exist in python 2) and what the stage
+# counted in geometry_stats: points, hull points, combinations, tiles.
+#
+# If there's a baseline, any stage that got slower (or hungrier) by more than
+# --threshold fails the run. Baselines depend on the machine, so make your own
+# before changing anything.
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import argparse
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+
+import autobubble_geometry as geometry
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+np = geometry.np
+
+shapes = ['centered', 'ragged-left', 'diamond']
+row_counts = [1, 2, 3, 5, 8, 12, 20, 40]
+layer_sizes = [200, 500, 1000, 2000, 4000]
+
+quick_row_counts = [1, 5, 12, 40]
+quick_layer_sizes = [200, 1000, 4000]
+
+# the brute force search tries every 4 points of the hull, so it gets its own
+# limit. Without numpy, anything past a dozen rows takes ages
+bruteforce_max_rows = 40 if np is not None else 12
+
+# how many combinations the single-combination stage times
+single_combinations = 100
+
+default_baseline = os.path.join(script_dir, 'benchmark-baseline.json')
+
+# timings below this are mostly noise, so they never count as regressions
+min_time = 0.002
+min_memory = 64 * 1024
+
+#
+#
+#  F I X T U R E S
+#
+
+# widths of text rows, relative to the width of the layer
+def get_row_widths(shape, rowCount, rng):
+  widths = []
+  for i in range(0, rowCount):
+    if shape == 'diamond':
+      # widest row in the middle
+      middle = (rowCount - 1) / 2.0
+      widths.append(1.0 - 0.7 * abs(i - middle) / max(middle, 1))
+    else:
+      widths.append(rng.uniform(0.45, 1.0))
+  return widths
+
+# text rows as [top, bottom, left, right], same as findTextRows returns
+# (bottom is the last row of pixels, right is one past the last column)
+def make_rows(shape, rowCount, size, seed = 1):
+  rng = random.Random(seed * 1000 + rowCount)
+  margin = size // 20
+  pitch = (size - 2 * margin) // rowCount
+  height = max(pitch * 2 // 3, 1)
+  usable = size - 2 * margin
+
+  rows = []
+  for i, width in enumerate(get_row_widths(shape, rowCount, rng)):
+    pixels = max(int(usable * width), 2)
+    if shape == 'ragged-left':
+      left = margin
+    else:
+      left = margin + (usable - pixels) // 2
+    top = margin + i * pitch
+    rows.append([top, top + height - 1, left, left + pixels])
+  return rows
+
+# alpha channel with the rows filled with 'letters': vertical strokes with
+# gaps between them, so rows have holes in them like real text does
+def make_alpha(rows, size):
+  alpha = np.zeros((size, size), dtype=np.uint8)
+  for [top, bottom, left, right] in rows:
+    stroke = max((bottom - top + 1) // 6, 1)
+    alpha[top:bottom + 1, left:right] = 255
+    for x in range(left + stroke, right, stroke * 3):
+      alpha[top:bottom + 1, x:x + stroke] = 0
+    # rows must start and end where we said they do
+    alpha[top:bottom + 1, left:left + stroke] = 255
+    alpha[top:bottom + 1, right - stroke:right] = 255
+  return alpha
+
+# same as make_alpha, as a list of bytes, one per row of pixels. Doesn't need
+# numpy, so the plain python row scan can be measured without it
+def make_alpha_lines(rows, size):
+  empty = bytes(bytearray(size))
+  lines = [empty] * size
+  for [top, bottom, left, right] in rows:
+    line = bytearray(size)
+    stroke = max((bottom - top + 1) // 6, 1)
+    line[left:right] = b'\xff' * (right - left)
+    for x in range(left + stroke, right, stroke * 3):
+      end = min(x + stroke, size)
+      line[x:end] = bytearray(end - x)
+    line[left:left + stroke] = b'\xff' * len(line[left:left + stroke])
+    line[right - stroke:right] = b'\xff' * stroke
+    lines[top:bottom + 1] = [bytes(line)] * (bottom - top + 1)
+  return lines
+
+def get_fixtures(quick):
+  fixtures = []
+  for shape in shapes:
+    for rowCount in (quick_row_counts if quick else row_counts):
+      for size in (quick_layer_sizes if quick else layer_sizes):
+        # rows need at least a pixel of height and a pixel of gap
+        if rowCount * 2 > size // 2:
+          continue
+        fixtures.append({
+          'name': '{}-r{:02d}-s{}'.format(shape, rowCount, size),
+          'shape': shape,
+          'rowCount': rowCount,
+          'size': size,
+        })
+  return fixtures
+
+#
+#
+#  S T A G E S
+#
+# every stage is split in two: setup (not measured) and the function that
+# gets measured. Setup returns None if the stage doesn't apply to a fixture
+
+def setup_rows(fixture, args):
+  if np is None:
+    return None
+  alpha = make_alpha(make_rows(fixture['shape'], fixture['rowCount'], fixture['size']), fixture['size'])
+  return lambda: geometry.findTextRows(alpha)
+
+# plain python row scan. Reads come from bytes of the whole layer, one tile
+# row at a time, roughly what a pixel region does
+def setup_sparse(fixture, args):
+  lines = make_alpha_lines(make_rows(fixture['shape'], fixture['rowCount'], fixture['size']), fixture['size'])
+  [height, width] = [fixture['size'], fixture['size']]
+
+  def readAlpha(x, y, w, h):
+    return b''.join(line[x:x + w] for line in lines[y:y + h])
+
+  geometry.reset_geometry_stats()
+  return lambda: geometry.findTextRowsSparse(readAlpha, width, height)
+
+def setup_correct(fixture, args):
+  rows = make_rows(fixture['shape'], fixture['rowCount'], fixture['size'])
+  return lambda: geometry.correctRows([list(r) for r in rows], 25)
+
+def setup_mvee(fixture, args):
+  rows = make_rows(fixture['shape'], fixture['rowCount'], fixture['size'])
+  return lambda: geometry.getEllipseDimensions(rows, 7, 3, {'fit': 'mvee'})
+
+def setup_bruteforce(fixture, args):
+  if fixture['rowCount'] > args.bruteforce_rows:
+    return None
+  points = geometry.getEllipseEdgePoints(make_rows(fixture['shape'], fixture['rowCount'], fixture['size']))
+  geometry.reset_geometry_stats()
+  return lambda: geometry.calculateEllipseBounds_bruteforce(points)
+
+# one bruteforceEllipseBounds call per combination, for the first
+# single_combinations combinations that have a center
+def setup_single(fixture, args):
+  points = geometry.getEllipseEdgePoints(make_rows(fixture['shape'], fixture['rowCount'], fixture['size']))
+  geometry.reset_geometry_stats()
+
+  work = []
+  for combination in itertools.combinations(points, 4):
+    [mx, my] = geometry.getEllipseCenterForPoints(combination)
+    if mx != -1:
+      work.append([combination, mx, my])
+    if len(work) >= single_combinations:
+      break
+
+  if not work:
+    return None
+
+  def run():
+    for [combination, mx, my] in work:
+      geometry.count_stat('combinations_evaluated')
+      geometry.bruteforceEllipseBounds(points, combination, mx, my)
+  return run
+
+stages = [
+  ['rows', setup_rows],              # findTextRows
+  ['sparse', setup_sparse],          # findTextRowsSparse
+  ['correct', setup_correct],        # correctRows
+  ['mvee', setup_mvee],              # getEllipseDimensions, default fitter
+  ['bruteforce', setup_bruteforce],  # calculateEllipseBounds_bruteforce
+  ['single', setup_single],          # bruteforceEllipseBounds
+]
+
+#
+#
+#  M E A S U R I N G
+#
+
+def measure(run, repeat):
+  best = None
+  for i in range(0, repeat):
+    geometry.reset_geometry_stats()
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  counts = dict(geometry.geometry_stats)
+
+  peak = None
+  if tracemalloc is not None:
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  return {'time': best, 'memory': peak, 'counts': counts}
+
+def run_benchmarks(fixtures, stageNames, args):
+  results = {}
+  for fixture in fixtures:
+    for [stage, setup] in stages:
+      if stage not in stageNames:
+        continue
+      run = setup(fixture, args)
+      if run is None:
+        continue
+      result = measure(run, args.repeat)
+      results[fixture['name'] + '/' + stage] = result
+      print_result(fixture['name'] + '/' + stage, result)
+  return results
+
+def format_counts(counts):
+  return ' '.join('{}={}'.format(k, counts[k]) for k in sorted(counts))
+
+def print_result(name, result):
+  memory = '-' if result['memory'] is None else '{:.0f}'.format(result['memory'] / 1024.0)
+  print('{:32}  {:10.3f} ms  {:>8} KB  {}'.format(name, result['time'] * 1000, memory, format_counts(result['counts'])))
+
+#
+#
+#  B A S E L I N E
+#
+
+def load_baseline(path):
+  if not os.path.isfile(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+def save_baseline(path, results):
+  with open(path, 'w') as f:
+    json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=1, sort_keys=True)
+
+# returns list of [name, what, old, new] for everything that got worse by
+# more than threshold
+def find_regressions(baseline, results, threshold):
+  regressions = []
+  for name in sorted(results):
+    old = baseline['results'].get(name)
+    if not old:
+      continue
+    new = results[name]
+
+    if new['time'] > min_time and new['time'] > old['time'] * (1 + threshold):
+      regressions.append([name, 'time', old['time'], new['time']])
+
+    if old['memory'] is not None and new['memory'] is not None:
+      if new['memory'] > min_memory and new['memory'] > old['memory'] * (1 + threshold):
+        regressions.append([name, 'memory', old['memory'], new['memory']])
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark autobubble geometry code on synthetic text.')
+  parser.add_argument('--stages', default=','.join(s[0] for s in stages), help='comma separated stages to run (default: all of them)')
+  parser.add_argument('--quick', action='store_true', help='fewer row counts and layer sizes')
+  parser.add_argument('--filter', default='', help='only run fixtures with this in their name, e.g. diamond-r05')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per stage, best time counts (default: 3)')
+  parser.add_argument('--bruteforce-rows', type=int, default=bruteforce_max_rows, help='most rows the brute force stage runs on (default: {})'.format(bruteforce_max_rows))
+  parser.add_argument('--baseline', default=default_baseline, help='baseline file (default: benchmark-baseline.json next to this script)')
+  parser.add_argument('--save-baseline', action='store_true', help='save results as the new baseline instead of comparing')
+  parser.add_argument('--threshold', type=float, default=0.25, help='how much slower than the baseline a stage can get before the run fails (default: 0.25, i.e. 25%%)')
+  args = parser.parse_args()
+
+  stageNames = args.stages.split(',')
+  unknown = [s for s in stageNames if s not in [stage[0] for stage in stages]]
+  if unknown:
+    parser.error('unknown stages: ' + ', '.join(unknown))
+
+  if np is None:
+    print('numpy is not installed, skipping rows stage and measuring pure python fallbacks')
+
+  fixtures = [f for f in get_fixtures(args.quick) if args.filter in f['name']]
+  results = run_benchmarks(fixtures, stageNames, args)
+
+  if args.save_baseline:
+    save_baseline(args.baseline, results)
+    print('')
+    print('saved baseline with {} results to {}'.format(len(results), args.baseline))
+    return 0
+
+  baseline = load_baseline(args.baseline)
+  if baseline is None:
+    print('')
+    print('no baseline at {}, nothing to compare against. Run with --save-baseline to make one.'.format(args.baseline))
+    return 0
+
+  regressions = find_regressions(baseline, results, args.threshold)
+  print('')
+  for [name, what, old, new] in regressions:
+    print('REGRESSION {}: {} went from {:.6g} to {:.6g} ({:+.0f}%)'.format(name, what, old, new, (new / old - 1) * 100))
+
+  print('{} results, {} regressions (threshold {:.0f}%)'.format(len(results), len(regressions), args.threshold * 100))
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
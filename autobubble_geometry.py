@@ -0,0 +1,1520 @@
+#!/usr/bin/env python
+
+# Bubble geometry: text rows, jag correction and ellipse fitting.
+#
+# Nothing in here talks to gimp. Everything works on plain lists (rows, points)
+# and numpy arrays (alpha channel), which means this module can be imported
+# without gimpfu: by worker processes that compute geometry in parallel, and
+# by benchmarks that run without gimp at all.
+#
+# Works with both python 2 (gimp) and python 3.
+
+import math
+import time
+import itertools
+
+# numpy is optional. Not every GIMP build ships it, so anything that uses it
+# needs to have a plain python fallback
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+try:
+  xrange
+except NameError:
+  xrange = range
+
+#
+#
+#  G E O M E T R Y   S T A T S
+#
+# counters for the geometry stages, so we can see how much work was done
+# (and how much was avoided). python_autobubble resets them on every run.
+geometry_stats = {}
+
+def reset_geometry_stats():
+  geometry_stats.clear()
+
+def count_stat(name, value = 1):
+  geometry_stats[name] = geometry_stats.get(name, 0) + value
+
+#
+#
+#  T E X T   R O W S
+#
+
+# Coarse-to-fine: rows are scanned on alpha pooled 8 columns to a block
+# (see getAlphaBlocks), which is exact for telling which rows have text and
+# where text starts and ends to the nearest block. Only the first and the
+# last block of every row band get looked at in full resolution.
+alphaBlockSize = 8
+
+# alpha pooled into blocks of alphaBlockSize columns, as [height, blocks] bool
+# array. Every 8 bytes of a row are read as one 64 bit number, which is
+# nonzero if any of the 8 pixels has alpha, so pooling is a single cheap pass.
+# Rows need to be contiguous and a multiple of 8 bytes long for that, anything
+# else gets copied into a zero padded array first
+def getAlphaBlocks(alpha):
+  [height, width] = alpha.shape
+  if alpha.dtype != np.uint8 or not alpha.flags['C_CONTIGUOUS'] or width % alphaBlockSize:
+    padded = np.zeros((height, -(-width // alphaBlockSize) * alphaBlockSize), dtype=np.uint8)
+    padded[:, :width] = alpha
+    alpha = padded
+
+  return alpha.view(np.uint64) != 0
+
+# numpy version of the row scan. Takes alpha array instead of the layer and
+# returns the same [top, bottom, left, right] rows as findTextRowsSparse
+def findTextRows(alpha):
+  blocks = getAlphaBlocks(alpha)
+  hasText = blocks.any(axis=1)
+
+  # rows with text come in runs. Pad with False on both ends, so every run
+  # has a start and an end, even if text touches top or bottom of the layer
+  edges = np.flatnonzero(np.diff(np.concatenate(([False], hasText, [False])).astype(np.int8)))
+
+  rows = []
+  for i in xrange(0, len(edges), 2):
+    top = int(edges[i])
+    bottom = int(edges[i + 1]) - 1
+
+    # same as findTextRowsSparse: bottom row of the band doesn't count
+    band = slice(top, max(bottom, top + 1))
+    columns = np.flatnonzero(blocks[band].any(axis=0))
+
+    # exact edges are somewhere inside the first and the last block
+    first = int(columns[0]) * alphaBlockSize
+    last = int(columns[-1]) * alphaBlockSize
+    left = first + int(np.flatnonzero(alpha[band, first:first + alphaBlockSize].any(axis=0))[0])
+    right = last + int(np.flatnonzero(alpha[band, last:last + alphaBlockSize].any(axis=0))[-1]) + 1
+    rows.append([top, bottom, left, right])
+
+  return rows
+
+# gimp keeps drawables in tiles of this size. Reads that line up with tiles
+# touch every tile once
+tileSize = 64
+
+# plain python version of the row scan, for when there's no numpy. Reads
+# alpha one tile at a time with readAlpha(x, y, width, height), which returns
+# alpha of that rectangle as a string (a byte per pixel, row after row).
+# Text layers are mostly empty, and fully transparent tiles are skipped after
+# a single strip(). The rest is scanned a row at a time with string ops,
+# never pixel by pixel. Returns the same rows as findTextRows
+def findTextRowsSparse(readAlpha, width, height):
+  # leftmost and one past rightmost column with alpha, for every row of pixels
+  lefts = [None] * height
+  rights = [None] * height
+
+  for ty in xrange(0, height, tileSize):
+    th = min(tileSize, height - ty)
+    # tiles go left to right, so the first tile with alpha in a row has its
+    # left edge and the last one has its right edge
+    for tx in xrange(0, width, tileSize):
+      tw = min(tileSize, width - tx)
+      alpha = readAlpha(tx, ty, tw, th)
+      count_stat('tiles_read')
+
+      if not alpha.strip(b'\x00'):
+        count_stat('tiles_empty')
+        continue
+
+      for y in xrange(0, th):
+        row = alpha[y * tw:(y + 1) * tw]
+        right = len(row.rstrip(b'\x00'))
+        if right == 0:
+          continue
+        if lefts[ty + y] is None:
+          lefts[ty + y] = tx + tw - len(row.lstrip(b'\x00'))
+        rights[ty + y] = tx + right
+
+  rows = []
+  top = None
+  # we go one row past the bottom of the layer, so that text touching the
+  # bottom edge still gets its row closed
+  for y in xrange(0, height + 1):
+    hasText = y < height and lefts[y] is not None
+    if hasText and top is None:
+      top = y
+    elif not hasText and top is not None:
+      # bottom row of the band doesn't count towards left and right, unless
+      # it's the only one, same as findTextRows
+      band = xrange(top, max(y - 1, top + 1))
+      rows.append([top, y - 1, min(lefts[i] for i in band), max(rights[i] for i in band)])
+      top = None
+
+  return rows
+
+def findJag(edge1, edge2, minStepSize):
+  #  |<edge1
+  #   |<edge2    - returns 1
+  #
+  #   |<edge1
+  #  |<edge2     - returns -1
+  if abs(edge1 - edge2) < minStepSize:
+    if edge1 > edge2:
+      # print("jag = 1")
+      return 1
+    else: 
+      return -1
+  
+  # print("jag is bigger than min step size")
+  return 0
+
+def correctRows(rows, minStepSize):
+  if len(rows) < 2:
+    return rows #there's nothing to do if we only have one row
+  
+  # correct jags in the left edge
+  for i in xrange(0, len(rows) - 1):
+    jag = findJag(rows[i][2], rows[i+1][2], minStepSize)
+    if jag == -1:
+      rows[i+1][2] = rows[i][2]
+    if jag == 1:
+      # in this case, we correct back, naively. We don't check whether re-adjustment
+      # would cause the jag to grow to acceptable size. I don't think the complicated
+      # nature of the work would make that worth it, but I'll accept a PR
+      rows[i][2] = rows[i+1][2]
+      if i > 0:
+        for j in range(i - 1, -1, -1):
+          rows[j][2] = rows[i][2]
+  
+  # now correct the other edge, but mind that meanings of findJag() have flipped
+  for i in xrange(0, len(rows) - 1):
+    # print('..')
+    jag = findJag(rows[i][3], rows[i+1][3], minStepSize)
+    if jag == 1:
+      rows[i+1][3] = rows[i][3]
+    if jag == -1:
+      rows[i][3] = rows[i+1][3]
+      if i > 0:
+        for j in range(i - 1, -1, -1):
+          rows[j][3] = rows[i][3]
+  
+  return rows
+
+#
+#
+#  T E X T   R E G I O N S
+#
+# One layer can hold text of more than one bubble (a panel's worth of SFX,
+# say). Ink that's close together is one region, and every region gets a
+# bubble of its own.
+#
+# Instead of dilating the alpha mask pixel by pixel, we pool it into blocks of
+# distance x distance pixels (block has ink if any pixel in it has alpha) and
+# treat touching blocks, diagonals included, as connected. Ink closer than
+# distance always ends up in one region, and a clump of ink that is more than
+# twice that from any other ink is a region of its own. Connected blocks are
+# found by runs: every run of inked blocks in a block row is joined with runs
+# in the row above that it touches.
+
+# [x, y, alpha] of every region, where alpha is the part of the layer the
+# region covers, with other regions' ink cleared. Regions are ordered by the
+# first block they have, top to bottom and left to right
+def splitTextRegions(alpha, distance):
+  [height, width] = alpha.shape
+  block = max(int(distance), 1)
+
+  ink = alpha > 0
+  blocks = np.logical_or.reduceat(ink, np.arange(0, height, block), axis=0)
+  blocks = np.logical_or.reduceat(blocks, np.arange(0, width, block), axis=1)
+
+  # runs as [blockRow, start, end], end exclusive
+  runs = []
+  parent = []
+
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  above = []
+  for r in xrange(0, blocks.shape[0]):
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], blocks[r].astype(np.int8), [0]))))
+    current = []
+    for [start, end] in zip(edges[0::2], edges[1::2]):
+      i = len(runs)
+      runs.append([r, int(start), int(end)])
+      parent.append(i)
+      # runs touch if they overlap or meet at a corner
+      for j in above:
+        if runs[j][1] <= end and runs[j][2] >= start:
+          parent[find(j)] = find(i)
+      current.append(i)
+    above = current
+
+  labels = np.zeros(blocks.shape, dtype=np.int32)
+  regions = []
+  for i in xrange(0, len(runs)):
+    root = find(i)
+    if root not in regions:
+      regions.append(root)
+    [r, start, end] = runs[i]
+    labels[r, start:end] = regions.index(root) + 1
+
+  count_stat('text_regions', len(regions))
+
+  result = []
+  for k in xrange(1, len(regions) + 1):
+    [blockRows, blockCols] = np.nonzero(labels == k)
+    [r1, r2, c1, c2] = [blockRows.min(), blockRows.max() + 1, blockCols.min(), blockCols.max() + 1]
+    [x, y] = [int(c1) * block, int(r1) * block]
+    [w, h] = [min(int(c2) * block, width) - x, min(int(r2) * block, height) - y]
+
+    mask = np.repeat(np.repeat(labels[r1:r2, c1:c2] == k, block, axis=0), block, axis=1)[:h, :w]
+    result.append([x, y, np.where(mask, alpha[y:y + h, x:x + w], 0)])
+
+  return result
+
+#
+#
+#  R E C T A N G L E   O U T L I N E
+#
+# Rectangle bubbles are padded rows plus connectors between neighbouring
+# rows. Instead of selecting every rectangle on its own (every selection call
+# makes gimp combine the whole selection mask), we work out the outline of
+# their union here and select it with a single polygon.
+
+# padded rows and connectors as [x1, y1, x2, y2], relative to the layer
+def getRectangleBubbleRects(rows, xpad, ypad):
+  # if the difference between row[n][1] and row[n+1][0] is more than this,
+  # treat the rows as two separate bubbles. Treshold is _average_ row height
+  connect_rows_treshold = 0
+  for row in rows:
+    connect_rows_treshold += row[1] - row[0]
+  connect_rows_treshold //= len(rows)
+
+  rects = []
+  for i in xrange(0, len(rows)):
+    rects.append([rows[i][2] - xpad, rows[i][0] - ypad, rows[i][3] + xpad, rows[i][1] + ypad])
+
+    # ensure current row is connected with row on top (unless the gap between
+    # two rows is bigger than our treshold)
+    if i > 0 and (rows[i][0] - rows[i-1][1]) < connect_rows_treshold:
+      x1 = max(rows[i][2], rows[i-1][2]) - xpad
+      x2 = min(rows[i][3], rows[i-1][3]) + xpad
+      rects.append([x1, rows[i-1][1] - ypad, x2, rows[i][0] + ypad])
+
+  # rows that don't overlap have connectors with no width
+  return [r for r in rects if r[2] > r[0] and r[3] > r[1]]
+
+# outline of a union of rectangles. Returns a list of loops, every loop a list
+# of [x, y] corners going clockwise (on screen, where y points down). Holes
+# go the other way around.
+def getRectilinearOutline(rects):
+  if not rects:
+    return []
+
+  # every rectangle edge becomes a grid line. Cells of that grid are either
+  # completely inside the union or completely outside of it
+  xs = sorted(set([r[0] for r in rects] + [r[2] for r in rects]))
+  ys = sorted(set([r[1] for r in rects] + [r[3] for r in rects]))
+  xIndex = dict((x, i) for i, x in enumerate(xs))
+  yIndex = dict((y, i) for i, y in enumerate(ys))
+
+  filled = set()
+  for [x1, y1, x2, y2] in rects:
+    for i in xrange(xIndex[x1], xIndex[x2]):
+      for j in xrange(yIndex[y1], yIndex[y2]):
+        filled.add((i, j))
+
+  # edges between filled and empty cells, pointing so the filled cell is on
+  # the right. Keyed by the corner they start at
+  edges = {}
+  for (i, j) in filled:
+    if (i, j - 1) not in filled:
+      edges.setdefault((i, j), []).append((i + 1, j))
+    if (i + 1, j) not in filled:
+      edges.setdefault((i + 1, j), []).append((i + 1, j + 1))
+    if (i, j + 1) not in filled:
+      edges.setdefault((i + 1, j + 1), []).append((i, j + 1))
+    if (i - 1, j) not in filled:
+      edges.setdefault((i, j + 1), []).append((i, j))
+
+  loops = []
+  while edges:
+    start = min(edges)
+    corners = [start]
+    current = start
+    while True:
+      following = edges[current]
+      end = following.pop()
+      if not following:
+        del edges[current]
+      if end == start:
+        break
+      corners.append(end)
+      current = end
+
+    # drop corners in the middle of straight edges
+    loop = []
+    for k in xrange(0, len(corners)):
+      prev = corners[k - 1]
+      corner = corners[k]
+      after = corners[(k + 1) % len(corners)]
+      if (prev[0] == corner[0] == after[0]) or (prev[1] == corner[1] == after[1]):
+        continue
+      loop.append([xs[corner[0]], ys[corner[1]]])
+    loops.append(loop)
+
+  return loops
+
+# replaces every corner of a loop with a quarter circle. Radius gets smaller
+# where edges are too short for it
+def roundPolygonCorners(loop, radius, segments = 4):
+  if radius <= 0:
+    return loop
+
+  rounded = []
+  count = len(loop)
+  for k in xrange(0, count):
+    prev = loop[k - 1]
+    corner = loop[k]
+    after = loop[(k + 1) % count]
+
+    inLength = abs(corner[0] - prev[0]) + abs(corner[1] - prev[1])
+    outLength = abs(after[0] - corner[0]) + abs(after[1] - corner[1])
+    r = min(radius, inLength / 2.0, outLength / 2.0)
+
+    # unit directions of the edge coming in and the edge going out
+    din = [(corner[0] - prev[0]) / float(inLength), (corner[1] - prev[1]) / float(inLength)]
+    dout = [(after[0] - corner[0]) / float(outLength), (after[1] - corner[1]) / float(outLength)]
+
+    # arc starts r before the corner, ends r after it, and its center is r
+    # away from both edges
+    cx = corner[0] - din[0] * r + dout[0] * r
+    cy = corner[1] - din[1] * r + dout[1] * r
+    for step in xrange(0, segments + 1):
+      t = step * math.pi / 2 / segments
+      point = [cx - dout[0] * r * math.cos(t) + din[0] * r * math.sin(t), cy - dout[1] * r * math.cos(t) + din[1] * r * math.sin(t)]
+      # arcs of corners with short edges between them touch
+      if not rounded or rounded[-1] != point:
+        rounded.append(point)
+
+  return rounded
+
+# joins loops into one flat [x0, y0, x1, y1, ...] list that a single polygon
+# selection can take. After every loop we go back to where the first loop
+# started. Those bridges are walked once in each direction, so they don't
+# cover anything
+def joinPolygons(loops):
+  coords = []
+  for loop in loops:
+    for point in loop + [loop[0]]:
+      coords.append(point[0])
+      coords.append(point[1])
+    if len(loops) > 1:
+      coords.append(loops[0][0][0])
+      coords.append(loops[0][0][1])
+  return coords
+
+# outline of a rectangle bubble (or several of them) as a list of loops,
+# moved by offset
+def getRectangleBubbleOutline(rows, xpad, ypad, radius = 0, offset = (0, 0)):
+  loops = getRectilinearOutline(getRectangleBubbleRects(rows, xpad, ypad))
+  loops = [roundPolygonCorners(loop, radius) for loop in loops]
+  return [[[x + offset[0], y + offset[1]] for [x, y] in loop] for loop in loops]
+
+#
+#
+#  C O N V E X   H U L L
+#
+# only points on the convex hull can touch an ellipse that encloses all of
+# them. Points inside of the hull (e.g. inner corners of ragged or centered
+# text) are inside the ellipse no matter what, so there's no need to give
+# them to the fitter.
+
+def cross(o, a, b):
+  return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+# Andrew's monotone chain. Returns hull points in counter-clockwise order,
+# without points that lie on hull edges
+def getConvexHull(points):
+  sortedPoints = sorted(points)
+  if len(sortedPoints) < 3:
+    return sortedPoints
+
+  lower = []
+  for p in sortedPoints:
+    while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+      lower.pop()
+    lower.append(p)
+
+  upper = []
+  for p in reversed(sortedPoints):
+    while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+      upper.pop()
+    upper.append(p)
+
+  # last point of each half is the first point of the other one
+  return lower[:-1] + upper[:-1]
+
+#
+#
+#  M I N I M U M   V O L U M E   E N C L O S I N G   E L L I P S E
+#
+# Khachiyan's algorithm. Instead of guessing centers from 4-point combinations
+# and bisecting radii, we look for weights 'u' of points such that the ellipse
+# given by weighted center and spread of the points is as small as possible.
+# Each iteration moves a bit of weight to the point that sticks out the most.
+# Everything here is 2D, so we don't need numpy for the matrix math.
+
+# bounding box of points, as [minx, miny, maxx, maxy]
+def getPointBounds(points):
+  xs = [p[0] for p in points]
+  ys = [p[1] for p in points]
+  return [min(xs), min(ys), max(xs), max(ys)]
+
+# smallest axis-aligned ellipse with the same aspect ratio as the bounding
+# box that still contains the bounding box. Always valid, never great.
+def getBoundingBoxEllipse(points):
+  [minx, miny, maxx, maxy] = getPointBounds(points)
+  w = max(maxx - minx, 1.0) * math.sqrt(2)
+  h = max(maxy - miny, 1.0) * math.sqrt(2)
+  return [(minx + maxx) / 2.0, (miny + maxy) / 2.0, w, h]
+
+# time.time() by which ellipse fitting has to be done, from 'budget' option
+# (milliseconds per bubble). None if there's no limit
+def getFitDeadline(options):
+  budget = options.get('budget', 0) if options else 0
+  if budget > 0:
+    return time.time() + budget / 1000.0
+  return None
+
+def isPastDeadline(deadline):
+  return deadline is not None and time.time() >= deadline
+
+def invert3x3(m):
+  [[a, b, c], [d, e, f], [g, h, i]] = m
+  det = a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+  if abs(det) < 1e-12:
+    return None
+  return [
+    [(e * i - f * h) / det, (c * h - b * i) / det, (b * f - c * e) / det],
+    [(f * g - d * i) / det, (a * i - c * g) / det, (c * d - a * f) / det],
+    [(d * h - e * g) / det, (b * g - a * h) / det, (a * e - b * d) / det]
+  ]
+
+# weighted center and variance along x and y, as [cx, cy, varx, vary]
+def getWeightedSpread(points, u):
+  n = len(points)
+  cx = sum(u[i] * points[i][0] for i in xrange(0, n))
+  cy = sum(u[i] * points[i][1] for i in xrange(0, n))
+  varx = sum(u[i] * (points[i][0] - cx) ** 2 for i in xrange(0, n))
+  vary = sum(u[i] * (points[i][1] - cy) ** 2 for i in xrange(0, n))
+  return [cx, cy, varx, vary]
+
+# axis-aligned version. Only spread along x and y axes counts, which makes
+# each step simple enough to do an exact line search.
+def mveeAxisAligned(points, tolerance, maxIterations, deadline = None):
+  n = len(points)
+  u = [1.0 / n] * n
+
+  # even equal weights give an ellipse we can scale up to fit, so stopping
+  # before the first iteration still has an answer
+  [cx, cy, varx, vary] = getWeightedSpread(points, u)
+
+  for iteration in xrange(0, maxIterations):
+    if isPastDeadline(deadline):
+      break
+
+    # how far out of the current ellipse each point is. Optimal solution has
+    # all points at 2 or less
+    g = [((p[0] - cx) ** 2) / varx + ((p[1] - cy) ** 2) / vary for p in points]
+    k = max(xrange(0, n), key=lambda i: g[i])
+
+    if g[k] - 2 <= 2 * tolerance:
+      break
+
+    # exact step size, root of (2 - s) + (3s - 2p) * step + 4p * step^2
+    ax = ((points[k][0] - cx) ** 2) / varx
+    ay = ((points[k][1] - cy) ** 2) / vary
+    s = ax + ay
+    p = ax * ay
+    if p > 0:
+      b = 3 * s - 2 * p
+      step = (-b + math.sqrt(b * b - 16 * p * (2 - s))) / (8 * p)
+    else:
+      step = (s - 2) / (3 * s)
+
+    u = [ui * (1 - step) for ui in u]
+    u[k] += step
+    [cx, cy, varx, vary] = getWeightedSpread(points, u)
+
+  # radius is sqrt(2 * variance). Then scale up just enough that every point
+  # is inside, because we stopped with tolerance left over
+  rx = math.sqrt(2 * varx)
+  ry = math.sqrt(2 * vary)
+  scale = math.sqrt(max(((p[0] - cx) / rx) ** 2 + ((p[1] - cy) / ry) ** 2 for p in points))
+  return [cx, cy, 2 * rx * scale, 2 * ry * scale]
+
+# rotated version. Returns [cx, cy, w, h, angle], where angle (radians) is the
+# direction of the 'w' axis
+def mveeRotated(points, tolerance, maxIterations, deadline = None):
+  n = len(points)
+  u = [1.0 / n] * n
+
+  for iteration in xrange(0, maxIterations):
+    if isPastDeadline(deadline):
+      break
+
+    # X = sum(u * q * q^T), q = [x, y, 1]
+    X = [[0.0] * 3 for i in xrange(0, 3)]
+    for i in xrange(0, n):
+      q = [points[i][0], points[i][1], 1.0]
+      for r in xrange(0, 3):
+        for c in xrange(0, 3):
+          X[r][c] += u[i] * q[r] * q[c]
+
+    Xi = invert3x3(X)
+    if Xi is None:
+      return None
+
+    M = []
+    for p in points:
+      q = [p[0], p[1], 1.0]
+      M.append(sum(q[r] * Xi[r][c] * q[c] for r in xrange(0, 3) for c in xrange(0, 3)))
+    k = max(xrange(0, n), key=lambda i: M[i])
+
+    if M[k] - 3 <= 3 * tolerance:
+      break
+
+    step = (M[k] - 3) / (3 * (M[k] - 1))
+    u = [ui * (1 - step) for ui in u]
+    u[k] += step
+
+  cx = sum(u[i] * points[i][0] for i in xrange(0, n))
+  cy = sum(u[i] * points[i][1] for i in xrange(0, n))
+  sxx = sum(u[i] * (points[i][0] - cx) ** 2 for i in xrange(0, n))
+  syy = sum(u[i] * (points[i][1] - cy) ** 2 for i in xrange(0, n))
+  sxy = sum(u[i] * (points[i][0] - cx) * (points[i][1] - cy) for i in xrange(0, n))
+
+  # principal axes of the spread. Radius along each axis is sqrt(2 * variance)
+  angle = 0.5 * math.atan2(2 * sxy, sxx - syy)
+  cos = math.cos(angle)
+  sin = math.sin(angle)
+  va = sxx * cos * cos + 2 * sxy * sin * cos + syy * sin * sin
+  vb = sxx * sin * sin - 2 * sxy * sin * cos + syy * cos * cos
+  if va <= 0 or vb <= 0:
+    return None
+
+  ra = math.sqrt(2 * va)
+  rb = math.sqrt(2 * vb)
+
+  scale = 0
+  for p in points:
+    da = (p[0] - cx) * cos + (p[1] - cy) * sin
+    db = -(p[0] - cx) * sin + (p[1] - cy) * cos
+    scale = max(scale, (da / ra) ** 2 + (db / rb) ** 2)
+  scale = math.sqrt(scale)
+
+  return [cx, cy, 2 * ra * scale, 2 * rb * scale, angle]
+
+# returns [cx, cy, w, h] (and angle, if rotated is set), same as
+# calculateEllipseBounds_bruteforce. Every iteration gives an ellipse that
+# contains all the points, so if we run out of time we just stop early
+def calculateEllipseBounds_mvee(points, tolerance = 0.001, rotated = False, maxIterations = 10000, deadline = None):
+  [minx, miny, maxx, maxy] = getPointBounds(points)
+
+  # all points on a line don't have an ellipse around them
+  if maxx - minx <= 0 or maxy - miny <= 0:
+    return getBoundingBoxEllipse(points)
+
+  if rotated:
+    dims = mveeRotated(points, tolerance, maxIterations, deadline)
+    if dims:
+      return dims
+
+  return mveeAxisAligned(points, tolerance, maxIterations, deadline)
+
+# corners of text rows that the ellipse has to enclose, minus the ones that
+# can't touch the ellipse anyway
+def getEllipseEdgePoints(rows):
+  rowCount = len(rows)
+
+  edgePoints = []
+
+  # determine edge points and offset a tiny bit to ensure a solution exists
+  # when calculating ellipse dimensions
+  for i in xrange(0, -(-rowCount // 2)):
+    # Instead of having one point per corner, we add extra points which take
+    # vertical and horizontal offset into account (a,b instead of x)
+    #       a    
+    #     b x-----
+    #       | text corner
+    #
+
+    edgePoints.append([float(rows[i][2]), float(rows[i][0])])
+    edgePoints.append([float(rows[i][3]), float(rows[i][0])])
+
+  for i in xrange(rowCount // 2, rowCount):
+    # offset x, left then right
+    edgePoints.append([float(rows[i][2]), float(rows[i][1])])
+    edgePoints.append([float(rows[i][3]), float(rows[i][1])])
+
+  hullPoints = getConvexHull(edgePoints)
+  count_stat('hull_points_in', len(edgePoints))
+  count_stat('hull_points_dropped', len(edgePoints) - len(hullPoints))
+
+  # brute force needs at least 4 points to make a combination
+  if len(hullPoints) >= 4:
+    return hullPoints
+
+  return edgePoints
+
+def getEllipseDimensions(rows, xpad, ypad, options = None, deadline = None):
+  # uh oh
+  #
+  # returns [x,y,width,height]
+  #
+  # Ideally, we'd draw an ellipse such that all the points would be:
+  #      * inside the ellipse
+  #      * as close as possible to the edge of the ellipse.
+  #
+  # That's a bit hard, though, so we'll have to do with an approximation.
+  # see: https://math.stackexchange.com/a/207837
+  # and even this is cancer so ...
+  #  
+  # Quick reminder. Rows coords are like this: top, bottom, left, right 
+  #
+  # NOTE: gimp-image-select-ellipse takes arguments (x,y,width,height) AS
+  #       A FLOAT, which means we don't have to round stuff.
+  #       source: procedure browser in gimp (see: help menu)
+  #
+  # If there's a deadline, fitters stop when they hit it and return the best
+  # ellipse they have by then. Bounding box ellipse is what we start from:
+  # it's always valid, so whatever the fitter comes back with has to beat it
+
+  edgePoints = getEllipseEdgePoints(rows)
+
+  if not options:
+    options = {}
+
+  if options.get('fit') == 'bruteforce':
+    dims = calculateEllipseBounds_bruteforce(edgePoints, deadline)
+  else:
+    dims = calculateEllipseBounds_mvee(edgePoints, options.get('tolerance', 0.001), options.get('rotated', False), deadline = deadline)
+
+  if deadline is not None:
+    if isPastDeadline(deadline):
+      count_stat('fits_out_of_time')
+
+    fallback = getBoundingBoxEllipse(edgePoints)
+    if dims[2] <= 0 or dims[3] <= 0 or dims[2] * dims[3] > fallback[2] * fallback[3]:
+      count_stat('fits_bounding_box')
+      return fallback
+
+  return dims
+
+
+#
+#
+#  B R U T E   F O R C E   E L L I P S E   S E A R C H
+#
+
+def sortPointsByComponent(points, component):
+  # this is criminally bad, but we don't care because it's only 4 points
+  # you can karmawhore this on /r/badcode, I don't care
+  sortedPoints = []
+
+  for p in points:
+    if len(sortedPoints) == 0:
+      sortedPoints.append(p)
+      continue
+
+    append = True
+    for i in range(0, len(sortedPoints)):
+      if sortedPoints[i][component] > p[component]:
+        sortedPoints.insert(i, p)
+        append = False
+        break
+
+    if append:
+      sortedPoints.append(p)
+  
+  return sortedPoints
+
+def getEllipseCenterForPoints(points):
+  # find center
+  middle_x = (points[0][0] + points[1][0] + points[2][0] + points[3][0]) / 4
+  middle_y = (points[0][1] + points[1][1] + points[2][1] + points[3][1]) / 4
+  
+  # find opposing vertices
+  leftFirst = sortPointsByComponent(points, 0)
+  #     * one of the first left points must be nw, the other sw
+  #     * note that this only works because leftmost two points
+  #       cant share 'y' coordinate due to how we calculate edge points
+  leftFirst
+  if leftFirst[0][1] > leftFirst[1][1]:
+    nw = leftFirst[0]
+    sw = leftFirst[1]
+  else:
+    nw = leftFirst[1]
+    sw = leftFirst[0]
+  
+  if leftFirst[2][1] > leftFirst[3][1]:
+    ne = leftFirst[2]
+    se = leftFirst[3]
+  else:
+    ne = leftFirst[3]
+    se = leftFirst[2]
+  
+  # don't even get a center if either of the slopes is vertical
+  if nw[0] == se[0] or ne[0] == sw[0]:
+    return [-1, -1]
+
+  # find where they intersect
+  nwse_slope = (se[1] - nw[1]) / (se[0] - nw[0])
+  swne_slope = (ne[1] - sw[1]) / (ne[0] - sw[0])
+  
+  nwse_extra = se[1] - nwse_slope * se[0]
+  swne_extra = ne[1] - swne_slope * ne[0]
+
+  # parallel diagonals never intersect (symmetric combinations do that)
+  if nwse_slope == swne_slope:
+    return [-1, -1]
+  
+  x = (swne_extra - nwse_extra) / (nwse_slope - swne_slope)
+  y = (nwse_slope * x) + nwse_extra
+  
+  # mirror that over the center point from earlier
+  mx = middle_x + (middle_x - x)
+  my = middle_y + (middle_y - y)
+  
+  # return value
+  return [mx, my]
+
+def bruteforceEllipseBounds(all_points, combination, mx, my):
+  maxx = combination[0][0]; maxy = combination[0][1]; minx = combination[0][0]; miny = combination[0][1]
+
+  iterations = 50
+  stepRelative = 0.75
+  stepRelative_arStage_outer = 0.99
+  stepRelative_arStage_inner = 0.98
+
+  for p in combination:
+    if p[0] > maxx:
+      maxx = p[0]
+    if p[0] < minx:
+      minx = p[0]
+    if p[1] > maxy:
+      maxy = p[1]
+    if p[1] < miny:
+      miny = p[1]
+
+  ew = maxx - minx  # this is our initial radius, twice as long as width/height
+  eh = maxy - miny  # this also radius, but for other axis
+
+  stepx = ew * stepRelative
+  stepy = eh * stepRelative
+
+  # step 1: find ellipse with same aspect ratio as text
+  while iterations > 0:
+    iterations -= 1
+
+    inEllipse = True
+    for point in all_points:
+      res = (((point[0] - mx) ** 2) / (ew ** 2)) + (((point[1] - my) ** 2) / (eh ** 2))
+      if res > 1:
+        inEllipse = False
+        break
+
+
+    if inEllipse:
+      ew -= stepx
+      eh -= stepy
+    else:
+      ew += stepx
+      eh += stepy
+
+    stepx *= stepRelative
+    stepy *= stepRelative
+
+  # step 2: try to find a better radius by shrinking shorter radius 
+  # and stretching longer radius. The following values are maximum 
+  # possible values - if we find a solution that has greater area than
+  # the best current solution, we return best width and height without
+  # searching further as we aren't going to find a better solution
+  iterations = 40
+  innerSteps = 20
+
+  bestArea = ew * eh
+  bestw = ew
+  besth = eh
+
+  # print("----- bruteforce -----")
+  # print("inital area:")
+  # print([bestArea, [mx, my], [bestw, besth]])
+
+  # true if ellipse is wider than taller, false otherwise
+  isLandscape = ew >= eh
+
+  stepx = ew * stepRelative_arStage_outer
+  stepy = eh * stepRelative_arStage_outer
+
+  if isLandscape:
+    stepInner = ew * stepRelative_arStage_inner
+  else:
+    stepInner = eh * stepRelative_arStage_inner
+  
+  for i in range(0, iterations):
+    # reduce shorter radius
+    if isLandscape:
+      eh -= stepy
+    else:
+      ew -= stepx
+
+    h = eh
+    w = ew
+
+    hasBeenInEllipse = False
+
+    for j in range(0, innerSteps):
+      # test if all points are in ellipse
+      inEllipse = True
+      for point in all_points:
+        res = (((point[0] - mx) ** 2) / (w ** 2)) + (((point[1] - my) ** 2) / (h ** 2))
+        if res > 1:
+          inEllipse = False
+          break
+      
+      # expand the ellipse in the other dimension from where we narrowed it
+      if isLandscape:
+        w += stepInner
+      else:
+        h += stepInner
+      
+      if inEllipse:
+        hasBeenInEllipse = True
+        nbb = w * h
+        if nbb < bestArea:
+          bestArea = nbb
+          bestw = w
+          besth = h
+          # print("bruteforce: found new solution (area, mx, my, rx, ry")
+          # print([bestArea, [mx, my], [bestw, besth]])
+        else:
+          break   # we won't find a better solution this iteration
+    
+    if not hasBeenInEllipse:
+      break       # if this iteation has never been in an ellipse, subsequent
+                  # iterations won't be either
+  
+  # return best radius:
+  return [bestw, besth]
+
+
+# numpy version of getEllipseCenterForPoints, for many combinations at once.
+#   points       - array of shape [n, 2]
+#   combinations - array of point indices, shape [c, 4]
+# returns array of shape [c, 2]. Combinations that getEllipseCenterForPoints
+# would reject (or divide by zero on) get NaN instead of [-1, -1]
+def getEllipseCentersForCombinations(points, combinations):
+  combo = points[combinations]              # [c, 4, 2]
+
+  middle_x = (combo[:, 0, 0] + combo[:, 1, 0] + combo[:, 2, 0] + combo[:, 3, 0]) / 4
+  middle_y = (combo[:, 0, 1] + combo[:, 1, 1] + combo[:, 2, 1] + combo[:, 3, 1]) / 4
+
+  # sortPointsByComponent keeps order of points with equal x, so sort must be stable
+  order = np.argsort(combo[:, :, 0], axis=1, kind='mergesort')
+  leftFirst = combo[np.arange(len(combo))[:, None], order]
+
+  swapLeft = (leftFirst[:, 0, 1] > leftFirst[:, 1, 1])[:, None]
+  nw = np.where(swapLeft, leftFirst[:, 0], leftFirst[:, 1])
+  sw = np.where(swapLeft, leftFirst[:, 1], leftFirst[:, 0])
+
+  swapRight = (leftFirst[:, 2, 1] > leftFirst[:, 3, 1])[:, None]
+  ne = np.where(swapRight, leftFirst[:, 2], leftFirst[:, 3])
+  se = np.where(swapRight, leftFirst[:, 3], leftFirst[:, 2])
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    nwse_slope = (se[:, 1] - nw[:, 1]) / (se[:, 0] - nw[:, 0])
+    swne_slope = (ne[:, 1] - sw[:, 1]) / (ne[:, 0] - sw[:, 0])
+
+    nwse_extra = se[:, 1] - nwse_slope * se[:, 0]
+    swne_extra = ne[:, 1] - swne_slope * ne[:, 0]
+
+    x = (swne_extra - nwse_extra) / (nwse_slope - swne_slope)
+    y = (nwse_slope * x) + nwse_extra
+
+  mx = middle_x + (middle_x - x)
+  my = middle_y + (middle_y - y)
+
+  rejected = (nw[:, 0] == se[:, 0]) | (ne[:, 0] == sw[:, 0]) | (nwse_slope == swne_slope)
+  rejected |= ~(np.isfinite(mx) & np.isfinite(my))
+  mx[rejected] = np.nan
+  my[rejected] = np.nan
+
+  return np.column_stack((mx, my))
+
+# numpy version of bruteforceEllipseBounds, for many combinations at once.
+# Every combination runs exactly the same search as it would in
+# bruteforceEllipseBounds, but each step of the search tests all points of all
+# combinations (and in step 2, all candidate radii of an iteration) in one go.
+#   all_points   - array of shape [n, 2]
+#   combinations - points of each combination, shape [c, 4, 2]
+#   mx, my       - centers of each combination, shape [c]
+# returns arrays of radii [rx, ry], each of shape [c]
+def bruteforceEllipseBounds_batched(all_points, combinations, mx, my):
+  iterations = 50
+  stepRelative = 0.75
+  stepRelative_arStage_outer = 0.99
+  stepRelative_arStage_inner = 0.98
+  innerSteps = 20
+
+  # these don't change, no matter which radius we test. Shape [c, n]
+  dx2 = (all_points[None, :, 0] - mx[:, None]) ** 2
+  dy2 = (all_points[None, :, 1] - my[:, None]) ** 2
+
+  ew = combinations[:, :, 0].max(axis=1) - combinations[:, :, 0].min(axis=1)
+  eh = combinations[:, :, 1].max(axis=1) - combinations[:, :, 1].min(axis=1)
+
+  stepx = ew * stepRelative
+  stepy = eh * stepRelative
+
+  # step 1: find ellipse with same aspect ratio as text
+  with np.errstate(divide='ignore', invalid='ignore'):
+    while iterations > 0:
+      iterations -= 1
+
+      outside = ((dx2 / (ew ** 2)[:, None]) + (dy2 / (eh ** 2)[:, None]) > 1).any(axis=1)
+      ew = np.where(outside, ew + stepx, ew - stepx)
+      eh = np.where(outside, eh + stepy, eh - stepy)
+
+      stepx *= stepRelative
+      stepy *= stepRelative
+
+  # step 2: shrink the shorter radius, stretch the longer one. See
+  # bruteforceEllipseBounds for the details
+  iterations = 40
+
+  bestArea = ew * eh
+  bestw = ew.copy()
+  besth = eh.copy()
+
+  isLandscape = ew >= eh
+
+  stepx = ew * stepRelative_arStage_outer
+  stepy = eh * stepRelative_arStage_outer
+  stepInner = np.where(isLandscape, ew, eh) * stepRelative_arStage_inner
+
+  # combinations that already broke out of the outer loop
+  done = np.zeros(len(combinations), dtype=bool)
+
+  for i in range(0, iterations):
+    eh = np.where(~done & isLandscape, eh - stepy, eh)
+    ew = np.where(~done & ~isLandscape, ew - stepx, ew)
+
+    # every radius the inner loop could test, built with the same additions
+    # the inner loop would do. Shape [c, innerSteps + 1]
+    candidates = [np.where(isLandscape, ew, eh)]
+    for j in range(0, innerSteps):
+      candidates.append(candidates[-1] + stepInner)
+    candidates = np.column_stack(candidates)
+
+    w = np.where(isLandscape[:, None], candidates[:, :-1], ew[:, None])
+    h = np.where(isLandscape[:, None], eh[:, None], candidates[:, :-1])
+
+    # [c, innerSteps, n]: points against all candidates of all combinations
+    with np.errstate(divide='ignore', invalid='ignore'):
+      res = dx2[:, None, :] / (w ** 2)[:, :, None] + dy2[:, None, :] / (h ** 2)[:, :, None]
+    inEllipse = ~((res > 1).any(axis=2))
+
+    # same as bruteforceEllipseBounds, radius gets stepped before it's saved
+    nbb = np.where(isLandscape[:, None], candidates[:, 1:] * eh[:, None], ew[:, None] * candidates[:, 1:])
+
+    hasBeenInEllipse = np.zeros(len(combinations), dtype=bool)
+    running = ~done
+
+    for j in range(0, innerSteps):
+      hit = running & inEllipse[:, j]
+      hasBeenInEllipse |= hit
+
+      better = hit & (nbb[:, j] < bestArea)
+      bestArea = np.where(better, nbb[:, j], bestArea)
+      bestw = np.where(better, np.where(isLandscape, candidates[:, j + 1], ew), bestw)
+      besth = np.where(better, np.where(isLandscape, eh, candidates[:, j + 1]), besth)
+
+      # we won't find a better solution this iteration
+      running &= ~(hit & ~better)
+
+    done |= ~hasBeenInEllipse
+
+    if done.all():
+      break
+
+  return [bestw, besth]
+
+# Lower bound for rx * ry of any ellipse centered at (mx, my) that contains
+# all the points. For every point, (dx/rx)^2 + (dy/ry)^2 <= 1 means that
+#     * rx >= |dx| and ry >= |dy|
+#     * rx * ry >= 2 * |dx * dy|    (because a^2 + b^2 >= 2ab)
+# Brute force search can end a hair inside of the ellipse it converges to, so
+# bounds get a bit of slack before we compare them to the best area.
+lowerBoundSlack = 1e-5
+
+def getEllipseAreaLowerBound(points, mx, my):
+  maxdx = 0
+  maxdy = 0
+  maxdxdy = 0
+  for p in points:
+    dx = abs(p[0] - mx)
+    dy = abs(p[1] - my)
+    maxdx = max(maxdx, dx)
+    maxdy = max(maxdy, dy)
+    maxdxdy = max(maxdxdy, dx * dy)
+
+  return max(maxdx * maxdy, 2 * maxdxdy)
+
+# same as getEllipseAreaLowerBound, for arrays of centers
+def getEllipseAreaLowerBounds(points, mx, my):
+  dx = np.abs(points[None, :, 0] - mx[:, None])
+  dy = np.abs(points[None, :, 1] - my[:, None])
+  return np.maximum(dx.max(axis=1) * dy.max(axis=1), 2 * (dx * dy).max(axis=1))
+
+# with a deadline, search stops when it hits it and returns the best ellipse
+# so far ([0, 0, 0, 0] if there isn't one yet)
+def calculateEllipseBounds_bruteforce(points, deadline = None):
+  if np is not None:
+    return calculateEllipseBounds_bruteforce_batched(points, deadline)
+
+  bestArea = -1
+  bestBounds = [0, 0, 0, 0]
+
+  for combination in itertools.combinations(points, 4):
+    if isPastDeadline(deadline):
+      break
+
+    count_stat('combinations_total')
+    # print("")
+    # print("")
+    # print("<starting new loop>")
+
+    [mx, my] = getEllipseCenterForPoints(combination)
+
+    # let's see if getEllipseCenterForPoints told us to not bother with
+    # this set of points. We'd just waste time
+    if mx == -1:
+      count_stat('combinations_rejected')
+      continue
+
+    # no ellipse around this center can beat the best one we've got
+    if bestArea > 0 and getEllipseAreaLowerBound(points, mx, my) * (1 - lowerBoundSlack) >= bestArea:
+      count_stat('combinations_pruned')
+      continue
+
+    count_stat('combinations_evaluated')
+    [rx, ry] = bruteforceEllipseBounds(points, combination, mx, my)
+
+    # did we already find an ellipse? If no, this is the best candidate
+    # so far and we'll mark it down later.
+    # if yes, we check if the new ellipse is smaller than the old one
+    if bestArea > 0:
+      nbb = rx * ry
+      if nbb < bestArea:
+        # print("[[[ N E W   B E S T   S O L U T I O N]]]")
+        # print ("mx, my, rx, ry")
+        # print (bestBounds)
+        bestArea = nbb
+        bestBounds = [mx, my, rx*2, ry*2]
+    else:
+      bestArea = rx * ry
+      bestBounds = [mx, my, rx*2, ry*2]
+      # print("BEST AREA:")
+      # print([bestArea, [mx, my], [rx, ry]])
+      
+    
+  # print ("::")
+  # print ("mx, my, rx, ry")
+  # print (bestBounds)
+
+  return bestBounds
+
+# how many combinations get searched at once. Keeps memory in check when
+# there's a lot of points. First chunk is small, so we have a best area to
+# prune against as soon as possible
+combinationChunkSize = 1024
+firstCombinationChunkSize = 32
+
+def calculateEllipseBounds_bruteforce_batched(points, deadline = None):
+  bestArea = -1
+  bestIndex = -1
+  bestBounds = [0, 0, 0, 0]
+
+  pointsArray = np.array(points, dtype=np.float64)
+  allCombinations = itertools.combinations(xrange(0, len(points)), 4)
+
+  # pass 1: centers and lower bounds of all combinations. These are cheap
+  combinations = []
+  centers = []
+  lowerBounds = []
+
+  while not isPastDeadline(deadline):
+    chunk = list(itertools.islice(allCombinations, combinationChunkSize))
+    if not chunk:
+      break
+
+    count_stat('combinations_total', len(chunk))
+    chunk = np.array(chunk, dtype=np.intp)
+    chunkCenters = getEllipseCentersForCombinations(pointsArray, chunk)
+
+    # let's not bother with the combinations getEllipseCenterForPoints
+    # would reject
+    valid = ~np.isnan(chunkCenters[:, 0])
+    count_stat('combinations_rejected', len(chunk) - int(valid.sum()))
+
+    combinations.append(chunk[valid])
+    centers.append(chunkCenters[valid])
+    lowerBounds.append(getEllipseAreaLowerBounds(pointsArray, chunkCenters[valid, 0], chunkCenters[valid, 1]))
+
+  if not combinations:
+    return bestBounds
+
+  combinations = np.concatenate(combinations)
+  centers = np.concatenate(centers)
+  lowerBounds = np.concatenate(lowerBounds) * (1 - lowerBoundSlack)
+
+  # pass 2: search combinations with the most promising bounds first. Once a
+  # chunk starts with a bound that can't beat the best area, neither can the
+  # rest of them
+  order = np.argsort(lowerBounds, kind='mergesort')
+  start = 0
+  evaluated = 0
+  chunkSize = firstCombinationChunkSize
+
+  while start < len(order) and not isPastDeadline(deadline):
+    chunk = order[start:start + chunkSize]
+    start += chunkSize
+    chunkSize = combinationChunkSize
+
+    if bestArea > 0:
+      chunk = chunk[lowerBounds[chunk] < bestArea]
+      if len(chunk) == 0:
+        break
+
+    evaluated += len(chunk)
+    [rx, ry] = bruteforceEllipseBounds_batched(pointsArray, pointsArray[combinations[chunk]], centers[chunk, 0], centers[chunk, 1])
+
+    # ties go to the combination that comes first, same as going through
+    # them in order
+    areas = rx * ry
+    for c in np.flatnonzero(areas <= areas.min()):
+      if bestArea <= 0 or areas[c] < bestArea or (areas[c] == bestArea and chunk[c] < bestIndex):
+        bestArea = float(areas[c])
+        bestIndex = int(chunk[c])
+        bestBounds = [float(centers[chunk[c], 0]), float(centers[chunk[c], 1]), float(rx[c]) * 2, float(ry[c]) * 2]
+
+  # combinations we didn't get to before the deadline count as pruned
+  count_stat('combinations_evaluated', evaluated)
+  count_stat('combinations_pruned', len(order) - evaluated)
+  return bestBounds
+
+#
+#
+#  B U B B L E   S H A P E S
+#
+# What a bubble looks like, in image coordinates. One of:
+#
+#     ['ellipse', x, y, width, height]           axis-aligned, by bounding box
+#     ['rotated', cx, cy, ra, rb, angle]         by center, radii and angle
+#     ['polygon', loops]                         rectangle bubble outline
+#
+# Shapes can be selected in gimp or rasterized with numpy (see below).
+
+# shapes of a bubble from its geometry (see computeBubbleGeometry). offset
+# is the offset of the layer the bubble is for
+def getBubbleShapes(geometry, xpad, ypad, radius = 0, offset = (0, 0)):
+  if geometry.get('regions'):
+    shapes = []
+    for region in geometry['regions']:
+      regionOffset = (offset[0] + region['offset'][0], offset[1] + region['offset'][1])
+      shapes.extend(getBubbleShapes(region, xpad, ypad, radius, regionOffset))
+    return shapes
+
+  if not geometry['rows']:
+    return []
+
+  dims = geometry['ellipse']
+  if dims is None:
+    return [['polygon', getRectangleBubbleOutline(geometry['rows'], xpad, ypad, radius, offset)]]
+
+  if len(dims) > 4:
+    return [['rotated', dims[0] + offset[0], dims[1] + offset[1], dims[2] / 2.0 + xpad, dims[3] / 2.0 + ypad, dims[4]]]
+
+  # ellipse grows by padding on every side. Note that the center gets rounded
+  # down, same as it always did
+  x = dims[0] - dims[2] // 2 - xpad + offset[0]
+  y = dims[1] - dims[3] // 2 - ypad + offset[1]
+  return [['ellipse', x, y, dims[2] + 2 * xpad, dims[3] + 2 * ypad]]
+
+# [x1, y1, x2, y2] of a shape
+def getShapeBounds(shape):
+  if shape[0] == 'ellipse':
+    return [shape[1], shape[2], shape[1] + shape[3], shape[2] + shape[4]]
+
+  if shape[0] == 'rotated':
+    [cx, cy, ra, rb, angle] = shape[1:]
+    # half-widths of the bounding box of a rotated ellipse
+    hw = math.sqrt((ra * math.cos(angle)) ** 2 + (rb * math.sin(angle)) ** 2)
+    hh = math.sqrt((ra * math.sin(angle)) ** 2 + (rb * math.cos(angle)) ** 2)
+    return [cx - hw, cy - hh, cx + hw, cy + hh]
+
+  points = [point for loop in shape[1] for point in loop]
+  return [min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points), max(p[1] for p in points)]
+
+# polygon shapes, as lists of loops that can be filled with a single polygon.
+# Polygons are filled even-odd, so where two bubbles overlap, the overlap
+# would be a hole. Shapes whose bounds overlap go into different lists. Most
+# of the time nothing overlaps and everything is one list
+def getDisjointPolygonLoops(shapes):
+  groups = []
+  for shape in shapes:
+    if shape[0] != 'polygon':
+      continue
+
+    bounds = getShapeBounds(shape)
+    for group in groups:
+      if not any(b[0] < bounds[2] and bounds[0] < b[2] and b[1] < bounds[3] and bounds[1] < b[3] for b in group[0]):
+        group[0].append(bounds)
+        group[1].extend(shape[1])
+        break
+    else:
+      groups.append([[bounds], list(shape[1])])
+
+  return [group[1] for group in groups]
+
+# whole-pixel [x, y, width, height] that covers all shapes plus margin,
+# clipped to the image. None if there's nothing to cover
+def getShapesBounds(shapes, margin, imageWidth, imageHeight):
+  if not shapes:
+    return None
+
+  bounds = [getShapeBounds(shape) for shape in shapes]
+  x1 = max(int(math.floor(min(b[0] for b in bounds) - margin)), 0)
+  y1 = max(int(math.floor(min(b[1] for b in bounds) - margin)), 0)
+  x2 = min(int(math.ceil(max(b[2] for b in bounds) + margin)), imageWidth)
+  y2 = min(int(math.ceil(max(b[3] for b in bounds) + margin)), imageHeight)
+
+  if x2 <= x1 or y2 <= y1:
+    return None
+  return [x1, y1, x2 - x1, y2 - y1]
+
+#
+#
+#  R A S T E R
+#
+# Draws shapes into a numpy array of coverage (0 to 1 per pixel, antialiased),
+# so bubbles can be written into a layer directly instead of going through
+# gimp's selection. Arrays cover bounds ([x, y, width, height] in image
+# coordinates) and have shape [height, width]. Needs numpy.
+
+# sub-rows per pixel row when rasterizing polygons. Horizontal coverage is
+# exact, vertical is sampled
+polygonSamples = 4
+
+# antialiased ellipse. Distance of every pixel center from the edge is
+# approximated with f / |grad f|, which is plenty for 1 px of antialiasing
+def rasterizeEllipse(coverage, bounds, cx, cy, ra, rb, angle = 0.0):
+  [bx, by, width, height] = bounds
+
+  # only touch pixels inside of ellipse's bounding box
+  [x1, y1, x2, y2] = getShapeBounds(['rotated', cx, cy, ra, rb, angle])
+  x1 = max(int(math.floor(x1)) - 1 - bx, 0)
+  y1 = max(int(math.floor(y1)) - 1 - by, 0)
+  x2 = min(int(math.ceil(x2)) + 1 - bx, width)
+  y2 = min(int(math.ceil(y2)) + 1 - by, height)
+  if x2 <= x1 or y2 <= y1 or ra <= 0 or rb <= 0:
+    return
+
+  dx = np.arange(x1, x2, dtype=np.float64)[None, :] + bx + 0.5 - cx
+  dy = np.arange(y1, y2, dtype=np.float64)[:, None] + by + 0.5 - cy
+  cos = math.cos(angle)
+  sin = math.sin(angle)
+  u = (dx * cos + dy * sin) / ra
+  v = (dy * cos - dx * sin) / rb
+
+  f = 1 - u * u - v * v
+  gradient = 2 * np.sqrt((u / ra) ** 2 + (v / rb) ** 2)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    distance = np.where(gradient > 0, f / gradient, np.inf)
+
+  region = coverage[y1:y2, x1:x2]
+  np.maximum(region, np.clip(distance + 0.5, 0, 1), out=region)
+
+# antialiased polygons, even-odd fill. Every loop is a list of [x, y]
+def rasterizePolygons(coverage, bounds, loops, samples = None):
+  [bx, by, width, height] = bounds
+  samples = samples or polygonSamples
+
+  # y of every sub-row, relative to bounds
+  ys = (np.arange(height * samples, dtype=np.float64) + 0.5) / samples
+
+  crossingRows = []
+  crossingXs = []
+  for loop in loops:
+    for k in xrange(0, len(loop)):
+      [xa, ya] = loop[k - 1]
+      [xb, yb] = loop[k]
+      if ya == yb:
+        continue
+      ya -= by; yb -= by; xa -= bx; xb -= bx
+
+      # sub-rows this edge crosses: ya <= y < yb (or the other way around)
+      first = np.searchsorted(ys, min(ya, yb), 'left')
+      last = np.searchsorted(ys, max(ya, yb), 'left')
+      if last <= first:
+        continue
+      rows = np.arange(first, last)
+      crossingRows.append(rows)
+      crossingXs.append(xa + (ys[rows] - ya) * (xb - xa) / (yb - ya))
+
+  if not crossingRows:
+    return
+
+  rows = np.concatenate(crossingRows)
+  xs = np.clip(np.concatenate(crossingXs), 0, width)
+
+  # sorted by row, then by x. Every row has an even number of crossings, so
+  # crossings pair up into spans that are inside
+  order = np.lexsort((xs, rows))
+  rows = rows[order]
+  xs = xs[order]
+  spanRows = rows[0::2]
+  starts = xs[0::2]
+  ends = xs[1::2]
+
+  # coverage of a span that starts at x is 1 - frac(x) in its first pixel
+  # and 1 after that. Written as differences, it's (1 - frac) at floor(x)
+  # and frac at floor(x) + 1. Ends are the same, but negative
+  diff = np.zeros((height * samples, width + 2), dtype=np.float64)
+  for [edge, sign] in [[starts, 1], [ends, -1]]:
+    pixel = np.floor(edge).astype(np.intp)
+    frac = edge - pixel
+    np.add.at(diff, (spanRows, pixel), sign * (1 - frac))
+    np.add.at(diff, (spanRows, pixel + 1), sign * frac)
+
+  rowCoverage = np.cumsum(diff, axis=1)[:, :width]
+  pixelCoverage = rowCoverage.reshape(height, samples, width).mean(axis=1)
+
+  np.maximum(coverage, np.clip(pixelCoverage, 0, 1), out=coverage)
+
+# coverage of all shapes, overlapping shapes are combined like selection adds.
+# Polygons that overlap are filled separately, same as selectShapes does
+def rasterizeShapes(shapes, bounds):
+  coverage = np.zeros((bounds[3], bounds[2]), dtype=np.float64)
+
+  for shape in shapes:
+    if shape[0] == 'ellipse':
+      [x, y, w, h] = shape[1:]
+      rasterizeEllipse(coverage, bounds, x + w / 2.0, y + h / 2.0, w / 2.0, h / 2.0)
+    elif shape[0] == 'rotated':
+      rasterizeEllipse(coverage, bounds, *shape[1:])
+
+  for loops in getDisjointPolygonLoops(shapes):
+    rasterizePolygons(coverage, bounds, loops)
+
+  return coverage
+
+# euclidean distance from every pixel to the nearest pixel of mask, as far
+# as limit. Anything further away than that gets a distance over limit.
+# Distance is worked out separately for columns and rows, and rows only need
+# to look limit pixels to either side, so this is a handful of array ops
+def getDistanceField(mask, limit):
+  [height, width] = mask.shape
+  far = int(math.ceil(limit)) + 1
+
+  # vertical distance to the nearest pixel of the mask in the same column.
+  # Row of the last mask pixel above (or at) every pixel, first one below
+  rows = np.arange(height)[:, None]
+  above = np.maximum.accumulate(np.where(mask, rows, -far - height), axis=0)
+  below = np.minimum.accumulate(np.where(mask, rows, far + 2 * height)[::-1], axis=0)[::-1]
+  vertical = np.minimum(np.minimum(rows - above, below - rows), far).astype(np.float64)
+
+  # nearest pixel of the mask is at most limit columns away
+  squared = vertical * vertical
+  best = squared.copy()
+  for dx in xrange(1, min(far, width)):
+    np.minimum(best[:, dx:], squared[:, :-dx] + dx * dx, out=best[:, dx:])
+    np.minimum(best[:, :-dx], squared[:, dx:] + dx * dx, out=best[:, :-dx])
+
+  return np.sqrt(np.minimum(best, far * far))
+
+# how far outline reaches past the edge of the bubble
+def getOutlineReach(thickness, feather):
+  return thickness + feather + 1
+
+# outline of a bubble from its coverage: everything within thickness of the
+# bubble, same as growing the selection. With feather, outline fades out
+# over feather pixels instead of having a hard (well, antialiased) edge.
+# Coverage needs getOutlineReach pixels of margin, or outline gets clipped
+def rasterizeOutline(coverage, thickness, feather):
+  distance = getDistanceField(coverage >= 0.5, getOutlineReach(thickness, feather))
+
+  if feather > 0:
+    outline = np.clip((thickness + 0.5 - distance) / feather + 0.5, 0, 1)
+  else:
+    outline = np.clip(thickness + 1 - distance, 0, 1)
+
+  return np.maximum(outline, coverage)
+
+#
+#
+#  G E O M E T R Y   J O B S
+#
+
+# computes geometry of one bubble from its text rows.
+# Returns {'rows': [...], 'ellipse': [...] or None}. If ellipse fitting ran
+# out of time, geometry also gets 'partial': True, so that it doesn't end up
+# in the cache
+def computeBubbleGeometry(textRows, isRound, minStepSize, xpad, ypad, options):
+  geometry = {'rows': textRows, 'ellipse': None}
+
+  # layers without any text in them don't get a bubble
+  if textRows:
+    if isRound:
+      deadline = getFitDeadline(options)
+      geometry['ellipse'] = getEllipseDimensions(textRows, xpad, ypad, options, deadline)
+      if isPastDeadline(deadline):
+        geometry['partial'] = True
+    else:
+      geometry['rows'] = correctRows(textRows, minStepSize)
+
+  return geometry
+
+# same as computeBubbleGeometry, but from alpha channel of the layer instead
+# of text rows. With 'split' option, layer is split into text regions (see
+# splitTextRegions) first. If there's more than one, geometry of every region
+# goes to 'regions' (with 'offset' of the region added) and 'rows' gets rows
+# of all of them, relative to the layer
+def computeAlphaGeometry(alpha, isRound, minStepSize, xpad, ypad, options):
+  if options.get('split'):
+    regions = splitTextRegions(alpha, options['split'])
+    if len(regions) > 1:
+      geometry = {'rows': [], 'ellipse': None, 'regions': []}
+      for [x, y, regionAlpha] in regions:
+        region = computeBubbleGeometry(findTextRows(regionAlpha), isRound, minStepSize, xpad, ypad, options)
+        region['offset'] = [x, y]
+        geometry['regions'].append(region)
+        geometry['rows'].extend([row[0] + y, row[1] + y, row[2] + x, row[3] + x] for row in region['rows'])
+        if region.pop('partial', False):
+          geometry['partial'] = True
+      return geometry
+
+  return computeBubbleGeometry(findTextRows(alpha), isRound, minStepSize, xpad, ypad, options)
+
+# entry point for worker processes. Job is a dict with either 'alpha' (numpy
+# array) or 'rows', plus 'key' and the shape parameters. Returns
+# [key, geometry, stats], because stats counted in a worker process don't
+# show up in the parent on their own
+def computeBubbleGeometryJob(job):
+  reset_geometry_stats()
+
+  if 'alpha' in job:
+    geometry = computeAlphaGeometry(job['alpha'], job['isRound'], job['minStepSize'], job['xpad'], job['ypad'], job['options'])
+  else:
+    geometry = computeBubbleGeometry(job['rows'], job['isRound'], job['minStepSize'], job['xpad'], job['ypad'], job['options'])
+
+  return [job['key'], geometry, dict(geometry_stats)]
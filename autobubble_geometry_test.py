@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+
+# Checks for the geometry code in autobubble_geometry.py. Like the benchmark,
+# these don't need gimp. Run them with pytest, or on their own:
+#
+#     python autobubble_geometry_test.py
+#
+# Most of them compare a fast version of something against the slow version
+# it replaced, on random inputs. Anything that needs numpy is skipped
+# without it.
+
+from __future__ import print_function
+
+import os
+import sys
+import math
+import time
+import json
+import random
+import unittest
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import autobubble_geometry as geometry
+
+np = geometry.np
+
+needs_numpy = unittest.skipIf(np is None, 'needs numpy')
+
+# random text rows as [top, bottom, left, right], one under another
+def random_rows(rng, rowCount, width = 400):
+  rows = []
+  top = rng.randint(0, 20)
+  for i in range(0, rowCount):
+    height = rng.randint(5, 30)
+    left = rng.randint(0, width // 2)
+    rows.append([top, top + height, left, rng.randint(left + 2, width)])
+    top += height + rng.randint(1, 15)
+  return rows
+
+# runs fn with numpy hidden from the geometry module, so it takes the plain
+# python path
+def without_numpy(fn, *args):
+  saved = geometry.np
+  geometry.np = None
+  try:
+    return fn(*args)
+  finally:
+    geometry.np = saved
+
+#
+#
+#  T E X T   R O W S
+#
+
+# rows the slow way: every row of pixels on its own, nothing pooled
+def reference_text_rows(alpha):
+  lefts = []
+  rights = []
+  for line in alpha:
+    columns = np.flatnonzero(line)
+    lefts.append(int(columns[0]) if len(columns) else None)
+    rights.append(int(columns[-1]) + 1 if len(columns) else None)
+
+  rows = []
+  top = None
+  for y in range(0, len(lefts) + 1):
+    hasText = y < len(lefts) and lefts[y] is not None
+    if hasText and top is None:
+      top = y
+    elif not hasText and top is not None:
+      band = range(top, max(y - 1, top + 1))
+      rows.append([top, y - 1, min(lefts[i] for i in band), max(rights[i] for i in band)])
+      top = None
+  return rows
+
+# readAlpha for findTextRowsSparse, over alpha as bytes
+def alpha_reader(alpha):
+  [height, width] = alpha.shape
+  data = np.ascontiguousarray(alpha).tobytes()
+  def readAlpha(x, y, w, h):
+    return b''.join(data[(y + i) * width + x:(y + i) * width + x + w] for i in range(0, h))
+  return readAlpha
+
+# blobs of random size anywhere on the layer, edges included. Odd sizes and
+# single pixels are what block pooling could get wrong
+def random_blobs(rng, width, height):
+  alpha = np.zeros((height, width), dtype=np.uint8)
+  for i in range(0, rng.randint(0, 8)):
+    [x, y] = [rng.randint(0, width - 1), rng.randint(0, height - 1)]
+    alpha[y:y + rng.randint(1, 20), x:x + rng.randint(1, 70)] = rng.choice([1, 128, 255])
+  return alpha
+
+@needs_numpy
+def test_find_text_rows_matches_sparse_and_reference():
+  rng = random.Random(24)
+  for i in range(0, 60):
+    alpha = random_blobs(rng, rng.randint(1, 200), rng.randint(1, 150))
+    [height, width] = alpha.shape
+    rows = geometry.findTextRows(alpha)
+    assert rows == reference_text_rows(alpha), i
+    assert rows == geometry.findTextRowsSparse(alpha_reader(alpha), width, height), i
+
+@needs_numpy
+def test_find_text_rows_takes_any_layout():
+  rng = random.Random(25)
+  for i in range(0, 30):
+    alpha = random_blobs(rng, rng.randint(1, 200), rng.randint(1, 150))
+    strided = np.zeros((alpha.shape[0] * 2, alpha.shape[1] * 3), dtype=np.uint8)
+    strided[::2, ::3] = alpha
+
+    # whatever the memory layout, rows are those of the same pixels
+    for layout in [np.asfortranarray(alpha), strided[::2, ::3], alpha[::-1], alpha[:, ::-1]]:
+      [height, width] = layout.shape
+      assert geometry.findTextRows(layout) == geometry.findTextRowsSparse(alpha_reader(layout), width, height), i
+
+#
+#
+#  T E X T   R E G I O N S
+#
+
+# mask grown by d pixels every way, corners included
+def dilate(mask, d):
+  grown = mask.copy()
+  for axis in [0, 1]:
+    spread = grown.copy()
+    for k in range(1, d + 1):
+      if k >= grown.shape[axis]:
+        break
+      if axis == 0:
+        spread[k:] |= grown[:-k]
+        spread[:-k] |= grown[k:]
+      else:
+        spread[:, k:] |= grown[:, :-k]
+        spread[:, :-k] |= grown[:, k:]
+    grown = spread
+  return grown
+
+# each region's ink put back on a canvas the size of the layer
+def region_canvases(regions, alpha):
+  canvases = []
+  for [x, y, part] in regions:
+    canvas = np.zeros(alpha.shape, dtype=alpha.dtype)
+    canvas[y:y + part.shape[0], x:x + part.shape[1]] = part
+    canvases.append(canvas)
+  return canvases
+
+@needs_numpy
+def test_split_text_regions_covers_ink_exactly():
+  rng = random.Random(23)
+  for i in range(0, 60):
+    alpha = random_blobs(rng, rng.randint(1, 200), rng.randint(1, 150))
+    distance = rng.randint(1, 20)
+    canvases = region_canvases(geometry.splitTextRegions(alpha, distance), alpha)
+
+    # every bit of ink in exactly one region, and no region without any
+    assert all(canvas.any() for canvas in canvases), i
+    if not canvases:
+      assert not alpha.any(), i
+      continue
+    inked = np.sum([canvas > 0 for canvas in canvases], axis=0)
+    assert inked.max() <= 1, i
+    assert (np.sum(canvases, axis=0) == alpha).all(), i
+
+    # ink within the distance of a region's ink is that region's
+    for k in range(0, len(canvases)):
+      near = dilate(canvases[k] > 0, distance)
+      assert all(not (near & (canvases[j] > 0)).any() for j in range(0, len(canvases)) if j != k), (i, distance)
+
+@needs_numpy
+def test_split_text_regions_keeps_far_blobs_apart():
+  rng = random.Random(26)
+  for i in range(0, 30):
+    distance = rng.randint(1, 20)
+    [w, h] = [rng.randint(1, 40), rng.randint(1, 40)]
+    gap = rng.randint(2 * distance, 2 * distance + 30)
+    alpha = np.zeros((h + rng.randint(0, 30), 2 * w + gap + rng.randint(0, 30)), dtype=np.uint8)
+    alpha[0:h, 0:w] = 255
+    alpha[0:h, w + gap:2 * w + gap] = 255
+
+    regions = geometry.splitTextRegions(alpha, distance)
+    assert len(regions) == 2, (i, distance, gap)
+
+    # and blobs closer than the distance are one region
+    alpha[:] = 0
+    alpha[0:h, 0:w] = 255
+    alpha[0:h, w + distance - 1:2 * w + distance - 1] = 255
+    assert len(geometry.splitTextRegions(alpha, distance)) == 1, (i, distance)
+
+#
+#
+#  C O N V E X   H U L L
+#
+
+def test_convex_hull_is_convex_and_holds_every_point():
+  rng = random.Random(4)
+  for i in range(0, 100):
+    # small grid, so there's plenty of duplicate and collinear points
+    points = [[float(rng.randint(0, 12)), float(rng.randint(0, 12))] for j in range(0, rng.randint(1, 30))]
+    hull = geometry.getConvexHull(points)
+
+    assert all(p in points for p in hull), i
+    assert len(set(map(tuple, hull))) == len(hull), i
+    if len(set(map(tuple, points))) < 3:
+      continue
+
+    # counter-clockwise with strict turns means no point sits on an edge, and
+    # every point is on the inner side of (or on) every edge
+    for k in range(0, len(hull)):
+      [a, b] = [hull[k], hull[(k + 1) % len(hull)]]
+      assert geometry.cross(a, b, hull[(k + 2) % len(hull)]) > 0 or len(hull) < 3, (i, hull)
+      assert all(geometry.cross(a, b, p) >= 0 for p in points), (i, hull)
+
+def test_edge_points_count_what_hull_dropped():
+  rng = random.Random(44)
+  for i in range(0, 30):
+    rows = random_rows(rng, rng.randint(1, 10))
+    geometry.reset_geometry_stats()
+    points = geometry.getEllipseEdgePoints(rows)
+    stats = geometry.geometry_stats
+
+    # every row has two corners on its top or bottom edge
+    assert stats['hull_points_in'] == 2 * (-(-len(rows) // 2) + len(rows) - len(rows) // 2), i
+    if stats['hull_points_in'] - stats['hull_points_dropped'] >= 4:
+      assert len(points) == stats['hull_points_in'] - stats['hull_points_dropped'], i
+    else:
+      assert len(points) == stats['hull_points_in'], i
+
+#
+#
+#  E L L I P S E   F I T
+#
+
+# whether ellipse dims ([cx, cy, w, h] or [cx, cy, w, h, angle]) contain
+# every point, give or take rounding
+def ellipse_contains(dims, points):
+  [cx, cy, w, h] = dims[0:4]
+  angle = dims[4] if len(dims) > 4 else 0
+  [cos, sin] = [math.cos(angle), math.sin(angle)]
+  for [x, y] in points:
+    da = (x - cx) * cos + (y - cy) * sin
+    db = -(x - cx) * sin + (y - cy) * cos
+    if (da / (w / 2.0)) ** 2 + (db / (h / 2.0)) ** 2 > 1 + 1e-9:
+      return False
+  return True
+
+def test_mvee_contains_points():
+  rng = random.Random(3)
+  for i in range(0, 20):
+    points = geometry.getEllipseEdgePoints(random_rows(rng, rng.randint(1, 8)))
+    box = geometry.getBoundingBoxEllipse(points)
+    axis = geometry.calculateEllipseBounds_mvee(points)
+    rotated = geometry.calculateEllipseBounds_mvee(points, rotated = True)
+
+    assert len(axis) == 4 and ellipse_contains(axis, points), (i, axis)
+    assert len(rotated) == 5 and ellipse_contains(rotated, points), (i, rotated)
+
+    # never worse than the ellipse around the bounding box, and turning
+    # can only help (give or take tolerance)
+    assert axis[2] * axis[3] <= box[2] * box[3] * 1.001, i
+    assert rotated[2] * rotated[3] <= axis[2] * axis[3] * 1.01, i
+
+# smallest ellipse around a rectangle is the one through its corners, with
+# axes sqrt(2) times its sides
+def test_mvee_of_rectangle():
+  rng = random.Random(4)
+  for i in range(0, 20):
+    [w, h] = [rng.uniform(10, 300), rng.uniform(10, 300)]
+    [x, y] = [rng.uniform(-50, 50), rng.uniform(-50, 50)]
+    corners = [[x, y], [x + w, y], [x + w, y + h], [x, y + h]]
+
+    dims = geometry.calculateEllipseBounds_mvee(corners, tolerance = 1e-6)
+    expected = [x + w / 2, y + h / 2, w * math.sqrt(2), h * math.sqrt(2)]
+    assert all(abs(a - b) < 1e-3 * max(w, h) for [a, b] in zip(dims, expected)), (i, dims, expected)
+
+    # same rectangle, turned. Area has to come out the same
+    angle = rng.uniform(0, math.pi)
+    [cos, sin] = [math.cos(angle), math.sin(angle)]
+    turned = [[px * cos - py * sin, px * sin + py * cos] for [px, py] in corners]
+    dims = geometry.calculateEllipseBounds_mvee(turned, tolerance = 1e-6, rotated = True)
+    assert ellipse_contains(dims, turned), i
+    assert abs(dims[2] * dims[3] - 2 * w * h) < 1e-3 * w * h, (i, dims)
+
+def test_mvee_out_of_time_still_contains_points():
+  rng = random.Random(22)
+  for i in range(0, 20):
+    points = geometry.getEllipseEdgePoints(random_rows(rng, rng.randint(1, 8)))
+    for rotated in [False, True]:
+      for dims in [
+        geometry.calculateEllipseBounds_mvee(points, rotated = rotated, deadline = time.time() - 1),
+        geometry.calculateEllipseBounds_mvee(points, rotated = rotated, maxIterations = 0),
+      ]:
+        assert ellipse_contains(dims, points), (i, rotated, dims)
+
+def test_budget_gives_partial_geometry_that_contains_text():
+  rng = random.Random(23)
+  for i in range(0, 20):
+    rows = random_rows(rng, rng.randint(1, 8))
+    points = geometry.getEllipseEdgePoints(rows)
+    fit = rng.choice(['mvee', 'bruteforce'])
+
+    # a nanosecond is less than time.time() can tell apart, so the deadline
+    # has passed before the first check
+    result = geometry.computeBubbleGeometry(rows, True, 25, 7, 3, {'budget': 1e-6, 'fit': fit, 'rotated': rng.random() < 0.5})
+    assert result.get('partial'), i
+    assert ellipse_contains(result['ellipse'], points), (i, fit, result['ellipse'])
+
+    result = geometry.computeBubbleGeometry(rows, True, 25, 7, 3, {'fit': fit})
+    assert not result.get('partial'), i
+
+#
+#
+#  B R U T E   F O R C E
+#
+
+@needs_numpy
+def test_bruteforce_batched_matches_scalar():
+  rng = random.Random(5)
+  for i in range(0, 40):
+    points = geometry.getEllipseEdgePoints(random_rows(rng, rng.randint(1, 6)))
+    batched = geometry.calculateEllipseBounds_bruteforce(points)
+    scalar = without_numpy(geometry.calculateEllipseBounds_bruteforce, points)
+    assert batched == scalar, (i, batched, scalar)
+
+@needs_numpy
+def test_bruteforce_combination_batched_matches_scalar():
+  rng = random.Random(6)
+  points = geometry.getEllipseEdgePoints(random_rows(rng, 5))
+  work = []
+  for combination in itertools.combinations(points, 4):
+    [mx, my] = geometry.getEllipseCenterForPoints(combination)
+    if mx != -1:
+      work.append([combination, mx, my])
+
+  pointsArray = np.array(points, dtype=np.float64)
+  [rx, ry] = geometry.bruteforceEllipseBounds_batched(pointsArray, np.array([w[0] for w in work], dtype=np.float64), np.array([w[1] for w in work]), np.array([w[2] for w in work]))
+  for i in range(0, len(work)):
+    assert [rx[i], ry[i]] == geometry.bruteforceEllipseBounds(points, *work[i]), i
+
+# runs fn with lower bounds that never prune anything
+def without_pruning(fn, *args):
+  saved = [geometry.getEllipseAreaLowerBound, geometry.getEllipseAreaLowerBounds]
+  geometry.getEllipseAreaLowerBound = lambda points, mx, my: 0
+  geometry.getEllipseAreaLowerBounds = lambda points, mx, my: np.zeros(len(mx))
+  try:
+    return fn(*args)
+  finally:
+    [geometry.getEllipseAreaLowerBound, geometry.getEllipseAreaLowerBounds] = saved
+
+def test_area_lower_bound_holds():
+  rng = random.Random(60)
+  checked = 0
+  for i in range(0, 10):
+    points = geometry.getEllipseEdgePoints(random_rows(rng, rng.randint(2, 6)))
+    for combination in itertools.combinations(points, 4):
+      [mx, my] = geometry.getEllipseCenterForPoints(combination)
+      if mx == -1:
+        continue
+      [rx, ry] = geometry.bruteforceEllipseBounds(points, combination, mx, my)
+
+      # search can give up on far away centers before its ellipse holds
+      # every point. Bound is only about ellipses that do
+      if not ellipse_contains([mx, my, 2 * rx, 2 * ry], points):
+        continue
+      checked += 1
+      assert geometry.getEllipseAreaLowerBound(points, mx, my) * (1 - geometry.lowerBoundSlack) <= rx * ry, (i, combination)
+  assert checked > 0
+
+def test_pruned_bruteforce_matches_unpruned():
+  rng = random.Random(61)
+  pruned = 0
+  for i in range(0, 15):
+    points = geometry.getEllipseEdgePoints(random_rows(rng, rng.randint(1, 6)))
+
+    geometry.reset_geometry_stats()
+    scalar = without_numpy(geometry.calculateEllipseBounds_bruteforce, points)
+    pruned += geometry.geometry_stats.get('combinations_pruned', 0)
+    assert scalar == without_numpy(without_pruning, geometry.calculateEllipseBounds_bruteforce, points), i
+
+    if np is not None:
+      batched = geometry.calculateEllipseBounds_bruteforce(points)
+      assert batched == without_pruning(geometry.calculateEllipseBounds_bruteforce, points), i
+
+  # or there'd be nothing to compare
+  assert pruned > 0
+
+#
+#
+#  R E C T A N G L E   O U T L I N E
+#
+
+# pixels inside of any of the rects, as [height, width] bool array
+def rects_mask(rects, width, height):
+  mask = np.zeros((height, width), dtype=bool)
+  for [x1, y1, x2, y2] in rects:
+    mask[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)] = True
+  return mask
+
+@needs_numpy
+def test_rectangle_outline_covers_union_of_rects():
+  rng = random.Random(16)
+  for i in range(0, 100):
+    rows = geometry.correctRows(random_rows(rng, rng.randint(1, 8)), rng.choice([0, 10, 25]))
+    [xpad, ypad] = [rng.randint(0, 10), rng.randint(0, 10)]
+    rects = geometry.getRectangleBubbleRects(rows, xpad, ypad)
+    loops = geometry.getRectangleBubbleOutline(rows, xpad, ypad)
+
+    # every corner is a whole pixel, so coverage is exactly 0 or 1
+    coverage = np.zeros((500, 450), dtype=np.float64)
+    geometry.rasterizePolygons(coverage, [-20, -20, 450, 500], loops)
+    assert (coverage == rects_mask([[r[0] + 20, r[1] + 20, r[2] + 20, r[3] + 20] for r in rects], 450, 500)).all(), i
+
+def test_overlapping_polygons_are_never_filled_together():
+  rng = random.Random(17)
+  shapes = []
+  for i in range(0, 30):
+    x = rng.randint(0, 300)
+    y = rng.randint(0, 300)
+    shapes.append(['polygon', [[[x, y], [x + 40, y], [x + 40, y + 20], [x, y + 20]]]])
+
+  groups = geometry.getDisjointPolygonLoops(shapes)
+  assert sum(len(loops) for loops in groups) == len(shapes)
+  for loops in groups:
+    bounds = [geometry.getShapeBounds(['polygon', [loop]]) for loop in loops]
+    for [a, b] in itertools.combinations(bounds, 2):
+      assert not (a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3])
+
+#
+#
+#  R A S T E R
+#
+
+@needs_numpy
+def test_overlapping_polygons_rasterize_as_union():
+  shapes = [
+    ['polygon', [[[0, 0], [30, 0], [30, 20], [0, 20]]]],
+    ['polygon', [[[10, 10], [40, 10], [40, 30], [10, 30]]]],
+  ]
+  coverage = geometry.rasterizeShapes(shapes, [0, 0, 50, 40])
+  assert (coverage == rects_mask([[0, 0, 30, 20], [10, 10, 40, 30]], 50, 40)).all()
+
+@needs_numpy
+def test_rasterized_ellipse_matches_area():
+  rng = random.Random(18)
+  for i in range(0, 20):
+    [ra, rb] = [rng.uniform(5, 60), rng.uniform(5, 60)]
+    angle = rng.uniform(0, 3.2)
+    coverage = np.zeros((140, 140), dtype=np.float64)
+    geometry.rasterizeEllipse(coverage, [0, 0, 140, 140], 70.0, 70.0, ra, rb, angle)
+    # antialiased edge is off by less than a pixel along the circumference
+    assert abs(coverage.sum() - math.pi * ra * rb) < 2 * math.pi * max(ra, rb) * 0.1, i
+
+# distance from every pixel to every pixel of the mask, keeping the nearest
+def reference_distance_field(mask):
+  [height, width] = mask.shape
+  [ys, xs] = np.nonzero(mask)
+  if len(ys) == 0:
+    return np.full(mask.shape, np.inf)
+  [rows, columns] = np.mgrid[0:height, 0:width]
+  return np.sqrt(((rows[:, :, None] - ys) ** 2 + (columns[:, :, None] - xs) ** 2).min(axis=2))
+
+@needs_numpy
+def test_distance_field_matches_brute_force():
+  rng = random.Random(19)
+  for i in range(0, 30):
+    [width, height] = [rng.randint(1, 50), rng.randint(1, 40)]
+    mask = np.zeros((height, width), dtype=bool)
+    for j in range(0, rng.randint(0, 5)):
+      [x, y] = [rng.randint(0, width - 1), rng.randint(0, height - 1)]
+      mask[y:y + rng.randint(1, 10), x:x + rng.randint(1, 10)] = True
+    limit = rng.uniform(0.5, 12)
+
+    field = geometry.getDistanceField(mask, limit)
+    expected = reference_distance_field(mask)
+
+    # exact within limit, anything further is just further
+    near = expected <= limit
+    assert np.allclose(field[near], expected[near]), i
+    assert (field[~near] > limit).all(), i
+
+@needs_numpy
+def test_outline_covers_everything_within_thickness():
+  rng = random.Random(20)
+  for i in range(0, 10):
+    [ra, rb] = [rng.uniform(3, 15), rng.uniform(3, 15)]
+    thickness = rng.randint(1, 8)
+    coverage = np.zeros((60, 60), dtype=np.float64)
+    geometry.rasterizeEllipse(coverage, [0, 0, 60, 60], 30.0, 30.0, ra, rb, rng.uniform(0, 3.2))
+
+    outline = geometry.rasterizeOutline(coverage, thickness, 0)
+    distance = reference_distance_field(coverage >= 0.5)
+    assert (outline[distance <= thickness] == 1).all(), i
+    assert (outline[distance > thickness + 1] == coverage[distance > thickness + 1]).all(), i
+
+#
+#
+#  P L A N S
+#
+# Plans and the geometry cache are JSON, and bubbles get drawn from whatever
+# comes back out of it. That has to be the same bubble
+
+# a few blobs of random text rows in different quarters of the layer, so
+# split has something to split
+def random_alpha(rng, width, height):
+  alpha = np.zeros((height, width), dtype=np.uint8)
+  quarters = [[0, 0], [width // 2, 0], [0, height // 2], [width // 2, height // 2]]
+  for [x, y] in rng.sample(quarters, rng.randint(1, 3)):
+    for [top, bottom, left, right] in random_rows(rng, rng.randint(1, 3), width // 2 - 10):
+      if bottom < height // 2 - 10:
+        alpha[y + top:y + bottom + 1, x + left:x + right] = 255
+  return alpha
+
+@needs_numpy
+def test_geometry_survives_json():
+  rng = random.Random(20)
+  for i in range(0, 30):
+    alpha = random_alpha(rng, 300, 240)
+    options = rng.choice([{}, {'split': 32}, {'rotated': True}, {'split': 32, 'fit': 'bruteforce'}])
+    result = geometry.computeAlphaGeometry(alpha, rng.random() < 0.7, 25, 7, 3, options)
+    loaded = json.loads(json.dumps(result))
+
+    shapes = geometry.getBubbleShapes(result, 7, 3)
+    assert json.loads(json.dumps(shapes)) == geometry.getBubbleShapes(loaded, 7, 3), i
+
+    # and plans keep shapes as JSON too
+    bounds = [-20, -20, 320, 260]
+    assert (geometry.rasterizeShapes(shapes, bounds) == geometry.rasterizeShapes(json.loads(json.dumps(shapes)), bounds)).all(), i
+
+#
+#
+#  R U N N I N G
+#
+
+def main():
+  tests = sorted(name for name in globals() if name.startswith('test_'))
+  for name in tests:
+    try:
+      globals()[name]()
+    except unittest.SkipTest as e:
+      print('skip {} ({})'.format(name, e))
+      continue
+    print('ok  ' + name)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())